@@ -0,0 +1,136 @@
+"""
+Static assets — content-hashed URLs, immutable caching, strong ETags and
+precompressed gzip/brotli variants, all computed once at startup.
+
+Templates link assets through `asset_url(name)` -> `/static/<name>?v=<hash>`.
+A request carrying the current hash is cached forever (`immutable`); anything
+else must revalidate, which is a cheap 304 thanks to the ETag.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:  # optional dependency
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {"text/css", "text/html", "text/plain", "application/javascript",
+                "text/javascript", "application/json", "image/svg+xml"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+def write_if_changed(path: str, text: str) -> bool:
+    """Write `text` unless the file already holds exactly that; keeps mtimes
+    (and therefore any downstream caches/watchers) stable across restarts."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return True
+
+
+class Asset:
+    __slots__ = ("body", "version", "media_type", "variants")
+
+    def __init__(self, body: bytes, media_type: str):
+        self.body = body
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        self.media_type = media_type
+        self.variants: Dict[str, bytes] = {}   # content-encoding -> bytes
+        if media_type in COMPRESSIBLE and len(body) > 256:
+            if brotli is not None:
+                self._keep("br", brotli.compress(body, quality=11))
+            self._keep("gzip", gzip.compress(body, compresslevel=9, mtime=0))
+
+    def _keep(self, encoding: str, data: bytes):
+        if len(data) < len(self.body):
+            self.variants[encoding] = data
+
+    def etag(self, encoding: Optional[str]) -> str:
+        # Strong ETags must differ per representation.
+        return f'"{self.version}-{encoding}"' if encoding else f'"{self.version}"'
+
+
+def _accepts(header: str, encoding: str) -> bool:
+    for part in header.split(","):
+        token, *params = [x.strip() for x in part.split(";")]
+        if token.lower() != encoding:
+            continue
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+class AssetManifest:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.assets: Dict[str, Asset] = {}
+        self.scan()
+
+    def scan(self):
+        assets = {}
+        for root, _dirs, files in os.walk(self.directory):
+            for fn in files:
+                full = os.path.join(root, fn)
+                name = os.path.relpath(full, self.directory).replace(os.sep, "/")
+                assets[name] = self._load(full)
+        self.assets = assets
+
+    @staticmethod
+    def _load(full: str) -> Asset:
+        with open(full, "rb") as f:
+            body = f.read()
+        media_type = mimetypes.guess_type(full)[0] or "application/octet-stream"
+        return Asset(body, media_type)
+
+    def get(self, name: str) -> Optional[Asset]:
+        asset = self.assets.get(name)
+        if asset is None:
+            # Files added after startup; never serve anything outside the directory.
+            full = os.path.realpath(os.path.join(self.directory, name))
+            if full.startswith(os.path.realpath(self.directory) + os.sep) and os.path.isfile(full):
+                asset = self.assets[name] = self._load(full)
+        return asset
+
+    def url(self, name: str) -> str:
+        asset = self.get(name)
+        return f"/static/{name}?v={asset.version}" if asset else f"/static/{name}"
+
+    def response(self, request: Request, name: str) -> Response:
+        asset = self.get(name)
+        if asset is None:
+            return Response("Not Found", status_code=404, media_type="text/plain")
+
+        accept = request.headers.get("accept-encoding", "")
+        encoding = next((e for e in ("br", "gzip") if e in asset.variants and _accepts(accept, e)), None)
+        etag = asset.etag(encoding)
+        headers = {
+            "ETag": etag,
+            "Cache-Control": IMMUTABLE if request.query_params.get("v") == asset.version else REVALIDATE,
+            "Vary": "Accept-Encoding",
+        }
+        inm = request.headers.get("if-none-match")
+        if inm and (inm.strip() == "*" or etag in [t.strip() for t in inm.split(",")]):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
+        return Response(asset.body, media_type=asset.media_type, headers=headers)
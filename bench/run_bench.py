@@ -0,0 +1,536 @@
+"""
+Load/benchmark harness — starts the stub LLM and the app as subprocesses in a
+scratch directory, drives endpoints at fixed concurrency levels and writes
+throughput and latency percentiles to a JSON file for run-to-run comparison.
+
+    python bench/run_bench.py --out bench-results.json
+    python bench/run_bench.py --scenarios history --history-rows 2000000
+    python bench/run_bench.py --scenarios free_many_ip,paid_single_ip --concurrency 1,32 --duration 20
+    python bench/run_bench.py --scenarios free_many_ip --stubs 2 --brownout-latency-ms 3000
+
+Scenarios (each gets a fresh database):
+  free_many_ip / free_single_ip   ROLLOVER_MODE=0 with an effectively unlimited cap
+  paid_many_ip / paid_single_ip   ROLLOVER_MODE=1 with an effectively unlimited balance
+  quota_contention                one IP fires --quota-attempts concurrent calls at a FREE cap
+                                  and a PAID balance of --quota-limit; exactly that many must
+                                  succeed, and the stored counter/balance must match after
+                                  shutdown. Runs once per --quota-backends entry: memory
+                                  (QUOTA_FLUSH_INTERVAL=1, in-process QuotaStore), sqlite (the
+                                  default atomic UPSERT / BEGIN IMMEDIATE path) and workers (launcher
+                                  with --quota-workers processes sharing the database)
+  quota_flush_race                in-process QuotaStore check: a key evicted and reloaded while
+                                  a write-back is held must still see the charges being written
+  coalesce                        --coalesce-attempts identical concurrent calls, first to
+                                  /enhance and then to /enhance_stream (hedging off); each burst
+                                  must reach the stub exactly once
+  history                         /history and /save over a table seeded with --history-rows
+
+"many IP" spreads requests over --ips distinct X-Forwarded-For addresses; "single IP"
+puts all of them on one, so every request contends on the same quota row. Enhance
+prompts are unique per request and the response cache is off (unless --cache), so
+/enhance always measures the upstream path. The load generator shares the machine
+with the app and stub; compare runs made on the same host.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+UNLIMITED = str(10 ** 9)
+MODE_ENV = {
+    "free": {"ROLLOVER_MODE": "0", "DAILY_FREE_LIMIT": UNLIMITED},
+    "paid": {"ROLLOVER_MODE": "1", "INITIAL_CREDITS": UNLIMITED, "MAX_BALANCE": UNLIMITED},
+}
+SCENARIOS = ["free_many_ip", "free_single_ip", "paid_many_ip", "paid_single_ip", "quota_contention",
+             "quota_flush_race", "coalesce", "history"]
+BUILD_BODY = {"audience": "busy parents", "tone": "warm", "goal": "Instagram caption",
+              "platform": "Instagram", "details": "lunchbox subscription"}
+
+
+# ---------------- Processes ----------------
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, proc: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"process exited with {proc.returncode} before {url} came up")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"timed out waiting for {url}")
+
+
+def stop(proc: Optional[subprocess.Popen]):
+    if proc is not None and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def start_stub(args, latency_ms: float, error_rate: float) -> tuple:
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "stub_llm.py"), "--port", str(port),
+                             "--latency-ms", str(latency_ms), "--jitter-ms", str(args.stub_jitter_ms),
+                             "--error-rate", str(error_rate), "--tokens", str(args.stub_tokens),
+                             "--token-delay-ms", str(args.stub_token_delay_ms)])
+    wait_ready(f"http://127.0.0.1:{port}/stats", proc)
+    return proc, f"http://127.0.0.1:{port}/v1"
+
+
+def start_stubs(args) -> tuple:
+    """--stubs N backends; with --brownout-latency-ms the first one is degraded."""
+    procs, urls = [], []
+    for i in range(max(args.stubs, 1)):
+        brownout = i == 0 and args.brownout_latency_ms is not None
+        proc, url = start_stub(args, args.brownout_latency_ms if brownout else args.stub_latency_ms,
+                               args.brownout_error_rate if brownout else args.stub_error_rate)
+        procs.append(proc)
+        urls.append(url)
+    return procs, urls
+
+
+def app_env(workdir: str, stub_urls: List[str], cache: bool, extra: Dict[str, str]) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPO_DIR + os.pathsep + env.get("PYTHONPATH", ""),
+        "ENABLE_GPT": "1", "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": stub_urls[0],
+        "DB_FILE": os.path.join(workdir, "bench.db"), "RETENTION_INTERVAL": "0",
+        "CACHE_ENABLED": "1" if cache else "0", "LOG_LEVEL": "WARNING",
+    })
+    if len(stub_urls) > 1:
+        env["UPSTREAMS"] = json.dumps([{"name": f"stub{i}", "base_url": u} for i, u in enumerate(stub_urls)])
+    env.update(extra)
+    return env
+
+
+def prepare_db(workdir: str, env: Dict[str, str]):
+    """Import the app once so it writes its assets and runs migrations."""
+    subprocess.run([sys.executable, "-c", "import prompt_wizard"], cwd=workdir, env=env, check=True)
+
+
+def stub_calls(stub_urls: List[str]) -> int:
+    """Chat completion requests the stubs have received so far."""
+    return sum(httpx.get(u.rsplit("/v1", 1)[0] + "/stats", timeout=5).json()["requests"] for u in stub_urls)
+
+
+def start_app(workdir: str, env: Dict[str, str], workers: int = 1) -> tuple:
+    port = free_port()
+    if workers > 1:
+        cmd = [sys.executable, os.path.join(REPO_DIR, "prompt_wizard.py"), "serve", "--host", "127.0.0.1",
+               "--port", str(port), "--workers", str(workers)]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "prompt_wizard:app", "--host", "127.0.0.1",
+               "--port", str(port), "--log-level", "warning", "--no-access-log"]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+    base = f"http://127.0.0.1:{port}"
+    wait_ready(base + "/health", proc)
+    return proc, base
+
+
+def seed_history(db_path: str, rows: int, batch: int = 50_000):
+    conn = sqlite3.connect(db_path)
+    filler = "Create 3 variants of an Instagram caption for busy parents about lunchbox subscriptions. "
+    start = time.perf_counter()
+    done = 0
+    while done < rows:
+        n = min(batch, rows - done)
+        conn.executemany("INSERT INTO history (prompt, created_at) VALUES (?, ?)",
+                         ((f"{filler}#{done + i}", "2025-01-01 00:00") for i in range(n)))
+        conn.commit()
+        done += n
+    conn.close()
+    print(f"  seeded {rows:,} history rows in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+# ---------------- Load ----------------
+def percentile(sorted_vals: List[float], p: float) -> Optional[float]:
+    if not sorted_vals:
+        return None
+    k = math.ceil(p / 100 * len(sorted_vals)) - 1   # nearest rank
+    return sorted_vals[min(max(k, 0), len(sorted_vals) - 1)]
+
+
+def summarize(lat: List[float], prefix: str = "") -> Dict[str, Any]:
+    lat = sorted(lat)
+    ms = lambda v: None if v is None else round(v * 1000, 2)
+    return {f"{prefix}p50_ms": ms(percentile(lat, 50)), f"{prefix}p95_ms": ms(percentile(lat, 95)),
+            f"{prefix}p99_ms": ms(percentile(lat, 99)), f"{prefix}max_ms": ms(lat[-1] if lat else None)}
+
+
+class Endpoint:
+    def __init__(self, name: str, method: str, path: str, body: Optional[Callable[[], Any]] = None,
+                 stream: bool = False):
+        self.name, self.method, self.path, self.body, self.stream = name, method, path, body, stream
+
+
+def mode_endpoints(mode: str) -> List[Endpoint]:
+    prompt = lambda: {"prompt": f"Write a caption about lunchboxes ({uuid.uuid4().hex})"}
+    return [
+        Endpoint("build", "POST", "/build", lambda: BUILD_BODY),
+        Endpoint("enhance", "POST", "/enhance", prompt),
+        Endpoint("enhance_stream", "POST", "/enhance_stream", prompt, stream=True),
+        Endpoint("quota_status", "GET", "/credits_status" if mode == "paid" else "/usage_today"),
+        Endpoint("health", "GET", "/health"),
+    ]
+
+
+def ip_picker(many: bool, n_ips: int) -> Callable[[], str]:
+    if not many:
+        return lambda: "10.0.0.1"
+    n_ips = max(1, min(n_ips, 65536))
+
+    def pick() -> str:
+        k = random.randrange(n_ips)
+        return f"10.1.{k // 256}.{k % 256}"
+    return pick
+
+
+async def one_request(client: httpx.AsyncClient, ep: Endpoint, ip: str) -> tuple:
+    """-> (status, total_seconds, first_token_seconds or None)"""
+    headers = {"X-Forwarded-For": ip}
+    body = ep.body() if ep.body else None
+    t0 = time.perf_counter()
+    if not ep.stream:
+        r = await client.request(ep.method, ep.path, json=body, headers=headers)
+        return r.status_code, time.perf_counter() - t0, None
+    first = None
+    async with client.stream(ep.method, ep.path, json=body, headers=headers) as r:
+        async for line in r.aiter_lines():
+            if first is None and line.startswith("event: token"):
+                first = time.perf_counter() - t0
+            if line.startswith("event: error"):
+                return "stream_error", time.perf_counter() - t0, first
+    return r.status_code, time.perf_counter() - t0, first
+
+
+async def drive(base: str, ep: Endpoint, concurrency: int, duration: float, pick_ip: Callable[[], str]) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    lat: List[float] = []
+    ttft: List[float] = []
+    statuses: Counter = Counter()
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=60) as client:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + duration
+
+        async def worker():
+            while loop.time() < deadline:
+                try:
+                    status, secs, first = await one_request(client, ep, pick_ip())
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                    continue
+                statuses[status] += 1
+                lat.append(secs)
+                if first is not None:
+                    ttft.append(first)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    total = sum(statuses.values())
+    ok = sum(n for s, n in statuses.items() if isinstance(s, int) and s < 400)
+    out = {"endpoint": ep.name, "concurrency": concurrency, "requests": total, "ok": ok, "errors": total - ok,
+           "rps": round(total / elapsed, 1) if elapsed else None,
+           "status_counts": {str(k): v for k, v in sorted(statuses.items(), key=str)}, **summarize(lat)}
+    if ep.stream:
+        out.update(summarize(ttft, "first_token_"))
+    return out
+
+
+async def quota_burst(base: str, path: str, attempts: int) -> Counter:
+    """Fire `attempts` /enhance calls from one IP at once; returns status counts."""
+    limits = httpx.Limits(max_connections=attempts, max_keepalive_connections=attempts)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=60) as client:
+        ep = Endpoint("enhance", "POST", path, lambda: {"prompt": f"burst {uuid.uuid4().hex}"})
+        results = await asyncio.gather(*(one_request(client, ep, "10.9.9.9") for _ in range(attempts)),
+                                       return_exceptions=True)
+    return Counter(r[0] if isinstance(r, tuple) else type(r).__name__ for r in results)
+
+
+async def identical_burst(base: str, ep: Endpoint, attempts: int) -> Counter:
+    """Fire `attempts` calls with the same body at once; returns status counts."""
+    limits = httpx.Limits(max_connections=attempts, max_keepalive_connections=attempts)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=60) as client:
+        results = await asyncio.gather(*(one_request(client, ep, f"10.8.{i // 256}.{i % 256}") for i in range(attempts)),
+                                       return_exceptions=True)
+    return Counter(r[0] if isinstance(r, tuple) else type(r).__name__ for r in results)
+
+
+# ---------------- Scenarios ----------------
+def run_scenario(name: str, args, stub_urls: List[str]) -> List[Dict[str, Any]]:
+    with tempfile.TemporaryDirectory(prefix=f"pw-bench-{name}-") as workdir:
+        if name == "quota_contention":
+            return run_quota_contention(workdir, args, stub_urls)
+        if name == "quota_flush_race":
+            return [asyncio.run(quota_flush_race())]
+        if name == "coalesce":
+            return run_coalesce(workdir, args, stub_urls)
+
+        mode = "paid" if name.startswith("paid") else "free"
+        env = app_env(workdir, stub_urls, args.cache, MODE_ENV[mode])
+        prepare_db(workdir, env)
+        if name == "history":
+            seed_history(env["DB_FILE"], args.history_rows)
+            endpoints = [Endpoint("history", "GET", "/history"),
+                         Endpoint("save", "POST", "/save", lambda: {"prompt": f"saved {uuid.uuid4().hex}"})]
+            pick_ip = ip_picker(True, args.ips)
+        else:
+            endpoints = mode_endpoints(mode)
+            pick_ip = ip_picker(name.endswith("many_ip"), args.ips)
+        if args.endpoints:
+            endpoints = [e for e in endpoints if e.name in args.endpoints]
+
+        proc, base = start_app(workdir, env)
+        try:
+            results = []
+            for ep in endpoints:
+                for c in args.concurrency:
+                    r = asyncio.run(drive(base, ep, c, args.duration, pick_ip))
+                    r["scenario"] = name
+                    if name == "history":
+                        r["history_rows"] = args.history_rows
+                    results.append(r)
+                    print(f"  {name:16} {ep.name:15} c={c:<4} {r['rps']:>8} rps  p50={r['p50_ms']}ms "
+                          f"p99={r['p99_ms']}ms  errors={r['errors']}", file=sys.stderr)
+            return results
+        finally:
+            stop(proc)
+
+
+QUOTA_BACKENDS = {"memory": {"QUOTA_FLUSH_INTERVAL": "1"}, "sqlite": {}, "workers": {}}
+
+
+def stored_quota(db_path: str, mode: str, ip: str) -> Optional[int]:
+    """Charges the database recorded for `ip` today: the FREE counter, or the PAID
+    balance spent (read after the app has shut down and flushed)."""
+    conn = sqlite3.connect(db_path)
+    try:
+        if mode == "free":
+            row = conn.execute("SELECT SUM(count) FROM usage_counts WHERE ip = ?", (ip,)).fetchone()
+            return row[0] or 0
+        row = conn.execute("SELECT balance FROM credit_wallets WHERE ip = ?", (ip,)).fetchone()
+        return None if row is None else row[0]
+    finally:
+        conn.close()
+
+
+def run_quota_contention(workdir: str, args, stub_urls: List[str]) -> List[Dict[str, Any]]:
+    results = []
+    limit = args.quota_limit
+    attempts = max(args.quota_attempts, limit + 1)
+    for backend in args.quota_backends:
+        workers = args.quota_workers if backend == "workers" else 1
+        for mode, extra in (("free", {"ROLLOVER_MODE": "0", "DAILY_FREE_LIMIT": str(limit)}),
+                            ("paid", {"ROLLOVER_MODE": "1", "INITIAL_CREDITS": str(limit), "MAX_BALANCE": str(limit),
+                                      "DAILY_GRANT": "0"})):
+            mode_dir = os.path.join(workdir, f"{backend}-{mode}")
+            os.makedirs(mode_dir)
+            env = app_env(mode_dir, stub_urls, False, {**extra, **QUOTA_BACKENDS[backend]})
+            prepare_db(mode_dir, env)
+            proc, base = start_app(mode_dir, env, workers)
+            try:
+                counts = asyncio.run(quota_burst(base, "/enhance", attempts))
+            finally:
+                stop(proc)
+            stored = stored_quota(env["DB_FILE"], mode, "10.9.9.9")
+            succeeded = counts.get(200, 0)
+            rejected = counts.get(429 if mode == "free" else 402, 0)
+            # Failed upstream calls are refunded, so with --stub-error-rate > 0 only the
+            # upper bound can be checked.
+            failed = counts.get(500, 0)
+            expected_stored = succeeded if mode == "free" else limit - succeeded
+            exact = ((succeeded == limit and rejected == attempts - limit) if not failed else succeeded <= limit) \
+                and stored == expected_stored
+            results.append({"scenario": "quota_contention", "backend": backend, "workers": workers, "mode": mode,
+                            "limit": limit, "attempts": attempts, "succeeded": succeeded, "rejected": rejected,
+                            "stored": stored, "status_counts": {str(k): v for k, v in counts.items()}, "exact": exact})
+            print(f"  quota_contention {backend:7} {mode}: {succeeded}/{limit} succeeded, {rejected} rejected, "
+                  f"stored={stored}, exact={exact}", file=sys.stderr)
+    return results
+
+
+class GatedDB:
+    """Stand-in for db.Database that runs QuotaStore callbacks inline over dicts
+    and holds write-backs while `gate` is clear (the loaders are plain calls,
+    write_back a coroutine)."""
+
+    def __init__(self):
+        self.usage: Dict[tuple, int] = {}
+        self.wallets: Dict[str, list] = {}
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.writing = asyncio.Event()
+
+    async def run(self, fn, *args):
+        out = fn(self, *args)
+        return await out if asyncio.iscoroutine(out) else out
+
+    def load_usage(self, ip: str, day: str) -> int:
+        return self.usage.get((ip, day), 0)
+
+    def load_wallet(self, ip: str) -> tuple:
+        return tuple(self.wallets.setdefault(ip, [10, "2025-01-01"]))
+
+    async def write_back(self, usage: List[tuple], wallets: List[tuple]):
+        self.writing.set()
+        await self.gate.wait()
+        for ip, day, delta in usage:
+            self.usage[(ip, day)] = self.usage.get((ip, day), 0) + delta
+        for ip, delta, last_grant_day in wallets:
+            self.wallets[ip] = [self.wallets[ip][0] + delta, last_grant_day]
+
+
+async def quota_flush_race() -> Dict[str, Any]:
+    sys.path.insert(0, REPO_DIR)
+    from quota import QuotaStore
+
+    db = GatedDB()
+    store = QuotaStore(db, GatedDB.load_usage, GatedDB.load_wallet, GatedDB.write_back, today=lambda: "2025-01-01",
+                       free_limit=5, daily_grant=0, max_balance=10, max_items=1, flush_interval=60)
+    await store.use_free("a")
+    await store.spend("a", 3)
+    db.gate.clear()
+    flush = asyncio.ensure_future(store.flush())
+    await db.writing.wait()
+    await store.use_free("b")   # max_items=1: evicts a's entries mid-write-back
+    await store.balance("b")
+    seen = (await store.usage_count("a"), await store.balance("a"))
+    db.gate.set()
+    await flush
+    await store.flush()
+    stored = (db.usage[("a", "2025-01-01")], db.wallets["a"][0])
+    exact = seen == (1, 7) and stored == (1, 7)
+    print(f"  quota_flush_race: seen={seen} stored={stored} (want (1, 7)), exact={exact}", file=sys.stderr)
+    return {"scenario": "quota_flush_race", "seen": list(seen), "stored": list(stored), "exact": exact}
+
+
+def run_coalesce(workdir: str, args, stub_urls: List[str]) -> List[Dict[str, Any]]:
+    results = []
+    env = app_env(workdir, stub_urls, False, {**MODE_ENV["free"], "UPSTREAM_HEDGE": "0"})
+    prepare_db(workdir, env)
+    proc, base = start_app(workdir, env)
+    try:
+        for path, stream in (("/enhance", False), ("/enhance_stream", True)):
+            body = {"prompt": f"Write a caption about lunchboxes ({uuid.uuid4().hex})"}
+            ep = Endpoint(path.strip("/"), "POST", path, lambda: body, stream=stream)
+            before = stub_calls(stub_urls)
+            counts = asyncio.run(identical_burst(base, ep, args.coalesce_attempts))
+            calls = stub_calls(stub_urls) - before
+            ok = counts.get(200, 0)
+            exact = calls == 1 and ok == args.coalesce_attempts
+            results.append({"scenario": "coalesce", "endpoint": ep.name, "attempts": args.coalesce_attempts,
+                            "ok": ok, "upstream_calls": calls, "status_counts": {str(k): v for k, v in counts.items()},
+                            "exact": exact})
+            print(f"  coalesce {ep.name:15} {ok}/{args.coalesce_attempts} ok, {calls} upstream call(s), exact={exact}",
+                  file=sys.stderr)
+    finally:
+        stop(proc)
+    return results
+
+
+def git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Benchmark the Prompt Wizard app against a local stub LLM.")
+    ap.add_argument("--out", default="bench-results.json")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma list of: {', '.join(SCENARIOS)}")
+    ap.add_argument("--endpoints", default="", help="comma list to restrict endpoints (e.g. enhance,build)")
+    ap.add_argument("--concurrency", default="1,16,64", help="comma list of concurrency levels")
+    ap.add_argument("--duration", type=float, default=5.0, help="seconds per endpoint and concurrency level")
+    ap.add_argument("--ips", type=int, default=10_000, help="distinct client IPs in many-IP scenarios")
+    ap.add_argument("--cache", action="store_true", help="leave the response cache on")
+    ap.add_argument("--history-rows", type=int, default=100_000, help="rows seeded for the history scenario")
+    ap.add_argument("--quota-limit", type=int, default=50, help="cap/balance for the contention check")
+    ap.add_argument("--quota-attempts", type=int, default=400, help="concurrent calls in the contention check")
+    ap.add_argument("--quota-backends", default=",".join(QUOTA_BACKENDS),
+                    help=f"comma list of: {', '.join(QUOTA_BACKENDS)}")
+    ap.add_argument("--quota-workers", type=int, default=2, help="processes for the `workers` backend")
+    ap.add_argument("--coalesce-attempts", type=int, default=10, help="identical concurrent calls in the coalesce check")
+    ap.add_argument("--stub-latency-ms", type=float, default=300)
+    ap.add_argument("--stub-jitter-ms", type=float, default=100)
+    ap.add_argument("--stub-error-rate", type=float, default=0.0)
+    ap.add_argument("--stub-tokens", type=int, default=40)
+    ap.add_argument("--stub-token-delay-ms", type=float, default=10)
+    ap.add_argument("--stubs", type=int, default=1, help="stub backends (>1 exercises UPSTREAMS routing/hedging)")
+    ap.add_argument("--brownout-latency-ms", type=float, default=None, help="degrade the first stub to this latency")
+    ap.add_argument("--brownout-error-rate", type=float, default=0.0, help="error rate of the degraded stub")
+    args = ap.parse_args(argv)
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        ap.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.quota_backends = [b for b in args.quota_backends.split(",") if b]
+    unknown = set(args.quota_backends) - set(QUOTA_BACKENDS)
+    if unknown:
+        ap.error(f"unknown quota backends: {', '.join(sorted(unknown))}")
+    args.endpoints = [e for e in args.endpoints.split(",") if e]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    stubs, stub_urls = start_stubs(args)
+    results: List[Dict[str, Any]] = []
+    try:
+        for name in args.scenarios:
+            print(f"scenario {name}", file=sys.stderr)
+            results += run_scenario(name, args, stub_urls)
+    finally:
+        for proc in stubs:
+            stop(proc)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_rev": git_rev(), "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items()},
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.out}", file=sys.stderr)
+    checks = [r for r in results if r["scenario"] in ("quota_contention", "quota_flush_race", "coalesce")]
+    return 0 if all(r["exact"] for r in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
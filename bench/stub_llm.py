@@ -0,0 +1,88 @@
+"""
+Local OpenAI-compatible stub for benchmarks — `POST /v1/chat/completions`
+(plain or `stream: true` SSE) with configurable latency, jitter and error rate.
+
+    python bench/stub_llm.py --port 9100 --latency-ms 300 --jitter-ms 100 --error-rate 0.01
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:9100/v1.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def make_app(latency_ms: float, jitter_ms: float, error_rate: float, error_status: int,
+             tokens: int, token_delay_ms: float) -> FastAPI:
+    app = FastAPI(title="stub-llm")
+    stats = {"requests": 0, "errors": 0, "streams": 0}
+
+    def delay() -> float:
+        return max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000
+
+    def reply(prompt: str) -> list:
+        words = f"Improved prompt: {prompt}".split() or ["ok"]
+        return [(words[i % len(words)] + " ") for i in range(max(tokens, 1))]
+
+    @app.post("/chat/completions")
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        prompt = (body.get("messages") or [{}])[-1].get("content", "")
+        await asyncio.sleep(delay())
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": "stub: injected failure"}}, status_code=error_status)
+
+        pieces = reply(prompt)
+        if not body.get("stream"):
+            return {"id": "stub", "object": "chat.completion", "created": int(time.time()),
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "".join(pieces).strip()}}]}
+
+        stats["streams"] += 1
+
+        async def events():
+            for piece in pieces:
+                chunk = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                if token_delay_ms > 0:
+                    await asyncio.sleep(token_delay_ms / 1000)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake OpenAI /chat/completions server for benchmarks.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--latency-ms", type=float, default=300, help="mean time before the response (or first token)")
+    ap.add_argument("--jitter-ms", type=float, default=100, help="uniform +/- jitter on the latency")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failed with --error-status")
+    ap.add_argument("--error-status", type=int, default=500)
+    ap.add_argument("--tokens", type=int, default=40, help="tokens per reply")
+    ap.add_argument("--token-delay-ms", type=float, default=10, help="gap between streamed tokens")
+    args = ap.parse_args()
+
+    import uvicorn
+    app = make_app(args.latency_ms, args.jitter_ms, args.error_rate, args.error_status,
+                   args.tokens, args.token_delay_ms)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
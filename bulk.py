@@ -0,0 +1,193 @@
+"""
+Offline bulk builder — `python -m prompt_wizard build --in X.jsonl --out Y.jsonl`.
+
+Streams JSONL /build payloads (one object per line) through the same
+BuildPayload validation and template registry as the web route, fanned out over
+a process pool in fixed-size chunks. Only a bounded number of chunks is in
+flight at once and results are written in input order, so memory stays flat
+whether the input is one line or ten million. With --enhance, each built prompt
+is also sent upstream with bounded asyncio concurrency.
+
+Output lines: {"line": n, "ok": true, "prompt": ..., "concise": ...[, "enhanced": ...]}
+or {"line": n, "ok": false, "error": ...}.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from prompt_templates import BuildPayload, TemplateRegistry
+
+_registry: Optional[TemplateRegistry] = None
+
+
+def _init_worker(goals_file: str):
+    global _registry
+    _registry = TemplateRegistry.from_file(goals_file)
+
+
+def render_chunk(chunk: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+    """Validate + render one chunk of (line_no, raw_line)."""
+    out = []
+    for line_no, raw in chunk:
+        try:
+            payload = BuildPayload.model_validate_json(raw)
+        except ValidationError as e:
+            err = e.errors(include_url=False)[0]
+            loc = ".".join(str(x) for x in err["loc"])
+            out.append({"line": line_no, "ok": False, "error": f"{loc}: {err['msg']}" if loc else err["msg"]})
+            continue
+        detailed, concise = _registry.render(payload.model_dump())
+        out.append({"line": line_no, "ok": True, "prompt": detailed, "concise": concise})
+    return out
+
+
+def render_chunk_jsonl(chunk: List[Tuple[int, str]]) -> Tuple[str, int, int]:
+    """Worker entry point: the chunk already serialized as JSONL, plus (records, errors).
+    Shipping one string back is far cheaper than pickling a list of dicts."""
+    recs = render_chunk(chunk)
+    text = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in recs)
+    return text, len(recs), sum(1 for r in recs if not r["ok"])
+
+
+def read_lines(f) -> Iterator[Tuple[int, str]]:
+    for line_no, raw in enumerate(f, 1):
+        if raw.strip():
+            yield line_no, raw
+
+
+def chunked(it: Iterable, size: int) -> Iterator[list]:
+    it = iter(it)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def map_chunks(fn: Callable, lines: Iterable[Tuple[int, str]], goals_file: str, workers: int,
+               chunk_size: int) -> Iterator[Any]:
+    """Ordered stream of fn(chunk) results. workers<=1 runs inline (no pool start-up)."""
+    if workers <= 1:
+        _init_worker(goals_file)
+        for chunk in chunked(lines, chunk_size):
+            yield fn(chunk)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(goals_file,)) as pool:
+        pending = deque()
+        for chunk in chunked(lines, chunk_size):
+            pending.append(pool.submit(fn, chunk))
+            if len(pending) >= workers * 2:   # backpressure: stop reading until the head is done
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+async def enhance_records(records: Iterator[Dict[str, Any]], enhance: Callable, concurrency: int,
+                          field: str, write: Callable[[Dict[str, Any]], None]):
+    """Enhance ok records with at most `concurrency` upstream calls, writing in order.
+    Pulling from `records` blocks on worker processes, so it happens off the loop."""
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(concurrency)
+    pending = deque()
+
+    async def one(rec):
+        if rec.get("ok"):
+            async with sem:
+                try:
+                    rec["enhanced"] = await enhance(rec[field])
+                except Exception as e:
+                    rec["enhance_error"] = str(e)
+        return rec
+
+    while True:
+        batch = await loop.run_in_executor(None, lambda: list(islice(records, 256)))
+        if not batch:
+            break
+        for rec in batch:
+            pending.append(asyncio.ensure_future(one(rec)))
+            while len(pending) >= concurrency * 4 or (pending and pending[0].done()):
+                write(await pending.popleft())
+    while pending:
+        write(await pending.popleft())
+
+
+class Progress:
+    def __init__(self, every: float):
+        self.every = every
+        self.start = self.last = time.perf_counter()
+        self.records = self.errors = 0
+
+    def add(self, records: int, errors: int):
+        self.records += records
+        self.errors += errors
+        now = time.perf_counter()
+        if self.every > 0 and now - self.last >= self.every:
+            self.last = now
+            self.report()
+
+    def report(self, final: bool = False):
+        elapsed = time.perf_counter() - self.start
+        rate = self.records / elapsed if elapsed > 0 else 0.0
+        print(f"{'done' if final else 'progress'}: {self.records} records, {self.errors} errors, "
+              f"{elapsed:.1f}s, {rate:,.0f} rec/s", file=sys.stderr)
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(prog="python -m prompt_wizard build",
+                                 description="Build prompts for a JSONL file of /build payloads.")
+    ap.add_argument("--in", dest="inp", required=True, help="input JSONL ('-' for stdin)")
+    ap.add_argument("--out", required=True, help="output JSONL ('-' for stdout)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="render processes (1 = inline)")
+    ap.add_argument("--chunk-size", type=int, default=1000, help="records per worker task")
+    ap.add_argument("--enhance", action="store_true", help="also run each prompt through /enhance upstream")
+    ap.add_argument("--enhance-field", choices=["prompt", "concise"], default="concise")
+    ap.add_argument("--concurrency", type=int, default=8, help="max in-flight upstream calls with --enhance")
+    ap.add_argument("--progress", type=float, default=5.0, help="seconds between progress lines (0 = off)")
+    return ap.parse_args(argv)
+
+
+def main(argv: List[str], goals_file: str, enhancer: Optional[Callable] = None) -> int:
+    """`enhancer` is an async context manager yielding `async fn(prompt) -> str`;
+    the app passes one bound to its upstream client and response cache."""
+    args = parse_args(argv)
+    if args.enhance and enhancer is None:
+        print("error: --enhance needs GPT enabled (ENABLE_GPT=1 and OPENAI_API_KEY).", file=sys.stderr)
+        return 2
+
+    fin = sys.stdin if args.inp == "-" else open(args.inp, encoding="utf-8")
+    fout = sys.stdout if args.out == "-" else open(args.out, "w", encoding="utf-8")
+    progress = Progress(args.progress)
+
+    def write(rec: Dict[str, Any]):
+        fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        progress.add(1, int(not rec.get("ok") or "enhance_error" in rec))
+
+    try:
+        lines, chunk_size = read_lines(fin), max(args.chunk_size, 1)
+        if args.enhance:
+            chunks = map_chunks(render_chunk, lines, goals_file, args.workers, chunk_size)
+            records = (rec for chunk in chunks for rec in chunk)
+            async def run():
+                async with enhancer() as enhance:
+                    await enhance_records(records, enhance, max(args.concurrency, 1), args.enhance_field, write)
+            asyncio.run(run())
+        else:
+            for text, n, errors in map_chunks(render_chunk_jsonl, lines, goals_file, args.workers, chunk_size):
+                fout.write(text)
+                progress.add(n, errors)
+    finally:
+        if fin is not sys.stdin: fin.close()
+        if fout is not sys.stdout: fout.close()
+    progress.report(final=True)
+    return 0
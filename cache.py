@@ -0,0 +1,228 @@
+"""
+Response cache for /enhance — in-memory LRU (with TTL) in front of an SQLite table,
+plus single-flight coalescing of identical in-flight upstream calls (plain or streamed).
+
+Keys are content hashes of everything that determines the upstream answer, so an
+entry never needs invalidation; it only ages out (TTL) or is evicted (size bound).
+"""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, AsyncIterator, Awaitable, Callable, List
+
+CACHE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS enhance_cache (
+  key TEXT PRIMARY KEY,
+  response TEXT NOT NULL,
+  created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_enhance_cache_created ON enhance_cache(created_at);
+"""
+
+
+def cache_key(prompt: str, model: str, system: str, temperature: float, max_tokens: int) -> str:
+    raw = json.dumps([prompt, model, system, temperature, max_tokens], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache: a bounded LRU dict, backed by the `enhance_cache` table.
+
+    Memory hits are served without touching disk; disk hits are promoted into
+    memory. Both tiers drop entries older than `ttl` seconds. The table is
+    trimmed to `max_rows` (oldest first) every `prune_every` writes. Disk work
+    goes through the `db.Database` pool, off the event loop.
+    """
+
+    def __init__(self, db, max_items: int = 1000, max_rows: int = 50000,
+                 ttl: float = 86400, prune_every: int = 100):
+        self.db = db
+        self.max_items = max_items
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.prune_every = max(prune_every, 1)
+        self._mem: "OrderedDict[str, tuple]" = OrderedDict()
+        self._writes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def _fresh(self, created_at: float) -> bool:
+        return self.ttl <= 0 or (time.time() - created_at) < self.ttl
+
+    def _remember(self, key: str, value: str, created_at: float):
+        self._mem[key] = (value, created_at)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+            self.evictions += 1
+
+    def _disk_get(self, conn: sqlite3.Connection, key: str):
+        row = conn.execute("SELECT response, created_at FROM enhance_cache WHERE key=?", (key,)).fetchone()
+        if row and not self._fresh(row[1]):
+            conn.execute("DELETE FROM enhance_cache WHERE key=?", (key,))
+            row = None
+        return row
+
+    def _disk_put(self, conn: sqlite3.Connection, key: str, value: str, now: float, prune: bool):
+        conn.execute("INSERT OR REPLACE INTO enhance_cache (key, response, created_at) VALUES (?, ?, ?)",
+                     (key, value, now))
+        if prune:
+            self._prune(conn, now)
+
+    async def get(self, key: str) -> Optional[str]:
+        hit = self._mem.get(key)
+        if hit is not None:
+            if self._fresh(hit[1]):
+                self._mem.move_to_end(key)
+                self.hits_memory += 1
+                return hit[0]
+            del self._mem[key]
+
+        row = await self.db.run(self._disk_get, key)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits_disk += 1
+        self._remember(key, row[0], row[1])
+        return row[0]
+
+    async def put(self, key: str, value: str):
+        now = time.time()
+        self._remember(key, value, now)
+        self._writes += 1
+        await self.db.run(self._disk_put, key, value, now, self._writes % self.prune_every == 0)
+
+    def _prune(self, conn: sqlite3.Connection, now: float):
+        if self.ttl > 0:
+            conn.execute("DELETE FROM enhance_cache WHERE created_at < ?", (now - self.ttl,))
+        (rows,) = conn.execute("SELECT COUNT(*) FROM enhance_cache").fetchone()
+        if rows > self.max_rows:
+            conn.execute("DELETE FROM enhance_cache WHERE key IN "
+                         "(SELECT key FROM enhance_cache ORDER BY created_at ASC LIMIT ?)",
+                         (rows - self.max_rows,))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "items": len(self._mem),
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits_memory + self.hits_disk) / lookups, 4) if lookups else 0.0,
+        }
+
+
+class _Call:
+    """One shared call: its task, how many callers are attached and, for a
+    streaming call, the chunks it has produced so far."""
+    __slots__ = ("task", "waiters", "chunks", "_wake")
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self.chunks: List[Any] = []
+        self._wake = asyncio.get_running_loop().create_future()
+
+    def emit(self, chunk: Any):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def _notify(self, *_):
+        wake, self._wake = self._wake, asyncio.get_running_loop().create_future()
+        wake.set_result(None)   # only ever awaited through asyncio.wait, so never cancelled
+
+    async def follow(self) -> AsyncIterator[Any]:
+        """Every chunk from the first (a late joiner catches up), until the call ends."""
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.task.done():
+                return
+            await asyncio.wait((self._wake,))
+
+    async def result(self) -> Any:
+        return await asyncio.shield(self.task)
+
+
+class SingleFlight:
+    """Run at most one `fn()` per key at a time; concurrent callers await the same task.
+
+    The shared call runs as its own task, so a cancelled waiter (e.g. the client
+    that started it disconnecting) only stops waiting. The task itself is cancelled
+    once its last waiter is gone. Results and exceptions reach every waiter.
+
+    `stream()` shares calls that produce output as they go; streaming and plain
+    callers of the same key join each other's calls.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._join(key, lambda _emit: fn())
+        try:
+            return await call.result()
+        finally:
+            self._leave(key, call)
+
+    @asynccontextmanager
+    async def stream(self, key: str, fn: Callable[[Callable[[Any], None]], Awaitable[Any]]) -> AsyncIterator[_Call]:
+        """`fn(emit)` hands each chunk to `emit` and returns the final result.
+        Yields the shared call: iterate `call.follow()`, then `await call.result()`.
+        A call started by do() produces no chunks, only its result."""
+        call = self._join(key, fn)
+        try:
+            yield call
+        finally:
+            self._leave(key, call)
+
+    def _join(self, key: str, fn: Callable[[Callable[[Any], None]], Awaitable[Any]]) -> _Call:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call()
+            call.task = asyncio.ensure_future(fn(call.emit))
+            call.task.add_done_callback(lambda _t, k=key, c=call: self._forget(k, c))
+            call.task.add_done_callback(call._notify)
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        return call
+
+    def _leave(self, key: str, call: _Call):
+        call.waiters -= 1
+        if call.waiters == 0 and not call.task.done():
+            # Nobody is left to receive the answer: stop the upstream call and
+            # make sure later callers start a fresh one.
+            self._forget(key, call)
+            call.task.cancel()
+            self.abandoned += 1
+
+    def _forget(self, key: str, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+            "coalesce_ratio": round(self.coalesced / total, 4) if total else 0.0,
+        }
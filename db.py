@@ -0,0 +1,270 @@
+"""
+SQLite access — a fixed pool of long-lived WAL connections driven by a dedicated
+thread pool, so route handlers can `await` queries without blocking the event loop —
+plus a group-commit batch writer and a small `PRAGMA user_version` migration runner.
+"""
+
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+
+
+class Database:
+    """Each of the `size` worker threads owns one connection for its whole life.
+
+    `await db.run(fn, *args)` calls `fn(conn, *args)` on a worker and commits
+    (or rolls back on error) before returning. Connections use WAL so readers
+    never wait on the writer, `synchronous=NORMAL` (fsync at checkpoint, not on
+    every commit), a busy timeout instead of instant SQLITE_BUSY, and a large
+    prepared-statement cache since the app runs a small fixed set of queries.
+
+    `observer(name, seconds)`, if given, receives each call's time on the worker
+    (excluding queue wait), called back on the awaiting side.
+    """
+
+    def __init__(self, path: str, size: int = 4, busy_timeout_ms: int = 5000,
+                 synchronous: str = "NORMAL", cached_statements: int = 256,
+                 observer: Optional[Callable[[str, float], None]] = None):
+        self.path = path
+        self.observer = observer
+        self.size = max(size, 1)
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000,
+                               check_same_thread=False, cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _call(self, fn: Callable[..., Any], args: tuple) -> Any:
+        conn = self._conn()
+        start = time.perf_counter()
+        try:
+            result = fn(conn, *args)
+            if conn.in_transaction:
+                conn.commit()
+            return result
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._local.elapsed = time.perf_counter() - start
+
+    def _timed_call(self, fn: Callable[..., Any], args: tuple) -> Any:
+        try:
+            return self._call(fn, args), self._local.elapsed, None
+        except Exception as e:
+            return None, self._local.elapsed, e
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="db")
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        if self.observer is None:
+            return await loop.run_in_executor(self._pool(), self._call, fn, args)
+        result, elapsed, error = await loop.run_in_executor(self._pool(), self._timed_call, fn, args)
+        self.observer(fn.__name__.lstrip("_"), elapsed)
+        if error is not None:
+            raise error
+        return result
+
+    def run_sync(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Blocking variant for startup/CLI code that has no event loop."""
+        return self._pool().submit(self._call, fn, args).result()
+
+    def close(self):
+        """Stop the workers and close their connections (the pool restarts lazily if used again)."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+
+_STOP = object()
+
+
+class BatchWriter:
+    """Group commit: rows submitted by many requests are written together by
+    `fn(conn, items) -> results` (one result per item, in order) in a single
+    transaction.
+
+    A background task takes the first queued item, waits up to `max_delay`
+    seconds for more (skipped once `max_batch` are already waiting), then writes
+    up to `max_batch` at once. While a batch is being written new items keep
+    queueing, so under load batches grow by themselves. `submit()` resolves with
+    the item's result after its batch commits, or with None right away when
+    `wait=False` (fire-and-forget; failures then only reach `on_error`). The queue
+    holds at most `max_pending` items; beyond that `submit()` waits for room.
+    `aclose()` writes everything already queued before returning.
+    """
+
+    def __init__(self, db: Database, fn: Callable[[sqlite3.Connection, List[Any]], Sequence[Any]],
+                 max_batch: int = 100, max_delay: float = 0.002, max_pending: int = 10000,
+                 on_error: Optional[Callable[[Exception, int], None]] = None):
+        self.db = db
+        self.fn = fn
+        self.max_batch = max(max_batch, 1)
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.on_error = on_error   # (exception, rows lost) for failed batches
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.batches = 0
+        self.items = 0
+        self.failed = 0
+        self.largest = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(self.max_pending)
+        self._closing = False
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def submit(self, item: Any, wait: bool = True) -> Any:
+        if self._task is None or self._closing:
+            raise RuntimeError("batch writer is not running")
+        fut = asyncio.get_running_loop().create_future() if wait else None
+        await self._queue.put((item, fut))
+        return None if fut is None else await fut
+
+    async def aclose(self):
+        """Flush the queue and stop the writer task."""
+        if self._task is None:
+            return
+        self._closing = True
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _loop(self):
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            batch = [] if first is _STOP else [first]
+            stopping = first is _STOP
+            if not stopping and self.max_delay > 0 and self._queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.max_delay)
+            while not stopping and len(batch) < self.max_batch and not self._queue.empty():
+                entry = self._queue.get_nowait()
+                if entry is _STOP:
+                    stopping = True
+                else:
+                    batch.append(entry)
+            if batch:
+                await self._write(batch)
+
+    async def _write(self, batch: list):
+        try:
+            results = await self.db.run(self.fn, [item for item, _ in batch])
+        except Exception as e:
+            self.failed += len(batch)
+            if self.on_error is not None:
+                self.on_error(e, sum(1 for _, fut in batch if fut is None))
+            for _, fut in batch:
+                if fut is not None and not fut.done():
+                    fut.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(batch)
+        self.largest = max(self.largest, len(batch))
+        for (_, fut), result in zip(batch, results):
+            if fut is not None and not fut.done():   # the waiter may have gone away
+                fut.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pending": self.pending(), "batches": self.batches, "rows": self.items,
+                "failed_rows": self.failed, "largest_batch": self.largest}
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    step: Union[str, Callable[[sqlite3.Connection], None]]   # SQL script or fn(conn)
+    transactional: bool = True   # False for steps like VACUUM that can't run in a transaction
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection, migrations: Sequence[Migration]) -> int:
+    """Apply every migration newer than `PRAGMA user_version`, in order; returns the final version.
+
+    Transactional steps run under BEGIN IMMEDIATE and re-check the version once
+    they hold the write lock, so several processes starting at once apply each
+    step exactly once.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    for m in sorted(migrations, key=lambda m: m.version):
+        if schema_version(conn) >= m.version:
+            continue
+        if not m.transactional:
+            if callable(m.step):
+                m.step(conn)
+            else:
+                conn.executescript(m.step)
+            conn.execute(f"PRAGMA user_version={int(m.version)}")
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) < m.version:
+                if callable(m.step):
+                    m.step(conn)
+                else:
+                    # executescript() would COMMIT first; run statements one by one instead.
+                    for stmt in _split_sql(m.step):
+                        conn.execute(stmt)
+                conn.execute(f"PRAGMA user_version={int(m.version)}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return schema_version(conn)
+
+
+def _split_sql(script: str) -> List[str]:
+    stmts, buf = [], ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            if buf.strip():
+                stmts.append(buf.strip())
+            buf = ""
+    if buf.strip():
+        stmts.append(buf.strip())
+    return stmts
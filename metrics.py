@@ -0,0 +1,211 @@
+"""
+Minimal Prometheus text-format metrics — counters, gauges, histograms and an
+ASGI middleware for per-route request counts, latency and in-flight requests.
+
+Everything is updated from the event-loop thread only (DB timings are measured
+on the worker thread but recorded after the await), so the hot path is a dict
+lookup and a few integer adds with no locks.
+
+With several worker processes each keeps its own registry; `snapshot()` turns
+one into plain JSON-able families and `merge()` combines many: counters and
+histograms are summed, gauges keep one series per worker.
+"""
+
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+Family = Dict[str, Any]   # {"name", "help", "kind", "samples": [[sample_name, {labels}, value], ...]}
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(v: float) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def family(self) -> Family:
+        return {"name": self.name, "help": self.help, "kind": self.kind, "samples": list(self.samples())}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, labels: LabelValues = (), n: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def samples(self) -> Iterable[list]:
+        for k, v in self.values.items():
+            yield [self.name, dict(zip(self.labels, k)), v]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: LabelValues = (), n: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - n
+
+    def set(self, value: float, labels: LabelValues = ()):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[LabelValues, list] = {}   # labels -> [per-bucket counts (+Inf last), sum, count]
+
+    def observe(self, value: float, labels: LabelValues = ()):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        s[0][bisect_left(self.buckets, value)] += 1
+        s[1] += value
+        s[2] += 1
+
+    def samples(self) -> Iterable[list]:
+        for k, (counts, total, n) in self.series.items():
+            labels = dict(zip(self.labels, k))
+            acc = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                yield [f"{self.name}_bucket", {**labels, "le": "+Inf" if bound == float("inf") else repr(bound)}, acc]
+            yield [f"{self.name}_sum", labels, total]
+            yield [f"{self.name}_count", labels, n]
+
+
+class Registry:
+    """Holds metrics plus scrape-time collectors (callables returning
+    (name, help, kind, [(labels_dict, value), ...]) for state owned elsewhere,
+    e.g. cache counters or pool sizes)."""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], Iterable[tuple]]] = []
+
+    def add(self, metric: Metric) -> Any:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def collector(self, fn: Callable[[], Iterable[tuple]]):
+        self.collectors.append(fn)
+        return fn
+
+    def snapshot(self) -> List[Family]:
+        families = [m.family() for m in self.metrics]
+        for fn in self.collectors:
+            for name, help, kind, samples in fn():
+                families.append({"name": name, "help": help, "kind": kind,
+                                 "samples": [[name, dict(labels), value] for labels, value in samples]})
+        return families
+
+    def render(self) -> str:
+        return render(self.snapshot())
+
+
+def render(families: Iterable[Family]) -> str:
+    lines: List[str] = []
+    for f in families:
+        lines += [f"# HELP {f['name']} {f['help']}", f"# TYPE {f['name']} {f['kind']}"]
+        for name, labels, value in f["samples"]:
+            lines.append(f"{name}{_fmt_labels(list(labels), list(labels.values()))} {_num(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def merge(snapshots: Iterable[Tuple[str, List[Family]]], gauges: bool = True) -> List[Family]:
+    """Combine (worker, families) snapshots: counter/histogram samples with equal
+    labels are summed; gauge samples get a `worker` label (dropped if not `gauges`)."""
+    merged: Dict[str, Family] = {}
+    index: Dict[str, Dict[tuple, list]] = {}
+    for worker, families in snapshots:
+        for f in families:
+            if f["kind"] == "gauge" and not gauges:
+                continue
+            out = merged.setdefault(f["name"], {"name": f["name"], "help": f["help"], "kind": f["kind"], "samples": []})
+            seen = index.setdefault(f["name"], {})
+            for name, labels, value in f["samples"]:
+                if f["kind"] == "gauge":
+                    labels = {**labels, "worker": worker}
+                key = (name, tuple(sorted(labels.items())))
+                if key in seen:
+                    seen[key][2] += value
+                else:
+                    seen[key] = [name, labels, value]
+                    out["samples"].append(seen[key])
+    return list(merged.values())
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (no BaseHTTPMiddleware overhead, streaming-safe).
+    The route label is the matched path template, read from the scope after
+    routing, so cardinality stays bounded. `untimed_routes` (long-lived streams
+    that last as long as the client keeps them open) are counted but leave the
+    in-flight gauge once their headers go out, and aren't timed."""
+
+    def __init__(self, app, requests: Counter, latency: Histogram, in_flight: Gauge,
+                 untimed_routes: Tuple[str, ...] = ()):
+        self.app = app
+        self.requests = requests
+        self.latency = latency
+        self.in_flight = in_flight
+        self.untimed_routes = frozenset(untimed_routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+        untimed = [False]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if getattr(scope.get("route"), "path", None) in self.untimed_routes:
+                    untimed[0] = True
+                    self.in_flight.dec()
+            await send(message)
+
+        start = time.perf_counter()
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            if not untimed[0]:
+                self.in_flight.dec()
+                self.latency.observe(time.perf_counter() - start, (route,))
+            self.requests.inc((scope["method"], route, str(status[0])))
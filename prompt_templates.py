@@ -0,0 +1,112 @@
+"""
+Goal/format template registry for /build — compiled once from goals.json.
+
+A goal string ("Instagram caption", "Email subject lines", ...) is classified by
+the first entry whose keywords all appear in it; the entry supplies the strict
+OUTPUT FORMAT block and any default constraint lines for the concise prompt.
+New goals only need a new entry in the data file.
+"""
+
+import json
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from pydantic import BaseModel
+
+
+class BuildPayload(BaseModel):
+    audience: str
+    tone: str
+    goal: str
+    platform: Optional[str] = None
+    language: Optional[str] = "English"
+    constraints: Optional[str] = None
+    brand: Optional[str] = None
+    details: Optional[str] = None
+
+
+class GoalTemplate(NamedTuple):
+    name: str
+    output_fmt: str                       # full "OUTPUT FORMAT (STRICT):" block
+    default_constraints: Tuple[str, ...]  # concise lines used when no constraints given
+    enhance_tokens: int = 350             # base output allowance when /enhance rewrites this goal
+
+
+def _compile_goal(entry: Dict[str, Any]) -> GoalTemplate:
+    fmt = "\n".join(["OUTPUT FORMAT (STRICT):", *entry["output_format"]])
+    extra = tuple(f"- {line}" for line in entry.get("default_constraints", []))
+    return GoalTemplate(entry["name"], fmt, extra, entry.get("enhance_tokens", 350))
+
+
+class TemplateRegistry:
+    """Classifier + renderers. `classify()` is one precompiled regex (ordered
+    alternation of keyword lookaheads, so the first listed goal wins) behind an
+    LRU cache, since real traffic reuses a handful of goal strings."""
+
+    def __init__(self, goals: List[Dict[str, Any]], default: Dict[str, Any]):
+        self.templates = [_compile_goal(g) for g in goals]
+        self.default = _compile_goal(default)
+        alts = []
+        for i, g in enumerate(goals):
+            for keywords in g["match"]:
+                looks = "".join(f"(?=.*?{re.escape(k.lower())})" for k in keywords)
+                alts.append(f"(?P<g{i}_{len(alts)}>{looks})")
+        self._pattern = re.compile("^(?:" + "|".join(alts) + ")", re.S) if alts else None
+        self.classify = lru_cache(maxsize=1024)(self._classify)
+
+    @classmethod
+    def from_file(cls, path: str) -> "TemplateRegistry":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["goals"], data["default"])
+
+    def _classify(self, goal_lower: str) -> GoalTemplate:
+        m = self._pattern.match(goal_lower) if self._pattern else None
+        if not m:
+            return self.default
+        return self.templates[int(m.lastgroup[1:].split("_")[0])]
+
+    def render(self, p: Mapping[str, Any]) -> Tuple[str, str]:
+        """Return (detailed, concise) prompts for a BuildPayload-shaped mapping."""
+        lines = [
+            f"You are an expert. Create a {p.get('goal')}.",
+            f"Target audience: {p.get('audience')}.",
+            f"Tone: {p.get('tone')}.",
+            f"Language: {p.get('language')}.",
+        ]
+        if p.get("platform"):    lines.append(f"Platform: {p['platform']}.")
+        if p.get("brand"):       lines.append(f"Brand voice: {p['brand']}.")
+        if p.get("details"):     lines.append(f"Details: {p['details']}.")
+        if p.get("constraints"): lines.append(f"Constraints: {p['constraints']}.")
+        lines.append("Provide 3 variants when possible.")
+        detailed = "\n".join(lines)
+
+        goal = (p.get("goal") or "content").strip()
+        audience = (p.get("audience") or "").strip()
+        tone = (p.get("tone") or "").strip()
+        language = p.get("language") or "English"
+        platform = (p.get("platform") or "").strip()
+        brand = (p.get("brand") or "").strip()
+        details = (p.get("details") or "").strip()
+        constraints = (p.get("constraints") or "").strip()
+        tpl = self.classify(goal.lower())
+
+        concise_lines = [
+            f"TASK: Create 3 variants of {goal}.",
+            f"AUDIENCE: {audience}",
+            f"TONE/VOICE: {tone}" + (f" | Brand: {brand}" if brand else ""),
+            f"LANGUAGE: {language}",
+        ]
+        if platform: concise_lines.append(f"PLATFORM: {platform}")
+        if details:  concise_lines.append(f"PRODUCT/DETAILS: {details}")
+        concise_lines.append("CONSTRAINTS:")
+        if constraints:
+            concise_lines.append(f"- {constraints}")
+        else:
+            concise_lines.append("- Keep it concise and scroll-stopping.")
+            concise_lines.extend(tpl.default_constraints)
+
+        concise_lines += ["", tpl.output_fmt, "", "QUALITY CHECK:", "- If any variant violates constraints, rewrite it before returning."]
+        concise = "\n".join(concise_lines)
+        return detailed, concise
@@ -2,20 +2,47 @@
 Prompt Wizard — FREE/PAID with daily reset + cache-busted static + robust buttons
 """
 
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import logging
 import os
+import random
+import re
+import signal
 import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, List, NamedTuple
 
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 
 from dotenv import load_dotenv
 import httpx
 
+from db import BatchWriter, Database, Migration, migrate
+from cache import CACHE_TABLE_SQL, ResponseCache, SingleFlight, cache_key
+from quota import QuotaStore
+from similarity import SimilarityIndex, signature_from_bytes
+from status import StatusBoard
+from tokens import OverBudget, TokenCounter, output_budget, preflight
+from prompt_templates import BuildPayload, GoalTemplate, TemplateRegistry
+from assets import AssetManifest, write_if_changed
+from metrics import MetricsMiddleware, Registry, merge, render
+from logs import setup_logging
+from tracing import ServerTimingMiddleware, record, sample_stacks, span
+from upstream import RETRYABLE_STATUS, AdaptiveLimiter, Overloaded, RetryPolicy
+from routing import Backend, CircuitBreaker, Router, load_backends
+
 # Timezone (tzdata fallback)
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
@@ -29,18 +56,125 @@ OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 OPENAI_ORG = os.getenv("OPENAI_ORG")
 
+# Shared upstream client (one pool for the whole app)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "0") == "1"               # needs `h2` installed
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+
+# Several backends: JSON list of {"name", "base_url", "model", "api_key", "weight", "org"};
+# omitted fields default to the OPENAI_* values. Unset = the single OPENAI_* backend.
+UPSTREAMS = os.getenv("UPSTREAMS", "")
+UPSTREAM_HEDGE = os.getenv("UPSTREAM_HEDGE", "1") == "1"                  # duplicate calls slower than the backend's p95
+UPSTREAM_HEDGE_MIN_DELAY = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "0.25"))
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))  # consecutive failures to open
+UPSTREAM_BREAKER_RESET = float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))      # seconds before a probe
+
+# Upstream governor: adaptive concurrency limit + wait queue + retries
+UPSTREAM_LIMIT_MIN = int(os.getenv("UPSTREAM_LIMIT_MIN", "2"))
+UPSTREAM_LIMIT_MAX = int(os.getenv("UPSTREAM_LIMIT_MAX", "64"))
+UPSTREAM_LIMIT_INITIAL = int(os.getenv("UPSTREAM_LIMIT_INITIAL", "16"))
+UPSTREAM_TARGET_LATENCY = float(os.getenv("UPSTREAM_TARGET_LATENCY", "15"))  # slower calls shrink the limit
+UPSTREAM_QUEUE_MAX = int(os.getenv("UPSTREAM_QUEUE_MAX", "256"))          # waiters beyond this get 503
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "10"))  # max wait for a slot
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))                # on 429/5xx/connection errors
+UPSTREAM_RETRY_BASE = float(os.getenv("UPSTREAM_RETRY_BASE", "0.5"))
+UPSTREAM_RETRY_CAP = float(os.getenv("UPSTREAM_RETRY_CAP", "8"))
+UPSTREAM_RETRY_BUDGET = float(os.getenv("UPSTREAM_RETRY_BUDGET", "20"))   # seconds across all attempts
+
+# /enhance response cache (memory LRU + SQLite)
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "1000"))       # memory tier
+CACHE_MAX_ROWS = int(os.getenv("CACHE_MAX_ROWS", "50000"))        # SQLite tier
+CACHE_TTL = float(os.getenv("CACHE_TTL", "86400"))                # seconds, 0=never expire
+CACHE_HITS_FREE = os.getenv("CACHE_HITS_FREE", "1") == "1"        # 1=hits skip quota/credits
+# Near-duplicate suggestions (needs the cache): alongside a fresh answer, the caller
+# is offered their own past answer for a prompt at least this similar (estimated
+# Jaccard of word 3-grams) made with the same output budget.
+SIMILARITY_ENABLED = os.getenv("SIMILARITY_ENABLED", "1") == "1"
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.8"))
+SIMILARITY_MAX_ITEMS = int(os.getenv("SIMILARITY_MAX_ITEMS", "100000"))  # ~0.6 KB each in memory
+
+# /enhance token pre-flight (tokens.py; exact counts with `tiktoken` installed, else an estimate)
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+ENHANCE_COMPACT = os.getenv("ENHANCE_COMPACT", "1") == "1"          # collapse whitespace, drop repeated lines
+ENHANCE_INPUT_BUDGET = int(os.getenv("ENHANCE_INPUT_BUDGET", "2000"))  # input tokens after compaction, 0=unlimited
+ENHANCE_OVER_BUDGET = os.getenv("ENHANCE_OVER_BUDGET", "truncate")  # truncate | reject (413)
+# Output allowance: the goal's "enhance_tokens" (goals.json) + ratio x input tokens, within [min, max]
+ENHANCE_MAX_TOKENS = int(os.getenv("ENHANCE_MAX_TOKENS", "600"))
+ENHANCE_MIN_TOKENS = int(os.getenv("ENHANCE_MIN_TOKENS", "128"))
+ENHANCE_OUTPUT_RATIO = float(os.getenv("ENHANCE_OUTPUT_RATIO", "1.0"))
+# PAID: credits per call = ceil((input + output tokens) / N); input + max output is reserved
+# up front and the unused part refunded. 0 = a flat credit per call.
+ENHANCE_TOKENS_PER_CREDIT = int(os.getenv("ENHANCE_TOKENS_PER_CREDIT", "0"))
+
 ROLLOVER_MODE = os.getenv("ROLLOVER_MODE", "0") == "1"          # 0=FREE, 1=PAID
 DAILY_FREE_LIMIT = int(os.getenv("DAILY_FREE_LIMIT", "10"))      # FREE only
 
 INITIAL_CREDITS = int(os.getenv("INITIAL_CREDITS", "0"))
 DAILY_GRANT = int(os.getenv("DAILY_GRANT", "0"))
 MAX_BALANCE = int(os.getenv("MAX_BALANCE", "100"))
+QUOTA_MODE = "paid_credits" if ROLLOVER_MODE else "free_daily_cap"
+
+# /status: per-IP cache, refreshed on every charge/refund and at the daily reset
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "30"))        # seconds; also the cross-worker lag
+STATUS_CACHE_MAX_ITEMS = int(os.getenv("STATUS_CACHE_MAX_ITEMS", "10000"))
+STATUS_KEEPALIVE = float(os.getenv("STATUS_KEEPALIVE", "25"))        # SSE heartbeat, seconds
+
+# Hot quota state (opt-in): counters and wallets of active IPs in memory, written back
+# in batches. Only for ONE process per database: it then holds the "quota" lease and
+# refuses to start while another process has it. QUOTA_FLUSH_INTERVAL > 0 turns it on
+# and is the crash-loss window: a hard kill forgets at most that many seconds of
+# charges/refunds (clean shutdowns flush everything). 0 = every charge is a SQLite
+# write, exact across any number of processes. Ignored with WORKERS > 1.
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", "0"))
+QUOTA_MAX_ITEMS = int(os.getenv("QUOTA_MAX_ITEMS", "100000"))        # per table; idle IPs evicted LRU
+QUOTA_LEASE_TTL = float(os.getenv("QUOTA_LEASE_TTL", "15"))          # seconds; how long a crashed owner blocks a restart
 
 SHOW_USAGE = os.getenv("SHOW_USAGE", "1") == "1"
 SHOW_TIMER = os.getenv("SHOW_TIMER", "1") == "1"
 APP_TZ_STR = os.getenv("APP_TZ", "Asia/Manila")
 
 DB_FILE = os.getenv("DB_FILE", "prompts.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))                 # connections == DB worker threads
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")            # NORMAL is safe with WAL
+
+# Retention (0 = keep forever)
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))  # seconds between runs, 0=off
+USAGE_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "35"))  # older per-IP rows roll into daily totals
+HISTORY_MAX_ROWS = int(os.getenv("HISTORY_MAX_ROWS", "0"))
+HISTORY_MAX_DAYS = int(os.getenv("HISTORY_MAX_DAYS", "0"))
+HISTORY_ARCHIVE = os.getenv("HISTORY_ARCHIVE", "0") == "1"         # move pruned rows to history_archive
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "1000"))              # pages freed per run (incremental)
+
+# /save group commit
+HISTORY_BATCH_MAX = int(os.getenv("HISTORY_BATCH_MAX", "100"))      # rows per transaction
+HISTORY_BATCH_DELAY_MS = float(os.getenv("HISTORY_BATCH_DELAY_MS", "2"))  # wait for more rows before writing
+HISTORY_SAVE_ACK = os.getenv("HISTORY_SAVE_ACK", "commit")          # commit | queued (fire-and-forget)
+
+# /build templates
+GOALS_FILE = os.getenv("GOALS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "goals.json"))
+BUILD_BATCH_MAX = int(os.getenv("BUILD_BATCH_MAX", "10000"))
+
+# Observability
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                        # json | text
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") == "1"             # Server-Timing header on every response
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")                          # empty = /admin/* disabled
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# Multi-worker (`python -m prompt_wizard serve --workers N`; see DEPLOYMENT.md)
+WORKERS = int(os.getenv("WORKERS", "1"))                            # set by the launcher for its workers
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))  # seconds between metric snapshots
+SHARED_STATE = WORKERS > 1                                          # leases + merged /metrics via SQLite
+WORKER_ID = str(os.getpid())
+
+setup_logging(LOG_LEVEL, LOG_FORMAT)
+log = logging.getLogger("prompt_wizard")
 
 ROOT = os.getcwd()
 DB_PATH = os.path.join(ROOT, DB_FILE)
@@ -53,7 +187,7 @@ os.makedirs(STATIC_DIR, exist_ok=True)
 try:
     TZ = ZoneInfo(APP_TZ_STR)
 except (ZoneInfoNotFoundError, Exception):
-    print(f"WARN: tzdata not found for {APP_TZ_STR}; falling back to UTC+8.")
+    log.warning("tzdata not found for %s; falling back to UTC+8.", APP_TZ_STR)
     TZ = timezone(timedelta(hours=8))  # Manila: UTC+8, no DST
 
 def now_tz() -> datetime:
@@ -62,10 +196,12 @@ def now_tz() -> datetime:
 def today_str() -> str:
     return now_tz().strftime("%Y-%m-%d")
 
-def next_midnight_tz_iso() -> str:
+def next_midnight_tz() -> datetime:
     n = now_tz()
-    tmr = (n + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    return tmr.isoformat()
+    return (n + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def next_midnight_tz_iso() -> str:
+    return next_midnight_tz().isoformat()
 
 # ---------------- HTML/CSS (unchanged style) ----------------
 styles_css = """*{box-sizing:border-box}
@@ -99,7 +235,7 @@ base_html = """<!doctype html>
   <meta charset="utf-8" />
   <meta name="viewport" content="width=device-width, initial-scale=1" />
   <title>{{ app_name }}</title>
-  <link rel="stylesheet" href="/static/styles.css?v={{ build_id }}" />
+  <link rel="stylesheet" href="{{ asset_url('styles.css') }}" />
 </head>
 <body>
   <div class="wrap">
@@ -108,7 +244,7 @@ base_html = """<!doctype html>
     {% block content %}{% endblock %}
     <footer><p class="muted">© {{ year }} Prompt Wizard</p></footer>
   </div>
-  <script src="/static/app.js?v={{ build_id }}"></script>
+  <script src="{{ asset_url('app.js') }}"></script>
 </body>
 </html>
 """
@@ -226,20 +362,45 @@ index_html = """{% extends "base.html" %}
 
 <section class="panel">
   <h3>History</h3>
+  <input id="historySearch" type="search" placeholder="Search saved prompts…" />
   <div id="history"></div>
+  <button id="historyMore" class="ghost" type="button" style="display:none">Load more</button>
 </section>
 {% endblock %}
 """
 
-# Write assets
-with open(os.path.join(TEMPLATE_DIR, "base.html"), "w", encoding="utf-8") as f:
-    f.write(base_html)
-with open(os.path.join(TEMPLATE_DIR, "index.html"), "w", encoding="utf-8") as f:
-    f.write(index_html)
-with open(os.path.join(STATIC_DIR, "styles.css"), "w", encoding="utf-8") as f:
-    f.write(styles_css)
+# Write assets (only when changed, so mtimes and hashes stay stable across restarts)
+write_if_changed(os.path.join(TEMPLATE_DIR, "base.html"), base_html)
+write_if_changed(os.path.join(TEMPLATE_DIR, "index.html"), index_html)
+write_if_changed(os.path.join(STATIC_DIR, "styles.css"), styles_css)
 
 # static/app.js provided separately (already saved by you)
+# ---------------- Metrics ----------------
+metrics = Registry()
+HTTP_REQUESTS = metrics.counter("pw_http_requests_total", "HTTP requests by method, route and status.", ("method", "route", "status"))
+HTTP_LATENCY = metrics.histogram("pw_http_request_duration_seconds", "HTTP request latency by route.", ("route",))
+HTTP_IN_FLIGHT = metrics.gauge("pw_http_requests_in_flight", "HTTP requests currently being served.")
+UPSTREAM_REQUESTS = metrics.counter("pw_upstream_requests_total", "Upstream /chat/completions calls (hedges included) by backend, mode and status.", ("backend", "mode", "status"))
+UPSTREAM_LATENCY = metrics.histogram("pw_upstream_request_duration_seconds", "Upstream /chat/completions latency (streams: until closed).", ("backend", "mode"))
+DB_QUERY = metrics.histogram("pw_db_query_duration_seconds", "SQLite time per repository helper (worker side).", ("helper",),
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+UPSTREAM_RETRY_COUNT = metrics.counter("pw_upstream_retries_total", "Upstream attempts retried, by cause.", ("cause",))
+QUOTA_REJECTIONS = metrics.counter("pw_quota_rejections_total", "Enhance requests refused for quota (402 credits, 429 daily cap).", ("status",))
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+ENHANCE_TOKENS = metrics.histogram("pw_enhance_tokens", "Tokens per upstream enhance call (local count), by direction.", ("direction",),
+                                   buckets=TOKEN_BUCKETS)
+ENHANCE_TOKENS_SAVED = metrics.counter("pw_enhance_tokens_saved_total", "Input tokens removed by compaction/truncation before upstream calls.")
+ENHANCE_OVER_BUDGET_COUNT = metrics.counter("pw_enhance_over_budget_total", "Prompts over ENHANCE_INPUT_BUDGET, by outcome.", ("outcome",))
+ENHANCE_UPSTREAM_LATENCY = metrics.histogram("pw_enhance_upstream_duration_seconds", "Enhance time to the full upstream answer, by input size (tokens, upper bound).", ("input_tokens",))
+
+def _observe_db(helper: str, secs: float):
+    DB_QUERY.observe(secs, (helper,))
+    record("db", secs)   # Server-Timing
+
+def _observe_upstream(backend: str, mode: str, status: str, secs: float):
+    UPSTREAM_LATENCY.observe(secs, (backend, mode))
+    UPSTREAM_REQUESTS.inc((backend, mode, status))
+
 # ---------------- DB ----------------
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS history (
@@ -260,119 +421,801 @@ CREATE TABLE IF NOT EXISTS credit_wallets (
   timezone TEXT
 );
 """
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.executescript(SCHEMA)
+
+def _m1_baseline(conn: sqlite3.Connection):
+    # Databases created before migrations existed are at user_version 0 and
+    # already have these tables; every statement here is idempotent.
+    for stmt in (SCHEMA + CACHE_TABLE_SQL).split(";"):
+        if stmt.strip():
+            conn.execute(stmt)
+    conn.execute("UPDATE credit_wallets SET timezone=? WHERE timezone IS NULL OR timezone=''", (APP_TZ_STR,))
+
+def prompt_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _m6_history_search(conn: sqlite3.Connection):
+    conn.create_function("sha256_hex", 1, prompt_hash, deterministic=True)
+    conn.execute("ALTER TABLE history ADD COLUMN prompt_hash TEXT")
+    conn.execute("UPDATE history SET prompt_hash = sha256_hex(prompt)")
+    # Existing duplicates: keep the first save of each prompt.
+    conn.execute("DELETE FROM history WHERE id NOT IN (SELECT MIN(id) FROM history GROUP BY prompt_hash)")
+    conn.execute("CREATE UNIQUE INDEX ux_history_prompt_hash ON history(prompt_hash)")
+    # External-content FTS5 index kept in sync by triggers (retention deletes
+    # included). SQLite builds without FTS5 fall back to LIKE search.
+    try:
+        conn.execute("CREATE VIRTUAL TABLE history_fts USING fts5(prompt, content='history', content_rowid='id')")
+    except sqlite3.OperationalError as e:
+        log.warning("FTS5 unavailable, history search will scan: %s", e)
+        return
+    conn.execute("""CREATE TRIGGER history_fts_ai AFTER INSERT ON history BEGIN
+        INSERT INTO history_fts(rowid, prompt) VALUES (new.id, new.prompt);
+    END""")
+    conn.execute("""CREATE TRIGGER history_fts_ad AFTER DELETE ON history BEGIN
+        INSERT INTO history_fts(history_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+    END""")
+    conn.execute("""CREATE TRIGGER history_fts_au AFTER UPDATE OF prompt ON history BEGIN
+        INSERT INTO history_fts(history_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+        INSERT INTO history_fts(rowid, prompt) VALUES (new.id, new.prompt);
+    END""")
+    conn.execute("INSERT INTO history_fts(history_fts) VALUES ('rebuild')")
+
+MIGRATIONS = [
+    Migration(1, "baseline schema", _m1_baseline),
+    # Racy inserts could leave several rows per (ip, day). Every later UPDATE hit
+    # all of them, so the largest count is the closest to the real usage.
+    Migration(2, "unique (ip, day) on usage_counts", """
+        CREATE TABLE usage_counts_new (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          ip TEXT NOT NULL,
+          day TEXT NOT NULL,
+          count INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT INTO usage_counts_new (ip, day, count)
+          SELECT ip, day, MAX(count) FROM usage_counts
+          WHERE ip IS NOT NULL AND day IS NOT NULL GROUP BY ip, day;
+        DROP TABLE usage_counts;
+        ALTER TABLE usage_counts_new RENAME TO usage_counts;
+        CREATE UNIQUE INDEX ux_usage_counts_ip_day ON usage_counts(ip, day);
+        CREATE INDEX ix_usage_counts_day ON usage_counts(day);
+    """),
+    Migration(3, "retention tables", """
+        CREATE TABLE IF NOT EXISTS usage_daily_totals (
+          day TEXT PRIMARY KEY,
+          ips INTEGER NOT NULL DEFAULT 0,
+          total INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS history_archive (
+          id INTEGER PRIMARY KEY,
+          prompt TEXT NOT NULL,
+          created_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_history_created ON history(created_at);
+    """),
+    # auto_vacuum mode only changes on a full VACUUM; one-time cost at upgrade.
+    Migration(4, "incremental auto_vacuum", "PRAGMA auto_vacuum=INCREMENTAL; VACUUM;", transactional=False),
+    Migration(5, "worker leases and metric snapshots", """
+        CREATE TABLE IF NOT EXISTS leases (
+          name TEXT PRIMARY KEY,
+          holder TEXT NOT NULL,
+          expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS metrics_snapshots (
+          worker TEXT PRIMARY KEY,
+          updated_at REAL NOT NULL,
+          data TEXT NOT NULL
+        );
+    """),
+    Migration(6, "history dedup hash and full-text index", _m6_history_search),
+    Migration(7, "similarity index", """
+        CREATE TABLE IF NOT EXISTS similarity_index (
+          key TEXT PRIMARY KEY,
+          scope TEXT NOT NULL,
+          signature BLOB NOT NULL,
+          created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_similarity_scope_created ON similarity_index(scope, created_at);
+    """),
+    # Entries become per caller and per output budget; the old ones have no owner.
+    Migration(8, "similarity index per ip", """
+        DROP TABLE IF EXISTS similarity_index;
+        CREATE TABLE similarity_index (
+          ip TEXT NOT NULL,
+          max_tokens INTEGER NOT NULL,
+          key TEXT NOT NULL,
+          scope TEXT NOT NULL,
+          signature BLOB NOT NULL,
+          created_at REAL NOT NULL,
+          PRIMARY KEY (ip, max_tokens, key)
+        );
+        CREATE INDEX ix_similarity_scope_created ON similarity_index(scope, created_at);
+    """),
+]
+
+db = Database(DB_PATH, size=DB_POOL_SIZE, busy_timeout_ms=DB_BUSY_TIMEOUT_MS, synchronous=DB_SYNCHRONOUS,
+              observer=_observe_db)
+db.run_sync(migrate, MIGRATIONS)
+HISTORY_FTS = db.run_sync(lambda conn: conn.execute(
+    "SELECT 1 FROM sqlite_master WHERE type='table' AND name='history_fts'").fetchone() is not None)
+
+def _run_retention(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Roll old per-IP usage into daily totals, prune/archive history, free pages."""
+    out = {"usage_rows": 0, "history_rows": 0}
+    conn.execute("BEGIN IMMEDIATE")
+    if USAGE_RETENTION_DAYS > 0:
+        cutoff = (now_tz() - timedelta(days=USAGE_RETENTION_DAYS)).strftime("%Y-%m-%d")
+        conn.execute("""
+            INSERT INTO usage_daily_totals (day, ips, total)
+              SELECT day, COUNT(*), SUM(count) FROM usage_counts WHERE day < ? GROUP BY day
+            ON CONFLICT(day) DO UPDATE SET ips=ips+excluded.ips, total=total+excluded.total
+        """, (cutoff,))
+        out["usage_rows"] = conn.execute("DELETE FROM usage_counts WHERE day < ?", (cutoff,)).rowcount
+
+    # history ids grow with created_at, so both limits reduce to "delete id <= X".
+    bounds = []
+    if HISTORY_MAX_ROWS > 0:
+        row = conn.execute("SELECT id FROM history ORDER BY id DESC LIMIT 1 OFFSET ?", (HISTORY_MAX_ROWS,)).fetchone()
+        if row: bounds.append(row[0])
+    if HISTORY_MAX_DAYS > 0:
+        cutoff = (now_tz() - timedelta(days=HISTORY_MAX_DAYS)).strftime("%Y-%m-%d %H:%M")
+        row = conn.execute("SELECT MAX(id) FROM history WHERE created_at < ?", (cutoff,)).fetchone()
+        if row and row[0] is not None: bounds.append(row[0])
+    if bounds:
+        upto = max(bounds)
+        if HISTORY_ARCHIVE:
+            conn.execute("INSERT OR IGNORE INTO history_archive (id, prompt, created_at) "
+                         "SELECT id, prompt, created_at FROM history WHERE id <= ?", (upto,))
+        out["history_rows"] = conn.execute("DELETE FROM history WHERE id <= ?", (upto,)).rowcount
+    # Similarity entries only point into enhance_cache; drop those whose answer is gone.
+    out["similarity_rows"] = conn.execute(
+        "DELETE FROM similarity_index WHERE key NOT IN (SELECT key FROM enhance_cache)").rowcount
+    conn.commit()
+
+    if VACUUM_PAGES > 0:
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+    return out
+
+# Leases: one worker at a time runs singleton jobs; an expired lease (dead
+# holder) can be taken over, the holder renews by re-acquiring.
+def _lease_acquire(conn: sqlite3.Connection, name: str, holder: str, ttl: float) -> bool:
+    now = time.time()
+    row = conn.execute("""
+        INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at
+          WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+        RETURNING holder
+    """, (name, holder, now + ttl, now)).fetchone()
+    return row is not None
+
+def _lease_release(conn: sqlite3.Connection, name: str, holder: str):
+    conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+# Metric snapshots: each worker upserts its registry; counters of workers that
+# exit (or stop reporting) are folded into one "retired" row so totals stay
+# monotonic across recycling.
+METRICS_RETIRED = "retired"
+
+def _metrics_put(conn: sqlite3.Connection, worker: str, data: str):
+    conn.execute("INSERT OR REPLACE INTO metrics_snapshots (worker, updated_at, data) VALUES (?, ?, ?)",
+                 (worker, time.time(), data))
+
+def _metrics_all(conn: sqlite3.Connection):
+    return conn.execute("SELECT worker, updated_at, data FROM metrics_snapshots").fetchall()
+
+def _metrics_retire(conn: sqlite3.Connection, worker: Optional[str], stale_before: float) -> int:
+    conn.execute("BEGIN IMMEDIATE")
+    rows = conn.execute("SELECT worker, data FROM metrics_snapshots WHERE worker != ? AND (worker = ? OR updated_at < ?)",
+                        (METRICS_RETIRED, worker, stale_before)).fetchall()
+    if not rows:
+        return 0
+    retired = conn.execute("SELECT data FROM metrics_snapshots WHERE worker = ?", (METRICS_RETIRED,)).fetchone()
+    parts = [(METRICS_RETIRED, json.loads(retired["data"]))] if retired else []
+    parts += [(r["worker"], json.loads(r["data"])) for r in rows]
+    _metrics_put(conn, METRICS_RETIRED, json.dumps(merge(parts, gauges=False)))
+    conn.executemany("DELETE FROM metrics_snapshots WHERE worker = ?", [(r["worker"],) for r in rows])
+    return len(rows)
+
+def metrics_stale_before() -> float:
+    return time.time() - max(3 * METRICS_FLUSH_INTERVAL, 30)
+
+async def retention_loop():
+    while True:
+        try:
+            # With several workers only the lease holder runs the job.
+            if not SHARED_STATE or await db.run(_lease_acquire, "retention", WORKER_ID, RETENTION_INTERVAL * 2):
+                await db.run(_run_retention)
+                if SHARED_STATE:
+                    await db.run(_metrics_retire, None, metrics_stale_before())
+        except Exception as e:
+            log.warning("retention run failed: %s", e)
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+async def metrics_flush_loop():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            await db.run(_metrics_put, WORKER_ID, json.dumps(metrics.snapshot()))
+        except Exception as e:
+            log.warning("metrics snapshot failed: %s", e)
+
+response_cache = ResponseCache(db, max_items=CACHE_MAX_ITEMS, max_rows=CACHE_MAX_ROWS, ttl=CACHE_TTL)
+enhance_inflight = SingleFlight()
+
+# Near-duplicate index: signatures of each caller's past upstream inputs -> their
+# cache keys. An entry is "<ip> <max_tokens> <cache key>", so a lookup only sees
+# the caller's own prompts made with the same output budget. Persisted (fire-and-
+# forget, group commit) and reloaded in the background at startup; only entries
+# made under the current model/system/temperature are used.
+similar_index = SimilarityIndex(max_items=SIMILARITY_MAX_ITEMS)
+
+def similar_owner(ip: str, max_tokens: int) -> str:
+    return f"{ip} {max_tokens} "
+
+def _similar_put_batch(conn: sqlite3.Connection, rows: List[tuple]) -> List[None]:
+    conn.executemany("INSERT OR REPLACE INTO similarity_index (ip, max_tokens, key, scope, signature, created_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return [None] * len(rows)
+
+def _similar_rows(conn: sqlite3.Connection, scope: str, limit: int):
+    rows = conn.execute("SELECT ip, max_tokens, key, signature FROM similarity_index WHERE scope = ? "
+                        "ORDER BY created_at DESC LIMIT ?", (scope, limit)).fetchall()
+    return [(similar_owner(r[0], r[1]) + r[2], r[3]) for r in reversed(rows)]
+
+similar_writer = BatchWriter(db, _similar_put_batch, on_error=lambda e, lost: log.warning(
+    "similarity index write failed: %s", e, extra={"fields": {"rows_lost": lost}}))
+
+async def load_similar_index():
+    global similar_index
+    rows = await db.run(_similar_rows, SIMILAR_SCOPE, SIMILARITY_MAX_ITEMS)
+    def build() -> SimilarityIndex:
+        index = SimilarityIndex(max_items=SIMILARITY_MAX_ITEMS)
+        index.load((key, signature_from_bytes(blob)) for key, blob in rows)
+        return index
+    start = time.perf_counter()
+    built = await asyncio.to_thread(build)
+    for key, sig in similar_index.items():   # answers stored while we were loading
+        built.add(key, sig)
+    similar_index = built
+    log.info("similarity index loaded", extra={"fields": {"items": len(built),
+                                                          "seconds": round(time.perf_counter() - start, 2)}})
+
+async def prompt_signature(prompt: str) -> Optional[array]:
+    """MinHash signature of `prompt` (milliseconds of hashing for long prompts),
+    computed in a thread; None when suggestions are off or it has no words.
+    Computed once per request and passed to suggest_similar/remember_similar."""
+    if not (CACHE_ENABLED and SIMILARITY_ENABLED):
+        return None
+    with span("similarity"):
+        return await asyncio.to_thread(similar_index.signature, prompt)
+
+async def remember_similar(ip: str, max_tokens: int, key: str, sig: Optional[array]):
+    owner = similar_owner(ip, max_tokens)
+    if sig is None or owner + key in similar_index:
+        return
+    similar_index.add(owner + key, sig)
+    await similar_writer.submit((ip, max_tokens, key, SIMILAR_SCOPE, sig.tobytes(), time.time()), wait=False)
+
+async def suggest_similar(sig: array, ip: str, max_tokens: int, key: str) -> Optional[tuple]:
+    """The caller's stored answer for a near-duplicate (signature `sig`) -> (answer, similarity)."""
+    owner = similar_owner(ip, max_tokens)
+    match = similar_index.query(sig, SIMILARITY_THRESHOLD, exclude=(owner + key,), prefix=owner)
+    if match is None:
+        return None
+    answer = await response_cache.get(match[0][len(owner):])
+    if answer is None:   # expired or evicted from the response cache
+        similar_index.remove(match[0])
+        return None
+    return answer, match[1]
+
+async def lookup_cached(plan: "EnhancePlan", ip: str, no_cache: bool) -> tuple:
+    """Exact cache hit, else a near-duplicate suggestion -> (answer or None,
+    response fields, signature). A suggestion never stands in for the answer:
+    it comes back as `suggestion` next to the fresh one. The signature is only
+    computed on a miss, and is what the caller hands to remember_similar once
+    it has that answer; `no_cache` requests skip both."""
+    if not CACHE_ENABLED:
+        return None, {}, None
+    if no_cache:
+        response_cache.bypassed += 1
+        return None, {}, None
+    with span("cache"):
+        cached = await response_cache.get(plan.key)
+    if cached is not None:
+        return cached, {"cached": True}, None
+    sig = await prompt_signature(plan.prompt)
+    if sig is not None:
+        with span("cache"):
+            hit = await suggest_similar(sig, ip, plan.max_tokens, plan.key)
+        if hit is not None:
+            return None, {"suggestion": {"prompt": hit[0], "similarity": round(hit[1], 3)}}, sig
+    return None, {}, sig
+
+# ---------------- Upstream client ----------------
+upstream_backends = load_backends(
+    UPSTREAMS,
+    {"base_url": OPENAI_BASE_URL, "model": OPENAI_MODEL, "api_key": OPENAI_API_KEY, "org": OPENAI_ORG},
+    make_breaker=lambda: CircuitBreaker(UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_RESET),
+)
+GPT_READY = ENABLE_GPT and all(b.api_key for b in upstream_backends)
+MODEL_KEY = ",".join(sorted({b.model for b in upstream_backends}))   # cache key: any backend may answer
+
+def make_upstream_client(backend: Backend) -> httpx.AsyncClient:
+    http2 = UPSTREAM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            log.warning("UPSTREAM_HTTP2=1 but `h2` is not installed; using HTTP/1.1.")
+            http2 = False
+    return httpx.AsyncClient(
+        base_url=backend.base_url,
+        headers=backend.headers,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            read=UPSTREAM_READ_TIMEOUT,
+            write=UPSTREAM_CONNECT_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+    )
+
+def open_upstreams():
+    for b in upstream_backends:
+        b.client = make_upstream_client(b)
+
+async def close_upstreams():
+    for b in upstream_backends:
+        client, b.client = b.client, None
+        if client is not None:
+            await client.aclose()
+
+upstream_limiter = AdaptiveLimiter(
+    min_limit=UPSTREAM_LIMIT_MIN, max_limit=UPSTREAM_LIMIT_MAX, initial=UPSTREAM_LIMIT_INITIAL,
+    queue_max=UPSTREAM_QUEUE_MAX, queue_timeout=UPSTREAM_QUEUE_TIMEOUT, target_latency=UPSTREAM_TARGET_LATENCY,
+)
+upstream_router = Router(upstream_backends, upstream_limiter, hedge=UPSTREAM_HEDGE,
+                         hedge_min_delay=UPSTREAM_HEDGE_MIN_DELAY, observer=_observe_upstream)
+upstream_retry = RetryPolicy(retries=UPSTREAM_RETRIES, base=UPSTREAM_RETRY_BASE,
+                             cap=UPSTREAM_RETRY_CAP, budget=UPSTREAM_RETRY_BUDGET)
+
+async def upstream_post(body: Dict[str, Any]) -> httpx.Response:
+    """POST /chat/completions via the router (backend choice, hedging, failover),
+    retrying 429/5xx and connection errors with backoff once every backend tried
+    has failed; returns the last response (the caller decides whether it's an error)."""
+    start = time.monotonic()
+    for attempt in itertools.count():
+        try:
+            r = (await upstream_router.send(body)).response
+        except httpx.TransportError:
+            delay = upstream_retry.delay(attempt, time.monotonic() - start)
+            if delay is None:
+                raise
+            UPSTREAM_RETRY_COUNT.inc(("transport",))
+        else:
+            if r.status_code not in RETRYABLE_STATUS:
+                return r
+            delay = upstream_retry.delay(attempt, time.monotonic() - start, r.headers)
+            if delay is None:
+                return r
+            UPSTREAM_RETRY_COUNT.inc((str(r.status_code),))
+        await asyncio.sleep(delay)
+
+@asynccontextmanager
+async def upstream_stream(body: Dict[str, Any]):
+    """Streaming variant of upstream_post: retries only until a response is handed
+    to the caller, and holds the limiter slot until the stream is closed. A
+    transport error mid-stream counts against the backend's circuit breaker."""
+    start = time.monotonic()
+    for attempt in itertools.count():
+        try:
+            a = await upstream_router.send(body, stream=True)
+        except httpx.TransportError:
+            delay = upstream_retry.delay(attempt, time.monotonic() - start)
+            if delay is None:
+                raise
+            UPSTREAM_RETRY_COUNT.inc(("transport",))
+        else:
+            delay = None
+            if a.response.status_code in RETRYABLE_STATUS:
+                delay = upstream_retry.delay(attempt, time.monotonic() - start, a.response.headers)
+            if delay is None:
+                try:
+                    yield a.response
+                except httpx.TransportError:
+                    await a.aclose(failed=True)
+                    raise
+                finally:
+                    await a.aclose()
+                return
+            await a.aclose()
+            UPSTREAM_RETRY_COUNT.inc((str(a.response.status_code),))
+        await asyncio.sleep(delay)
+
+def upstream_pool_stats() -> Dict[str, Any]:
+    """Open/idle/waiting connection counts summed over the backend pools (best effort, httpcore internals)."""
+    out = {"open": 0, "idle": 0, "active": 0, "waiting": 0}
+    for b in upstream_backends:
+        if b.client is None:
+            continue
+        pool = getattr(b.client._transport, "_pool", None)
+        conns = list(getattr(pool, "connections", []) or [])
+        idle = sum(1 for c in conns if c.is_idle())
+        out["open"] += len(conns)
+        out["idle"] += idle
+        out["active"] += len(conns) - idle
+        out["waiting"] += sum(1 for r in (getattr(pool, "_requests", []) or []) if r.is_queued())
+    return out
+
+# Set once the server has been asked to stop. Long-lived streams watch it and end,
+# since uvicorn waits for open responses before it runs the lifespan shutdown
+# (so the lifespan itself is too late to tell them).
+shutting_down = asyncio.Event()
+
+def watch_stop_signals() -> Callable[[], None]:
+    """Chain onto the server's SIGINT/SIGTERM handlers to set `shutting_down`;
+    returns the undo. No-op off the main thread (test clients), where signals
+    can't be handled."""
+    if threading.current_thread() is not threading.main_thread():
+        return lambda: None
+    loop = asyncio.get_running_loop()
+    previous = {}
+
+    def handler(sig, frame):
+        loop.call_soon_threadsafe(shutting_down.set)
+        prev = previous[sig]
+        if callable(prev):
+            prev(sig, frame)
+        else:   # SIG_DFL/SIG_IGN: let the original disposition act on it
+            signal.signal(sig, prev)
+            signal.raise_signal(sig)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous[sig] = signal.getsignal(sig)
+        signal.signal(sig, handler)
+
+    def undo():
+        for sig, prev in previous.items():
+            if signal.getsignal(sig) is handler:
+                signal.signal(sig, prev)
+    return undo
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    if quota_store is not None:
+        await claim_quota_lease()
+    shutting_down.clear()
+    unwatch = watch_stop_signals()
+    open_upstreams()
+    history_writer.start()
+    similar_writer.start()
+    tasks = []
+    if quota_store is not None:
+        quota_store.start()
+        tasks.append(asyncio.create_task(quota_lease_loop()))
+    if CACHE_ENABLED and SIMILARITY_ENABLED:
+        tasks.append(asyncio.create_task(load_similar_index()))
+    if RETENTION_INTERVAL > 0:
+        tasks.append(asyncio.create_task(retention_loop()))
+    if SHARED_STATE:
+        tasks.append(asyncio.create_task(metrics_flush_loop()))
     try:
-        conn.execute("UPDATE credit_wallets SET timezone=? WHERE timezone IS NULL OR timezone=''", (APP_TZ_STR,))
-        conn.commit()
-    except Exception:
-        pass
-    conn.close()
-init_db()
+        yield
+    finally:
+        shutting_down.set()
+        unwatch()
+        for task in tasks:
+            task.cancel()
+        await close_upstreams()
+        await history_writer.aclose()   # flush queued /save rows before the pool goes away
+        await similar_writer.aclose()
+        if quota_store is not None:
+            await quota_store.aclose()   # write back the last QUOTA_FLUSH_INTERVAL of charges
+            try:
+                await db.run(_lease_release, QUOTA_LEASE, QUOTA_LEASE_HOLDER)
+            except Exception as e:
+                log.warning("quota lease release failed: %s", e)
+        if SHARED_STATE:
+            try:
+                await db.run(_metrics_put, WORKER_ID, json.dumps(metrics.snapshot()))
+                await db.run(_metrics_retire, WORKER_ID, 0.0)
+                await db.run(_lease_release, "retention", WORKER_ID)
+            except Exception as e:
+                log.warning("worker state hand-off failed: %s", e)
+        db.close()
+
+build_registry = TemplateRegistry.from_file(GOALS_FILE)
 
 # ---------------- Helpers ----------------
-app = FastAPI(title=APP_NAME)
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+app = FastAPI(title=APP_NAME, lifespan=lifespan)
+assets = AssetManifest(STATIC_DIR)   # content hashes + gzip/br variants, built once
 templates = Jinja2Templates(directory=TEMPLATE_DIR)
+templates.env.globals["asset_url"] = assets.url
+app.add_middleware(MetricsMiddleware, requests=HTTP_REQUESTS, latency=HTTP_LATENCY, in_flight=HTTP_IN_FLIGHT,
+                   untimed_routes=("/status/stream",))
+if SERVER_TIMING:
+    app.add_middleware(ServerTimingMiddleware)
+
+@metrics.collector
+def _state_metrics():
+    pool = upstream_pool_stats()
+    yield ("pw_upstream_pool_connections", "Shared upstream pool connections by state.", "gauge",
+           [({"state": k}, v) for k, v in pool.items()])
+    if CACHE_ENABLED:
+        c = response_cache.stats()
+        yield ("pw_enhance_cache_lookups_total", "Response cache lookups by result.", "counter",
+               [({"result": "hit_memory"}, c["hits_memory"]), ({"result": "hit_disk"}, c["hits_disk"]),
+                ({"result": "miss"}, c["misses"]), ({"result": "bypass"}, c["bypassed"])])
+        yield ("pw_enhance_cache_items", "Entries in the in-memory cache tier.", "gauge", [({}, c["items"])])
+    g = upstream_limiter.stats()
+    yield ("pw_upstream_concurrency_limit", "Current adaptive upstream concurrency limit.", "gauge", [({}, g["limit"])])
+    yield ("pw_upstream_queue_depth", "Requests waiting for an upstream slot.", "gauge", [({}, g["queued"])])
+    yield ("pw_upstream_requests_in_flight", "Upstream calls currently holding a slot.", "gauge", [({}, g["in_flight"])])
+    yield ("pw_upstream_backend_up", "1 while the backend's circuit breaker is closed.", "gauge",
+           [({"backend": b.name}, int(b.breaker.state == "closed")) for b in upstream_backends])
+    yield ("pw_upstream_breaker_opens_total", "Circuit breaker trips by backend.", "counter",
+           [({"backend": b.name}, b.breaker.opens) for b in upstream_backends])
+    yield ("pw_upstream_hedges_total", "Hedged duplicate calls started / won, and failovers.", "counter",
+           [({"event": "hedged"}, upstream_router.hedges), ({"event": "hedge_won"}, upstream_router.hedge_wins),
+            ({"event": "failover"}, upstream_router.failovers)])
+    yield ("pw_upstream_shed_total", "Requests refused by the upstream governor (503).", "counter",
+           [({"reason": "queue_full"}, g["rejected"]), ({"reason": "queue_timeout"}, g["queue_timeouts"])])
+    h = history_writer.stats()
+    yield ("pw_history_write_queue", "/save rows waiting for the group-commit writer.", "gauge", [({}, h["pending"])])
+    yield ("pw_history_write_batches_total", "History group-commit transactions.", "counter", [({}, h["batches"])])
+    yield ("pw_history_write_rows_total", "History rows written by outcome.", "counter",
+           [({"result": "ok"}, h["rows"]), ({"result": "failed"}, h["failed_rows"])])
+    if CACHE_ENABLED and SIMILARITY_ENABLED:
+        sm = similar_index.stats()
+        yield ("pw_similarity_index_items", "Entries in the near-duplicate index.", "gauge", [({}, sm["items"])])
+        yield ("pw_similarity_lookups_total", "Near-duplicate index lookups by result.", "counter",
+               [({"result": "match"}, sm["matches"]), ({"result": "miss"}, sm["lookups"] - sm["matches"])])
+    if quota_store is not None:
+        q = quota_store.stats()
+        yield ("pw_quota_entries", "Quota entries held in memory.", "gauge",
+               [({"table": "usage"}, q["usage_items"]), ({"table": "wallet"}, q["wallet_items"])])
+        yield ("pw_quota_dirty_entries", "Quota entries changed since the last write-back.", "gauge", [({}, q["dirty"])])
+        yield ("pw_quota_flushes_total", "Quota write-backs by result.", "counter",
+               [({"result": "ok"}, q["flushes"]), ({"result": "error"}, q["flush_errors"])])
+    st = status_board.stats()
+    yield ("pw_status_subscribers", "Open /status/stream connections.", "gauge", [({}, st["subscribers"])])
+    yield ("pw_status_lookups_total", "/status cache lookups by result.", "counter",
+           [({"result": "hit"}, st["hits"]), ({"result": "load"}, st["loads"])])
+    f = enhance_inflight.stats()
+    yield ("pw_enhance_singleflight_total", "Enhance upstream calls started (leader) vs joined (coalesced).", "counter",
+           [({"role": "leader"}, f["leaders"]), ({"role": "coalesced"}, f["coalesced"]), ({"role": "abandoned"}, f["abandoned"])])
 
 def _get_ip(req: Request) -> str:
     xff = req.headers.get("x-forwarded-for", "")
     return (xff.split(",")[0].strip() if xff else req.client.host)
 
+# Background work that must outlive the request that started it (e.g. refunds
+# after a client disconnect); a reference is kept so the task isn't GC'd mid-flight.
+_background_tasks: set = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Repository: `_name(conn, ...)` runs on a DB worker thread; `name(...)` is the
+# awaitable wrapper routes use. Composite helpers share one connection/hop.
+
 # FREE limits
-def can_use_and_inc(ip: str) -> bool:
-    day = today_str()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    row = cur.execute("SELECT count FROM usage_counts WHERE ip=? AND day=?", (ip, day)).fetchone()
-    count = (row[0] if row else 0)
-    if count >= DAILY_FREE_LIMIT:
-        conn.close()
+def _can_use_and_inc(conn: sqlite3.Connection, ip: str) -> bool:
+    """One UPSERT: insert the day's first use, or increment while under the limit.
+    No row comes back when the limit is reached. Uses ux_usage_counts_ip_day."""
+    if DAILY_FREE_LIMIT <= 0:
         return False
-    if row:
-        cur.execute("UPDATE usage_counts SET count=count+1 WHERE ip=? AND day=?", (ip, day))
-    else:
-        cur.execute("INSERT INTO usage_counts (ip, day, count) VALUES (?, ?, 1)", (ip, day))
-    conn.commit()
-    conn.close()
-    return True
+    return bool(conn.execute(
+        "INSERT INTO usage_counts (ip, day, count) VALUES (?, ?, 1) "
+        "ON CONFLICT(ip, day) DO UPDATE SET count=count+1 WHERE count < ? RETURNING count",
+        (ip, today_str(), DAILY_FREE_LIMIT)).fetchall())
+
+async def can_use_and_inc(ip: str) -> bool:
+    if quota_store is not None:
+        return await quota_store.use_free(ip)
+    return await db.run(_can_use_and_inc, ip)
 
-def get_usage_status(ip: str):
-    day = today_str()
-    conn = sqlite3.connect(DB_PATH)
+def _usage_count(conn: sqlite3.Connection, ip: str, day: str) -> int:
     row = conn.execute("SELECT count FROM usage_counts WHERE ip=? AND day=?", (ip, day)).fetchone()
-    conn.close()
-    count = (row[0] if row else 0)
+    return (row[0] if row else 0)
+
+def _usage_status(count: int) -> Dict[str, Any]:
     limit = DAILY_FREE_LIMIT
     remaining = max(limit - count, 0)
     reset_at = next_midnight_tz_iso()
     return {"count": count, "limit": limit, "remaining": remaining, "reset_at": reset_at}
 
+def _get_usage_status(conn: sqlite3.Connection, ip: str):
+    return _usage_status(_usage_count(conn, ip, today_str()))
+
+async def get_usage_status(ip: str):
+    if quota_store is not None:
+        return _usage_status(await quota_store.usage_count(ip))
+    return await db.run(_get_usage_status, ip)
+
+def _usage_refund(conn: sqlite3.Connection, ip: str):
+    conn.execute("UPDATE usage_counts SET count=count-1 WHERE ip=? AND day=? AND count>0", (ip, today_str()))
+
 # PAID wallet
-def wallet_get(ip: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+# Lazy daily grant, evaluated inside SQL so it can be applied in the same
+# statement that checks and spends: whole days since last_grant_day times
+# DAILY_GRANT, capped at MAX_BALANCE.
+_GRANT_DUE = "(:grant > 0 AND last_grant_day < :today)"
+_GRANTED_BALANCE = (f"(CASE WHEN {_GRANT_DUE} THEN MIN(balance + "
+                    "CAST(julianday(:today) - julianday(last_grant_day) AS INTEGER) * :grant, :max) "
+                    "ELSE balance END)")
+_GRANT_DAY = f"(CASE WHEN {_GRANT_DUE} THEN :today ELSE last_grant_day END)"
+
+def _wallet_params(ip: str, n: int = 0) -> Dict[str, Any]:
+    return {"ip": ip, "n": n, "today": today_str(), "grant": DAILY_GRANT, "max": MAX_BALANCE}
+
+def _wallet_ensure(conn: sqlite3.Connection, ip: str):
+    conn.execute("INSERT OR IGNORE INTO credit_wallets (ip,balance,last_grant_day,timezone) VALUES (?,?,?,?)",
+                 (ip, max(INITIAL_CREDITS, 0), today_str(), APP_TZ_STR))
+
+def _wallet_get(conn: sqlite3.Connection, ip: str):
+    _wallet_ensure(conn, ip)
     row = conn.execute("SELECT ip,balance,last_grant_day,timezone FROM credit_wallets WHERE ip=?", (ip,)).fetchone()
-    if not row:
-        conn.execute(
-            "INSERT INTO credit_wallets (ip,balance,last_grant_day,timezone) VALUES (?,?,?,?)",
-            (ip, max(INITIAL_CREDITS, 0), today_str(), APP_TZ_STR)
-        )
-        conn.commit()
-        row = conn.execute("SELECT ip,balance,last_grant_day,timezone FROM credit_wallets WHERE ip=?", (ip,)).fetchone()
-    conn.close()
     return dict(row)
 
-def wallet_grant_if_needed(ip: str):
+async def wallet_get(ip: str):
+    return await db.run(_wallet_get, ip)
+
+def _wallet_grant_if_needed(conn: sqlite3.Connection, ip: str):
     if DAILY_GRANT <= 0:
         return
-    w = wallet_get(ip)
-    last = w.get("last_grant_day") or today_str()
-    today = today_str()
-    if today > last:
-        d1 = datetime.strptime(last, "%Y-%m-%d")
-        d2 = datetime.strptime(today, "%Y-%m-%d")
-        days = (d2 - d1).days
-        add = max(days, 0) * DAILY_GRANT
-        new_bal = min(w["balance"] + add, MAX_BALANCE)
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute("UPDATE credit_wallets SET balance=?, last_grant_day=? WHERE ip=?",
-                     (new_bal, today, ip))
-        conn.commit()
-        conn.close()
-
-def wallet_status(ip: str):
-    wallet_grant_if_needed(ip)
-    w = wallet_get(ip)
+    _wallet_ensure(conn, ip)
+    conn.execute(f"UPDATE credit_wallets SET balance={_GRANTED_BALANCE}, last_grant_day={_GRANT_DAY} "
+                 f"WHERE ip=:ip AND {_GRANT_DUE}", _wallet_params(ip))
+
+async def wallet_grant_if_needed(ip: str):
+    await db.run(_wallet_grant_if_needed, ip)
+
+def _credits_status(balance: int) -> Dict[str, Any]:
     reset_at = next_midnight_tz_iso()
-    return {"balance": w["balance"], "grant_per_day": DAILY_GRANT,
+    return {"balance": balance, "grant_per_day": DAILY_GRANT,
             "max_balance": MAX_BALANCE, "reset_at": reset_at}
 
-def wallet_spend(ip: str, n: int = 1) -> bool:
-    wallet_grant_if_needed(ip)
-    w = wallet_get(ip)
-    if w["balance"] < n:
-        return False
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("UPDATE credit_wallets SET balance=balance-? WHERE ip=?", (n, ip))
-    conn.commit()
-    conn.close()
-    return True
+def _wallet_status(conn: sqlite3.Connection, ip: str):
+    conn.execute("BEGIN IMMEDIATE")
+    _wallet_grant_if_needed(conn, ip)
+    return _credits_status(_wallet_get(conn, ip)["balance"])
+
+async def wallet_status(ip: str):
+    if quota_store is not None:
+        return _credits_status(await quota_store.balance(ip))
+    return await db.run(_wallet_status, ip)
+
+def _wallet_spend(conn: sqlite3.Connection, ip: str, n: int = 1) -> bool:
+    """Grant + check + spend as one conditional UPDATE (plus creating the wallet on
+    first use), in a single write transaction. If the balance is short nothing is
+    written; the pending grant is recomputed identically next time."""
+    conn.execute("BEGIN IMMEDIATE")
+    _wallet_ensure(conn, ip)
+    return bool(conn.execute(
+        f"UPDATE credit_wallets SET balance={_GRANTED_BALANCE} - :n, last_grant_day={_GRANT_DAY} "
+        f"WHERE ip=:ip AND {_GRANTED_BALANCE} >= :n RETURNING balance",
+        _wallet_params(ip, n)).fetchall())
+
+async def wallet_spend(ip: str, n: int = 1) -> bool:
+    if quota_store is not None:
+        return await quota_store.spend(ip, n)
+    return await db.run(_wallet_spend, ip, n)
+
+def _wallet_refund(conn: sqlite3.Connection, ip: str, n: int = 1):
+    conn.execute("UPDATE credit_wallets SET balance=balance+? WHERE ip=?", (n, ip))
+
+# Hot quota state (quota.py). `_quota_wallet` hands the store the stored row;
+# the lazy grant is then applied in memory with the same arithmetic as above.
+def _quota_wallet(conn: sqlite3.Connection, ip: str):
+    w = _wallet_get(conn, ip)
+    return w["balance"], w["last_grant_day"]
+
+def _quota_write_back(conn: sqlite3.Connection, usage: List[tuple], wallets: List[tuple]):
+    """Deltas from the store, in one transaction. The usage UPSERT covers rows
+    that retention rolled up meanwhile; wallets always exist (created on load)."""
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany("INSERT INTO usage_counts (ip, day, count) VALUES (?1, ?2, MAX(?3, 0)) "
+                     "ON CONFLICT(ip, day) DO UPDATE SET count=MAX(count+?3, 0)", usage)
+    conn.executemany("UPDATE credit_wallets SET balance=balance+?2, last_grant_day=?3 WHERE ip=?1", wallets)
+
+def _quota_flush_failed(e: Exception):
+    log.warning("quota write-back failed, retrying next flush: %s", e)
+
+quota_store: Optional[QuotaStore] = None
+if QUOTA_FLUSH_INTERVAL > 0 and not SHARED_STATE:
+    quota_store = QuotaStore(db, _usage_count, _quota_wallet, _quota_write_back, today=today_str,
+                             free_limit=DAILY_FREE_LIMIT, daily_grant=DAILY_GRANT, max_balance=MAX_BALANCE,
+                             max_items=QUOTA_MAX_ITEMS, flush_interval=QUOTA_FLUSH_INTERVAL,
+                             on_error=_quota_flush_failed)
+
+# The in-memory store must be the only writer of quota rows (other processes would
+# enforce limits on their own copies, or on rows it is about to overwrite with deltas).
+QUOTA_LEASE = "quota"
+QUOTA_LEASE_HOLDER = f"{WORKER_ID}:{os.urandom(4).hex()}"   # pids repeat across containers
+
+async def claim_quota_lease():
+    """Wait up to QUOTA_LEASE_TTL for the lease (a crashed owner's runs out), then refuse to start."""
+    deadline = time.monotonic() + QUOTA_LEASE_TTL
+    while not await db.run(_lease_acquire, QUOTA_LEASE, QUOTA_LEASE_HOLDER, QUOTA_LEASE_TTL):
+        if time.monotonic() >= deadline:
+            raise RuntimeError("QUOTA_FLUSH_INTERVAL > 0 allows one process per database and another one holds "
+                               "the quota lease; set QUOTA_FLUSH_INTERVAL=0 to run several.")
+        await asyncio.sleep(1)
+
+async def quota_lease_loop():
+    global quota_store
+    while True:
+        await asyncio.sleep(QUOTA_LEASE_TTL / 3)
+        try:
+            if await db.run(_lease_acquire, QUOTA_LEASE, QUOTA_LEASE_HOLDER, QUOTA_LEASE_TTL):
+                continue
+        except Exception as e:
+            log.warning("quota lease renewal failed: %s", e)
+            continue
+        # Renewals stalled past the TTL and another process took over: write back
+        # what we hold and meter through SQLite from now on.
+        log.error("quota lease lost; falling back to SQLite quota")
+        store, quota_store = quota_store, None
+        await store.aclose()
+        return
+
+async def _load_quota_status(ip: str) -> Dict[str, Any]:
+    return {"credits": await wallet_status(ip)} if ROLLOVER_MODE else {"usage": await get_usage_status(ip)}
+
+status_board = StatusBoard(_load_quota_status, ttl=STATUS_CACHE_TTL, max_items=STATUS_CACHE_MAX_ITEMS,
+                           horizon=lambda: next_midnight_tz().timestamp())
+
+async def quota_status(ip: str) -> Dict[str, Any]:
+    """Fresh status (for responses that just charged or refunded); also updates
+    /status and pushes to the caller's open status streams."""
+    status = await _load_quota_status(ip)
+    status_board.put(ip, status)
+    return status
+
+async def charge_quota(ip: str, cost: int = 1) -> Optional[JSONResponse]:
+    """Meter one enhancement (`cost` credits in PAID mode, one request of the FREE
+    cap); returns the 402/429 response when the caller is out of quota."""
+    with span("quota"):
+        if ROLLOVER_MODE:
+            if not await wallet_spend(ip, cost):
+                QUOTA_REJECTIONS.inc(("402",))
+                return JSONResponse({"ok": False, "error": "Not enough credits.", "cost": cost,
+                                     "credits": await wallet_status(ip)}, status_code=402)
+        else:
+            if not await can_use_and_inc(ip):
+                QUOTA_REJECTIONS.inc(("429",))
+                return JSONResponse({"ok": False, "error": "Daily GPT limit reached.", "usage": await get_usage_status(ip)}, status_code=429)
+    status_board.changed(ip)
+    return None
+
+def upstream_busy(retry_after: int, **extra: Any) -> JSONResponse:
+    return JSONResponse({"ok": False, "error": "Upstream is busy, please retry shortly.", "retry_after": retry_after, **extra},
+                        status_code=503, headers={"Retry-After": str(retry_after)})
+
+async def refund_quota(ip: str, cost: int = 1):
+    if quota_store is not None:
+        await (quota_store.refund(ip, cost) if ROLLOVER_MODE else quota_store.refund_free(ip))
+    elif ROLLOVER_MODE:
+        await db.run(_wallet_refund, ip, cost)
+    else:
+        await db.run(_usage_refund, ip)
+    status_board.changed(ip)
 
 # ---------------- Models ----------------
-class BuildPayload(BaseModel):
-    audience: str
-    tone: str
-    goal: str
-    platform: Optional[str] = None
-    language: Optional[str] = "English"
-    constraints: Optional[str] = None
-    brand: Optional[str] = None
-    details: Optional[str] = None
+class BuildBatchPayload(BaseModel):
+    items: List[BuildPayload]
 
 class EnhancePayload(BaseModel):
     prompt: str
+    no_cache: bool = False   # skip the cache and near-duplicate lookups (fresh answer is still stored)
+    goal: Optional[str] = None   # sizes max_tokens; read from the prompt's goal line when omitted
 
 # ---------------- Routes ----------------
 @app.get("/", response_class=HTMLResponse)
@@ -387,179 +1230,593 @@ async def home(request: Request):
             "rollover_mode": ROLLOVER_MODE,
             "show_usage": SHOW_USAGE,
             "show_timer": SHOW_TIMER,
-            "build_id": int(datetime.now().timestamp()),  # cache-bust static
         },
     )
 
+@app.api_route("/static/{name:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def static_asset(name: str, request: Request):
+    return assets.response(request, name)
+
 @app.post("/build")
 async def build(payload: BuildPayload):
-    # simple debug to see payload
-    print("DEBUG /build payload:", payload.model_dump())
-
-    lines = [
-        f"You are an expert. Create a {payload.goal}.",
-        f"Target audience: {payload.audience}.",
-        f"Tone: {payload.tone}.",
-        f"Language: {payload.language}.",
-    ]
-    if payload.platform:    lines.append(f"Platform: {payload.platform}.")
-    if payload.brand:       lines.append(f"Brand voice: {payload.brand}.")
-    if payload.details:     lines.append(f"Details: {payload.details}.")
-    if payload.constraints: lines.append(f"Constraints: {payload.constraints}.")
-    lines.append("Provide 3 variants when possible.")
-    detailed = "\n".join(lines)
-
-    goal = (payload.goal or "content").strip()
-    audience = payload.audience.strip()
-    tone = payload.tone.strip()
-    language = payload.language or "English"
-    platform = (payload.platform or "").strip()
-    brand = (payload.brand or "").strip()
-    details = (payload.details or "").strip()
-    constraints = (payload.constraints or "").strip()
-
-    g = goal.lower()
-    if "instagram" in g and "caption" in g:
-        output_fmt = ("OUTPUT FORMAT (STRICT):\n"
-                      "1) Caption 1: <text> #<tag1> #<tag2>\n"
-                      "2) Caption 2: <text> #<tag1> #<tag2>\n"
-                      "3) Caption 3: <text> #<tag1> #<tag2>")
-    elif "email subject" in g or "email" in g:
-        output_fmt = ("OUTPUT FORMAT (STRICT):\n"
-                      "1) <subject line> (chars: ###)\n"
-                      "2) <subject line> (chars: ###)\n"
-                      "3) <subject line> (chars: ###)")
-    elif "tiktok" in g and "script" in g:
-        output_fmt = ("OUTPUT FORMAT (STRICT):\n"
-                      "1) Hook (≤8 words)\n"
-                      "2) Beat 1 (5–7s)\n"
-                      "3) Beat 2 (5–7s)\n"
-                      "4) Beat 3 (3–5s)\n"
-                      "5) CTA (1 line)\n"
-                      "6) 2 hashtags")
-    elif "blog" in g and "outline" in g:
-        output_fmt = ("OUTPUT FORMAT (STRICT):\n"
-                      "H1 Title\n"
-                      "H2 Sections (4–6)\n"
-                      "Bullet points per section (3–5)")
-    else:
-        output_fmt = ("OUTPUT FORMAT (STRICT):\n"
-                      "Return a numbered list of 3 variants:\n"
-                      "1) ...\n"
-                      "2) ...\n"
-                      "3) ...")
-
-    concise_lines = [
-        f"TASK: Create 3 variants of {goal}.",
-        f"AUDIENCE: {audience}",
-        f"TONE/VOICE: {tone}" + (f" | Brand: {brand}" if brand else ""),
-        f"LANGUAGE: {language}",
-    ]
-    if platform: concise_lines.append(f"PLATFORM: {platform}")
-    if details:  concise_lines.append(f"PRODUCT/DETAILS: {details}")
-    concise_lines.append("CONSTRAINTS:")
-    if constraints:
-        concise_lines.append(f"- {constraints}")
-    else:
-        concise_lines.append("- Keep it concise and scroll-stopping.")
-        if "instagram" in g and "caption" in g:
-            concise_lines.append("- End each caption with exactly 2 relevant hashtags.")
-
-    concise_lines += ["", output_fmt, "", "QUALITY CHECK:", "- If any variant violates constraints, rewrite it before returning."]
-    concise = "\n".join(concise_lines)
-
+    data = payload.model_dump()
+    log.debug("build payload", extra={"fields": {"payload": data}})
+    with span("render"):
+        detailed, concise = build_registry.render(data)
     return {"ok": True, "prompt": detailed, "concise": concise}
 
+@app.post("/build_batch")
+def build_batch(payload: BuildBatchPayload):
+    """Render many /build payloads in one call; results keep the input order.
+    Sync route, so FastAPI renders large batches in its threadpool."""
+    if len(payload.items) > BUILD_BATCH_MAX:
+        return JSONResponse({"ok": False, "error": f"Too many items (max {BUILD_BATCH_MAX})."}, status_code=413)
+    render = build_registry.render
+    items = []
+    with span("render"):
+        for p in payload.items:
+            detailed, concise = render(p.model_dump())
+            items.append({"prompt": detailed, "concise": concise})
+    return {"ok": True, "count": len(items), "items": items}
+
+ENHANCE_SYSTEM = ("You refine prompt instructions for generative AI models. "
+                  "Improve clarity, add structure, keep it concise but complete, "
+                  "and include explicit output formatting when helpful. "
+                  "Do NOT generate the final content—return only the improved prompt.")
+ENHANCE_TEMPERATURE = 0.4
+# Similarity entries are only reused under the same model/system/temperature
+# (and, per entry, the same sized max_tokens).
+SIMILAR_SCOPE = cache_key("", MODEL_KEY, ENHANCE_SYSTEM, ENHANCE_TEMPERATURE, 0)[:16]
+
+token_counter = TokenCounter(TOKENIZER_ENCODING)
+# Goal line of a /build prompt (detailed or concise), for requests that don't name one.
+_GOAL_LINE = re.compile(r"^(?:You are an expert\. Create an? |TASK: Create 3 variants of )(.+?)\.$", re.M)
+
+class EnhancePlan(NamedTuple):
+    prompt: str         # compacted (and possibly truncated) input that goes upstream
+    key: str            # cache key; includes max_tokens
+    goal: str
+    input_tokens: int
+    max_tokens: int
+    saved: int          # tokens removed by the pre-flight
+    truncated: bool
+
+def enhance_goal(payload: "EnhancePayload") -> GoalTemplate:
+    goal = payload.goal
+    if not goal:
+        m = _GOAL_LINE.search(payload.prompt)
+        goal = m.group(1) if m else ""
+    return build_registry.classify(goal.strip().lower())
+
+def plan_enhance(payload: "EnhancePayload") -> EnhancePlan:
+    """Token pre-flight: count, compact, enforce ENHANCE_INPUT_BUDGET (raises
+    OverBudget with ENHANCE_OVER_BUDGET=reject) and size max_tokens by goal."""
+    with span("tokens"):
+        try:
+            pf = preflight(payload.prompt, token_counter, ENHANCE_INPUT_BUDGET,
+                           truncate=ENHANCE_OVER_BUDGET != "reject", compact_text=ENHANCE_COMPACT)
+        except OverBudget:
+            ENHANCE_OVER_BUDGET_COUNT.inc(("rejected",))
+            raise
+        if pf.truncated:
+            ENHANCE_OVER_BUDGET_COUNT.inc(("truncated",))
+        tpl = enhance_goal(payload)
+    max_tokens = output_budget(pf.tokens, tpl.enhance_tokens, ENHANCE_OUTPUT_RATIO, ENHANCE_MAX_TOKENS, ENHANCE_MIN_TOKENS)
+    key = cache_key(pf.prompt, MODEL_KEY, ENHANCE_SYSTEM, ENHANCE_TEMPERATURE, max_tokens)
+    return EnhancePlan(pf.prompt, key, tpl.name, pf.tokens, max_tokens, pf.original_tokens - pf.tokens, pf.truncated)
+
+def prompt_too_long(e: OverBudget) -> JSONResponse:
+    return JSONResponse({"ok": False, "error": str(e), "tokens": {"input": e.tokens, "budget": e.budget}}, status_code=413)
+
+def credit_cost(tokens: int) -> int:
+    if ENHANCE_TOKENS_PER_CREDIT <= 0:
+        return 1
+    return max(1, -(-tokens // ENHANCE_TOKENS_PER_CREDIT))
+
+async def settle_quota(ip: str, reserved: int, tokens: int) -> int:
+    """Refund the unused part of an up-front reservation -> credits actually charged."""
+    used = min(credit_cost(tokens), reserved)
+    if ROLLOVER_MODE and used < reserved:
+        await refund_quota(ip, reserved - used)
+    return used
+
+def observe_tokens(plan: EnhancePlan, output_tokens: int, seconds: float):
+    """Per-call token accounting (metrics + one log line, so size can be lined
+    up with latency). The caller counts the output once and passes the same
+    number to settle_quota and token_fields."""
+    ENHANCE_TOKENS.observe(plan.input_tokens, ("input",))
+    ENHANCE_TOKENS.observe(output_tokens, ("output",))
+    if plan.saved:
+        ENHANCE_TOKENS_SAVED.inc((), plan.saved)
+    i = bisect_left(TOKEN_BUCKETS, plan.input_tokens)
+    ENHANCE_UPSTREAM_LATENCY.observe(seconds, (str(TOKEN_BUCKETS[i]) if i < len(TOKEN_BUCKETS) else "+Inf",))
+    log.info("enhance tokens", extra={"fields": {"goal": plan.goal, "input_tokens": plan.input_tokens,
+                                                 "saved_tokens": plan.saved, "truncated": plan.truncated,
+                                                 "max_tokens": plan.max_tokens, "output_tokens": output_tokens,
+                                                 "upstream_ms": round(seconds * 1000, 1)}})
+
+def token_fields(plan: EnhancePlan, output_tokens: int, cost: int) -> Dict[str, Any]:
+    out = {"tokens": {"input": plan.input_tokens, "output": output_tokens, "max_output": plan.max_tokens,
+                      "saved": plan.saved, "truncated": plan.truncated}}
+    if ROLLOVER_MODE:
+        out["cost"] = cost
+    return out
+
+def enhance_body(prompt: str, max_tokens: int = ENHANCE_MAX_TOKENS, stream: bool = False) -> Dict[str, Any]:
+    body = {   # "model" is filled in per backend by the router
+        "messages": [
+            {"role": "system", "content": ENHANCE_SYSTEM},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": ENHANCE_TEMPERATURE,
+        "max_tokens": max_tokens,
+    }
+    if stream:
+        body["stream"] = True
+    return body
+
+async def upstream_enhance(prompt: str, key: str, max_tokens: int = ENHANCE_MAX_TOKENS) -> str:
+    r = await upstream_post(enhance_body(prompt, max_tokens))
+    r.raise_for_status()
+    data = r.json()
+    out = data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
+    if CACHE_ENABLED and out:
+        await response_cache.put(key, out)
+    return out
+
+async def upstream_enhance_stream(prompt: str, key: str, max_tokens: int, emit: Callable[[str], None]) -> str:
+    """Streaming upstream_enhance: hands each content delta to `emit` as it arrives."""
+    parts = []
+    async with upstream_stream(enhance_body(prompt, max_tokens, stream=True)) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            delta = ((chunk.get("choices") or [{}])[0].get("delta") or {}).get("content")
+            if delta:
+                parts.append(delta)
+                emit(delta)
+    if not parts:
+        raise RuntimeError("Empty response from upstream.")
+    out = "".join(parts).strip()
+    if CACHE_ENABLED and out:
+        await response_cache.put(key, out)
+    return out
+
 @app.post("/enhance")
 async def enhance(payload: EnhancePayload, request: Request):
-    if not ENABLE_GPT or not OPENAI_API_KEY:
+    """Refine a prompt via the upstream model.
+
+    Cache policy: with CACHE_HITS_FREE=1 (default) a cache hit is returned before
+    metering, so it costs no credit and does not count toward the daily cap. With
+    CACHE_HITS_FREE=0 hits are metered exactly like upstream calls. Failing an exact
+    hit, the fresh answer comes with a `suggestion` ({prompt, similarity}) when the
+    caller got an answer to a near-duplicate prompt (SIMILARITY_THRESHOLD) before;
+    `no_cache: true` skips both lookups.
+
+    Concurrent identical requests share one upstream call (single-flight); each
+    caller is still metered on its own before joining it. Upstream calls go
+    through the governor: 503 + Retry-After when its queue is full, and the
+    charge is refunded whenever no answer could be produced.
+
+    Tokens: the prompt is compacted and fitted to ENHANCE_INPUT_BUDGET first
+    (truncated, or 413 with ENHANCE_OVER_BUDGET=reject), and max_tokens is sized
+    from its length and goal. With ENHANCE_TOKENS_PER_CREDIT set, PAID calls
+    reserve credits for input + max output and get the unused part back.
+    """
+    if not GPT_READY:
         return JSONResponse({"ok": False, "error": "GPT disabled."}, status_code=400)
 
     ip = _get_ip(request)
-    if ROLLOVER_MODE:
-        if not wallet_spend(ip, 1):
-            return JSONResponse({"ok": False, "error": "Not enough credits.", "credits": wallet_status(ip)}, status_code=402)
-    else:
-        if not can_use_and_inc(ip):
-            return JSONResponse({"ok": False, "error": "Daily GPT limit reached.", "usage": get_usage_status(ip)}, status_code=429)
+    try:
+        plan = plan_enhance(payload)
+    except OverBudget as e:
+        return prompt_too_long(e)
+    key = plan.key
+    cached, hit, sig = await lookup_cached(plan, ip, payload.no_cache)
+    cached_tokens = token_counter.count(cached) if cached is not None else 0
+    if cached is not None and CACHE_HITS_FREE:
+        return {"ok": True, "prompt": cached, **hit, **token_fields(plan, cached_tokens, 0), **(await quota_status(ip))}
+    if cached is None and upstream_limiter.saturated():
+        return upstream_busy(upstream_limiter.retry_after())
+
+    cost = credit_cost(plan.input_tokens + (cached_tokens if cached is not None else plan.max_tokens))
+    rejected = await charge_quota(ip, cost)
+    if rejected is not None:
+        return rejected
+
+    if cached is not None:
+        return {"ok": True, "prompt": cached, **hit, **token_fields(plan, cached_tokens, cost), **(await quota_status(ip))}
 
-    system = ("You refine prompt instructions for generative AI models. "
-              "Improve clarity, add structure, keep it concise but complete, "
-              "and include explicit output formatting when helpful. "
-              "Do NOT generate the final content—return only the improved prompt.")
+    try:
+        started = time.perf_counter()
+        with span("upstream"):
+            out = await enhance_inflight.do(key, lambda: upstream_enhance(plan.prompt, key, plan.max_tokens))
+        if out:
+            await remember_similar(ip, plan.max_tokens, key, sig)
+        output_tokens = token_counter.count(out)
+        observe_tokens(plan, output_tokens, time.perf_counter() - started)
+        cost = await settle_quota(ip, cost, plan.input_tokens + output_tokens)
+        return {"ok": True, "prompt": out, **hit, **token_fields(plan, output_tokens, cost), **(await quota_status(ip))}
+    except Overloaded as e:
+        await refund_quota(ip, cost)
+        return upstream_busy(e.retry_after, refunded=True, **(await quota_status(ip)))
+    except Exception as e:
+        await refund_quota(ip, cost)
+        return JSONResponse({"ok": False, "error": str(e), "refunded": True, **(await quota_status(ip))}, status_code=500)
+
+def sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-    if OPENAI_ORG: headers["OpenAI-Organization"] = OPENAI_ORG
+@app.post("/enhance_stream")
+async def enhance_stream(payload: EnhancePayload, request: Request):
+    """Streaming /enhance: relays upstream tokens as SSE `token` events, then one `done` event.
 
+    Quota is charged once up front (same cache and token policy as /enhance),
+    refunded if the stream fails or the client goes away before the first
+    token, and settled on the tokens actually streamed otherwise.
+    Errors before streaming starts (disabled, 402, 413, 429, 503) come back as JSON.
+
+    Concurrent identical requests share one upstream stream (the same single-flight
+    as /enhance); one that joins late first gets the tokens streamed so far, and
+    one that joins a plain /enhance call gets its answer as a single token.
+    """
+    if not GPT_READY:
+        return JSONResponse({"ok": False, "error": "GPT disabled."}, status_code=400)
+
+    ip = _get_ip(request)
     try:
-        async with httpx.AsyncClient(timeout=30, base_url=OPENAI_BASE_URL, headers=headers) as client:
-            r = await client.post("/chat/completions", json={
-                "model": OPENAI_MODEL,
-                "messages": [
-                    {"role": "system", "content": system},
-                    {"role": "user", "content": payload.prompt},
-                ],
-                "temperature": 0.4,
-                "max_tokens": 600,
-            })
-            r.raise_for_status()
-            data = r.json()
-            out = data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-            return {"ok": True, "prompt": out, **({"credits": wallet_status(ip)} if ROLLOVER_MODE else {"usage": get_usage_status(ip)})}
-    except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        plan = plan_enhance(payload)
+    except OverBudget as e:
+        return prompt_too_long(e)
+    key = plan.key
+    cached, hit, sig = await lookup_cached(plan, ip, payload.no_cache)
+    cached_tokens = token_counter.count(cached) if cached is not None else 0
+
+    if cached is None and upstream_limiter.saturated():
+        return upstream_busy(upstream_limiter.retry_after())
+    cost = 0
+    if cached is None or not CACHE_HITS_FREE:
+        cost = credit_cost(plan.input_tokens + (cached_tokens if cached is not None else plan.max_tokens))
+        rejected = await charge_quota(ip, cost)
+        if rejected is not None:
+            return rejected
+
+    async def cached_events():
+        yield sse("token", {"t": cached})
+        yield sse("done", {"ok": True, "prompt": cached, **hit, **token_fields(plan, cached_tokens, cost), **(await quota_status(ip))})
+
+    async def upstream_events():
+        parts = []
+        finished = False
+        started = time.perf_counter()
+        try:
+            async with enhance_inflight.stream(
+                    key, lambda emit: upstream_enhance_stream(plan.prompt, key, plan.max_tokens, emit)) as call:
+                async for delta in call.follow():
+                    parts.append(delta)
+                    yield sse("token", {"t": delta})
+                out = await call.result()
+            if not parts:   # joined a non-streaming /enhance call
+                if not out:
+                    raise RuntimeError("Empty response from upstream.")
+                parts.append(out)
+                yield sse("token", {"t": out})
+            finished = True
+            output_tokens = token_counter.count(out)
+            observe_tokens(plan, output_tokens, time.perf_counter() - started)
+            used = await settle_quota(ip, cost, plan.input_tokens + output_tokens)
+            if out:
+                await remember_similar(ip, plan.max_tokens, key, sig)
+            yield sse("done", {"ok": True, "prompt": out, **hit, **token_fields(plan, output_tokens, used), **(await quota_status(ip))})
+        except Exception as e:
+            if not parts:
+                await refund_quota(ip, cost)
+            elif not finished:
+                await settle_quota(ip, cost, plan.input_tokens + token_counter.count("".join(parts)))
+            finished = True
+            extra = {"retry_after": e.retry_after} if isinstance(e, Overloaded) else {}
+            yield sse("error", {"ok": False, "error": str(e), "refunded": not parts, **extra, **(await quota_status(ip))})
+        finally:
+            if not finished:
+                # Client disconnected; we're being cancelled, so the refund (all of
+                # it before the first token, else what wasn't streamed) runs as its own task.
+                spawn(settle_quota(ip, cost, plan.input_tokens + token_counter.count("".join(parts))) if parts
+                      else refund_quota(ip, cost))
+
+    events = cached_events() if cached is not None else upstream_events()
+    return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
+
+def _history_insert_batch(conn: sqlite3.Connection, rows: List[tuple]) -> List[tuple]:
+    """-> (id, duplicate) per row; an identical prompt already saved keeps its row."""
+    out = []
+    for text, created_at in rows:
+        digest = prompt_hash(text)
+        row = conn.execute("INSERT INTO history (prompt, created_at, prompt_hash) VALUES (?, ?, ?) "
+                           "ON CONFLICT(prompt_hash) DO NOTHING RETURNING id", (text, created_at, digest)).fetchone()
+        if row is not None:
+            out.append((row[0], False))
+        else:
+            out.append((conn.execute("SELECT id FROM history WHERE prompt_hash = ?", (digest,)).fetchone()[0], True))
+    return out
+
+def _history_write_failed(e: Exception, lost: int):
+    log.error("history batch write failed: %s", e, extra={"fields": {"unacknowledged_rows_lost": lost}})
+
+history_writer = BatchWriter(db, _history_insert_batch, max_batch=HISTORY_BATCH_MAX,
+                             max_delay=HISTORY_BATCH_DELAY_MS / 1000, on_error=_history_write_failed)
+
+def _fts_query(q: str) -> Optional[str]:
+    """User text -> FTS5 query: every word must match, the last one as a prefix."""
+    words = re.findall(r"\w+", q)
+    if not words:
+        return None
+    return " ".join(f'"{w}"' for w in words[:-1]) + (" " if len(words) > 1 else "") + f'"{words[-1]}"*'
+
+def _history_page(conn: sqlite3.Connection, etag: Optional[str], before_id: Optional[int],
+                  since_id: Optional[int], limit: int, q: str):
+    """Keyset page, newest first. Rows are only ever appended (higher ids) or
+    pruned from the oldest end, so (min id, max id) identifies the table state
+    and makes a cheap ETag. -> (etag, rows, max id); rows is None when the
+    client's `etag` is still current."""
+    lo, hi = conn.execute("SELECT MIN(id), MAX(id) FROM history").fetchone()
+    tag = f'W/"h{lo or 0}-{hi or 0}"'
+    if etag == tag:
+        return tag, None, hi
+    fts = bool(q) and HISTORY_FTS
+    key = "rowid" if fts else "id"
+    where, args = [], []
+    if before_id is not None:
+        where.append(f"{key} < ?"); args.append(before_id)
+    if since_id is not None:
+        where.append(f"{key} > ?"); args.append(since_id)
+    if fts:
+        match = _fts_query(q)
+        if match is None:
+            return tag, [], hi
+        # Walk the index newest-first and stop at limit+1 matches.
+        sql = ("SELECT h.id, h.prompt, h.created_at FROM history h JOIN ("
+               f"SELECT rowid FROM history_fts WHERE {' AND '.join(['history_fts MATCH ?'] + where)} "
+               "ORDER BY rowid DESC LIMIT ?) m ON h.id = m.rowid ORDER BY h.id DESC")
+        return tag, conn.execute(sql, (match, *args, limit + 1)).fetchall(), hi
+    if q:
+        where.append("prompt LIKE ? ESCAPE '\\'")
+        args.append("%" + re.sub(r"([\\%_])", r"\\\1", q) + "%")
+    sql = "SELECT id, prompt, created_at FROM history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    rows = conn.execute(sql + " ORDER BY id DESC LIMIT ?", (*args, limit + 1)).fetchall()
+    return tag, rows, hi
 
 @app.post("/save")
 async def save(item: Dict[str, Any]):
+    """Queued for the group-commit writer. With HISTORY_SAVE_ACK=commit (default)
+    the reply waits for the batch to commit and carries the new row's id; with
+    `queued` it returns at once (id null) and a failed write is only logged."""
     text = (item or {}).get("prompt", "").strip()
     if not text: return {"ok": False, "error": "Empty prompt."}
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT INTO history (prompt, created_at) VALUES (?, ?)", (text, now_tz().strftime("%Y-%m-%d %H:%M")))
-    conn.commit(); conn.close()
-    return {"ok": True}
+    created_at = now_tz().strftime("%Y-%m-%d %H:%M")
+    saved = await history_writer.submit((text, created_at), wait=HISTORY_SAVE_ACK != "queued")
+    row_id, duplicate = saved or (None, False)
+    return {"ok": True, "duplicate": duplicate, "item": {"id": row_id, "prompt": text, "created_at": created_at}}
 
 @app.get("/history")
-async def history():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    rows = conn.execute("SELECT prompt, created_at FROM history ORDER BY id DESC LIMIT 50").fetchall()
-    conn.close()
-    return {"items": [dict(r) for r in rows]}
+async def history(request: Request,
+                  before_id: Optional[int] = Query(None, ge=1, description="page: rows older than this id"),
+                  since_id: Optional[int] = Query(None, ge=0, description="delta: rows newer than this id"),
+                  limit: int = Query(50, ge=1, le=200),
+                  q: str = Query("", max_length=200, description="full-text search")):
+    """Newest first. `next_before_id` continues the listing (null at the end);
+    with `since_id`, `more: true` means more than `limit` rows arrived and the
+    client should reload instead. Revalidate with If-None-Match."""
+    etag, rows, latest = await db.run(_history_page, request.headers.get("if-none-match"),
+                                      before_id, since_id, limit, q.strip())
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if rows is None:
+        return Response(status_code=304, headers=headers)
+    more = len(rows) > limit
+    items = [dict(r) for r in rows[:limit]]
+    return JSONResponse({"items": items, "latest_id": latest or 0, "more": more,
+                         "next_before_id": items[-1]["id"] if more else None}, headers=headers)
 
 @app.get("/health")
 async def health():
-    info: Dict[str, Any] = {"ok": True, "enable_gpt": ENABLE_GPT, "mode": ("paid_credits" if ROLLOVER_MODE else "free_daily_cap")}
+    info: Dict[str, Any] = {"ok": True, "enable_gpt": ENABLE_GPT, "mode": QUOTA_MODE}
     if ROLLOVER_MODE:
         info.update({"initial_credits": INITIAL_CREDITS, "max_balance": MAX_BALANCE})
     else:
         info.update({"limit": DAILY_FREE_LIMIT})
+    info["upstream_pool"] = upstream_pool_stats()
+    if CACHE_ENABLED:
+        info["enhance_cache"] = response_cache.stats()
+    info["enhance_inflight"] = enhance_inflight.stats()
+    info["upstream_limiter"] = upstream_limiter.stats()
+    info["upstreams"] = upstream_router.stats()
+    info["history_writer"] = history_writer.stats()
+    info["status_board"] = status_board.stats()
+    if quota_store is not None:
+        info["quota_store"] = quota_store.stats()
+    if CACHE_ENABLED and SIMILARITY_ENABLED:
+        info["similarity_index"] = similar_index.stats()
     return info
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """Prometheus text format. With several workers this is the merge of every
+    worker's last snapshot (this worker's is refreshed first): counters and
+    histograms summed, gauges labelled by worker pid."""
+    if not SHARED_STATE:
+        text = metrics.render()
+    else:
+        await db.run(_metrics_put, WORKER_ID, json.dumps(metrics.snapshot()))
+        stale_before = metrics_stale_before()
+        parts = []
+        for r in await db.run(_metrics_all):
+            families = json.loads(r["data"])
+            if r["updated_at"] < stale_before:   # gone quiet: keep its counters, not its gauges
+                families = [f for f in families if f["kind"] != "gauge"]
+            parts.append((r["worker"], families))
+        text = render(merge(parts))
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def _admin_denied(request: Request) -> Optional[JSONResponse]:
+    """None if the request carries ADMIN_TOKEN; admin routes 404 while no token is configured."""
+    if not ADMIN_TOKEN:
+        return JSONResponse({"ok": False, "error": "Not Found"}, status_code=404)
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        return JSONResponse({"ok": False, "error": "Forbidden."}, status_code=403)
+    return None
+
+_profile_lock = asyncio.Lock()
+
+@app.post("/admin/profile", include_in_schema=False)
+async def admin_profile(request: Request, seconds: float = Query(10, gt=0), interval_ms: float = Query(5, ge=1)):
+    """Sample all threads for `seconds` and return collapsed stacks (flamegraph.pl /
+    speedscope input). The sampler runs off the event loop; one profile at a time."""
+    denied = _admin_denied(request)
+    if denied is not None:
+        return denied
+    if _profile_lock.locked():
+        return JSONResponse({"ok": False, "error": "A profile is already running."}, status_code=409)
+    async with _profile_lock:
+        seconds = min(seconds, PROFILE_MAX_SECONDS)
+        log.info("profile started", extra={"fields": {"seconds": seconds, "interval_ms": interval_ms}})
+        text = await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000)
+    return PlainTextResponse(text)
+
+@app.get("/status")
+async def status(request: Request):
+    """Mode, limits and the caller's usage or credits in one call. Served from a
+    per-IP cache (STATUS_CACHE_TTL) that charges, refunds and the daily reset refresh."""
+    return {"mode": QUOTA_MODE, "enable_gpt": ENABLE_GPT, **(await status_board.get(_get_ip(request)))}
+
+@app.get("/status/stream")
+async def status_stream(request: Request):
+    """SSE: a `status` event on connect, then whenever the caller's quota changes
+    (charge, refund, daily reset). Comment heartbeats every STATUS_KEEPALIVE
+    seconds; with several workers the heartbeat also re-reads the cached status,
+    since charges made by another worker aren't pushed here. The stream ends
+    when the server shuts down (EventSource reconnects on its own)."""
+    ip = _get_ip(request)
+
+    async def events():
+        q = status_board.subscribe(ip)
+        stop = asyncio.ensure_future(shutting_down.wait())
+        try:
+            last = await status_board.get(ip)
+            yield sse("status", {"mode": QUOTA_MODE, **last})
+            # Spread the midnight reload of every open stream over a few seconds.
+            reset_at = next_midnight_tz().timestamp() + random.uniform(0, 5)
+            while not stop.done():
+                getter = asyncio.ensure_future(q.get())
+                await asyncio.wait((getter, stop), timeout=max(0.0, min(STATUS_KEEPALIVE, reset_at - time.time())),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    status = getter.result()
+                else:
+                    getter.cancel()
+                    if stop.done():
+                        break
+                    if time.time() >= reset_at:
+                        reset_at = next_midnight_tz().timestamp() + random.uniform(0, 5)
+                        status = await status_board.get(ip)   # cache entries expire at midnight
+                    elif SHARED_STATE:
+                        status = await status_board.get(ip)
+                    else:
+                        status = last
+                if status == last:
+                    yield ": keepalive\n\n"
+                    continue
+                last = status
+                yield sse("status", {"mode": QUOTA_MODE, **status})
+        finally:
+            stop.cancel()
+            status_board.unsubscribe(ip, q)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @app.get("/usage_today")
 async def usage_today(request: Request):
     ip = _get_ip(request)
-    return get_usage_status(ip)
+    return await get_usage_status(ip)
 
 @app.get("/credits_status")
 async def credits_status(request: Request):
     ip = _get_ip(request)
-    return wallet_status(ip)
+    return await wallet_status(ip)
+
+@asynccontextmanager
+async def cli_enhancer():
+    """Upstream access for the offline CLI: shared backends, cache and single-flight,
+    no per-IP metering or near-duplicate suggestions."""
+    open_upstreams()
+    async def enhance_one(prompt: str) -> str:
+        plan = plan_enhance(EnhancePayload(prompt=prompt))   # OverBudget becomes the record's enhance_error
+        cached = await response_cache.get(plan.key) if CACHE_ENABLED else None
+        if cached is not None:
+            return cached
+        started = time.perf_counter()
+        out = await enhance_inflight.do(plan.key, lambda: upstream_enhance(plan.prompt, plan.key, plan.max_tokens))
+        observe_tokens(plan, token_counter.count(out), time.perf_counter() - started)
+        return out
+    try:
+        yield enhance_one
+    finally:
+        await close_upstreams()
 
-if __name__ == "__main__":
+def serve(argv: List[str]) -> int:
+    """Production entry point: N uvicorn worker processes behind one socket."""
+    import argparse
     import uvicorn
-    print("DEBUG:",
-          "MODE=", "PAID" if ROLLOVER_MODE else "FREE",
-          "| DAILY_FREE_LIMIT=", DAILY_FREE_LIMIT,
-          "| INITIAL_CREDITS=", INITIAL_CREDITS,
-          "| DAILY_GRANT=", DAILY_GRANT,
-          "| MAX_BALANCE=", MAX_BALANCE,
-          "| DB=", DB_PATH)
-    uvicorn.run("prompt_wizard:app", host="127.0.0.1", port=8000, reload=True)
-
-
-
-
-
-
+    ap = argparse.ArgumentParser(prog="python -m prompt_wizard serve", description="Run the app with worker processes.")
+    ap.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    ap.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--max-requests", type=int, default=0, help="recycle a worker after this many requests (0 = never)")
+    ap.add_argument("--graceful-timeout", type=float, default=30, help="seconds to finish in-flight requests on shutdown")
+    ap.add_argument("--keep-alive", type=int, default=5, help="HTTP keep-alive timeout (seconds)")
+    ap.add_argument("--forwarded-allow-ips", default=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"))
+    args = ap.parse_args(argv)
+    workers = max(args.workers, 1)
+    if args.max_requests and workers == 1:
+        log.warning("--max-requests needs --workers >= 2 (a single process has no supervisor to restart it); ignoring.")
+        args.max_requests = 0
+
+    # Workers inherit the environment; migrations already ran in this process at import.
+    os.environ["WORKERS"] = str(workers)
+    db.close()
+    log.info("serving", extra={"fields": {"host": args.host, "port": args.port, "workers": workers,
+                                          "max_requests": args.max_requests, "db": DB_PATH}})
+    uvicorn.run("prompt_wizard:app", host=args.host, port=args.port, workers=workers,
+                limit_max_requests=args.max_requests or None, timeout_graceful_shutdown=args.graceful_timeout,
+                timeout_keep_alive=args.keep_alive, proxy_headers=True, forwarded_allow_ips=args.forwarded_allow_ips,
+                access_log=False, log_level=LOG_LEVEL.lower())
+    return 0
 
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:2] == ["serve"]:
+        sys.exit(serve(sys.argv[2:]))
+    if sys.argv[1:2] == ["build"]:
+        import bulk
+        # Workers only render templates; stop the DB threads before forking them.
+        db.close()
+        sys.exit(bulk.main(sys.argv[2:], GOALS_FILE,
+                           enhancer=cli_enhancer if GPT_READY else None))
 
+    import uvicorn
+    log.info("starting", extra={"fields": {
+        "mode": "PAID" if ROLLOVER_MODE else "FREE",
+        "daily_free_limit": DAILY_FREE_LIMIT,
+        "initial_credits": INITIAL_CREDITS,
+        "daily_grant": DAILY_GRANT,
+        "max_balance": MAX_BALANCE,
+        "db": DB_PATH,
+    }})
+    uvicorn.run("prompt_wizard:app", host="127.0.0.1", port=8000, reload=True)
@@ -0,0 +1,249 @@
+"""
+Hot quota state — free-tier counters and credit wallets of active callers held
+in memory, with dirty entries written back to SQLite in periodic batches.
+
+Every check, spend and refund is served from memory; the database is only
+read the first time a caller is seen (or after their entry was evicted) and
+written once per `flush_interval` for all callers that changed. Write-backs
+are deltas (`count + n`, `balance + n`), so rows are never overwritten with a
+stale absolute value.
+
+Durability: a crash loses at most the last `flush_interval` seconds of
+changes (spent credits come back, used free requests are forgotten). A clean
+shutdown flushes everything (`aclose()`). Only one process may own the state:
+with several workers each would enforce limits on its own copy, so the app
+uses the SQLite path there instead.
+"""
+
+import asyncio
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class Usage:
+    __slots__ = ("count", "delta")
+
+    def __init__(self, count: int):
+        self.count = count
+        self.delta = 0
+
+    @property
+    def dirty(self) -> bool:
+        return self.delta != 0
+
+
+class Wallet:
+    __slots__ = ("balance", "last_grant_day", "delta", "granted")
+
+    def __init__(self, balance: int, last_grant_day: Optional[str]):
+        self.balance = balance
+        self.last_grant_day = last_grant_day
+        self.delta = 0
+        self.granted = False   # last_grant_day moved since the last write-back
+
+    @property
+    def dirty(self) -> bool:
+        return self.delta != 0 or self.granted
+
+
+class QuotaStore:
+    """`load_usage(conn, ip, day) -> count`, `load_wallet(conn, ip) -> (balance,
+    last_grant_day)` (creating the wallet if needed) and `write_back(conn,
+    usage_rows, wallet_rows)` run on the `db` pool; rows are `(ip, day, delta)`
+    and `(ip, delta, last_grant_day)`. `today()` gives the current quota day.
+    """
+
+    def __init__(self, db, load_usage: Callable, load_wallet: Callable, write_back: Callable,
+                 today: Callable[[], str], free_limit: int, daily_grant: int, max_balance: int,
+                 max_items: int = 100000, flush_interval: float = 1.0,
+                 on_error: Optional[Callable[[Exception], None]] = None):
+        self.db = db
+        self.load_usage = load_usage
+        self.load_wallet = load_wallet
+        self.write_back = write_back
+        self.today = today
+        self.free_limit = free_limit
+        self.daily_grant = daily_grant
+        self.max_balance = max_balance
+        self.max_items = max(max_items, 1)
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self._mem: Dict[str, OrderedDict] = {"usage": OrderedDict(), "wallet": OrderedDict()}
+        self._evicted: Dict[str, Dict[Any, Any]] = {"usage": {}, "wallet": {}}   # dirty, awaiting write-back
+        self._flushing: set = set()   # entries whose deltas the running write-back is committing
+        self._loading: Dict[Tuple[str, Any], asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+
+    # ---- entries ----
+    async def _get(self, kind: str, key: Any):
+        mem = self._mem[kind]
+        entry = mem.get(key)
+        if entry is not None:
+            mem.move_to_end(key)
+            self.hits += 1
+            return entry
+        entry = self._evicted[kind].pop(key, None)
+        if entry is not None:   # came back before its write-back: it is still the truth
+            self._insert(kind, key, entry)
+            return entry
+        task = self._loading.get((kind, key))
+        if task is None:
+            task = self._loading[(kind, key)] = asyncio.ensure_future(self._load(kind, key))
+            task.add_done_callback(lambda _t, k=(kind, key): self._loading.pop(k, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, kind: str, key: Any):
+        self.loads += 1
+        if kind == "usage":
+            entry: Any = Usage(await self.db.run(self.load_usage, *key))
+        else:
+            entry = Wallet(*await self.db.run(self.load_wallet, key))
+        self._insert(kind, key, entry)
+        return entry
+
+    def _insert(self, kind: str, key: Any, entry: Any):
+        mem = self._mem[kind]
+        mem[key] = entry
+        mem.move_to_end(key)
+        while len(mem) > self.max_items:
+            old_key, old = mem.popitem(last=False)
+            self.evictions += 1
+            # An entry being flushed looks clean, but SQLite doesn't have its
+            # delta until the write-back commits: reloading it now would miss it.
+            if old.dirty or old in self._flushing:
+                self._evicted[kind][old_key] = old
+
+    def _grant(self, w: Wallet):
+        """Same arithmetic as the SQL lazy grant: whole days since the last grant
+        times daily_grant, capped at max_balance."""
+        today = self.today()
+        if self.daily_grant <= 0 or w.last_grant_day is None or w.last_grant_day >= today:
+            return
+        days = (date.fromisoformat(today) - date.fromisoformat(w.last_grant_day)).days
+        balance = min(w.balance + days * self.daily_grant, self.max_balance)
+        w.delta += balance - w.balance
+        w.balance = balance
+        w.last_grant_day = today
+        w.granted = True
+
+    # ---- free tier ----
+    async def use_free(self, ip: str) -> bool:
+        if self.free_limit <= 0:
+            return False
+        u = await self._get("usage", (ip, self.today()))
+        if u.count >= self.free_limit:
+            return False
+        u.count += 1
+        u.delta += 1
+        return True
+
+    async def usage_count(self, ip: str) -> int:
+        return (await self._get("usage", (ip, self.today()))).count
+
+    async def refund_free(self, ip: str):
+        u = await self._get("usage", (ip, self.today()))
+        if u.count > 0:
+            u.count -= 1
+            u.delta -= 1
+
+    # ---- wallets ----
+    async def balance(self, ip: str) -> int:
+        w = await self._get("wallet", ip)
+        self._grant(w)
+        return w.balance
+
+    async def spend(self, ip: str, n: int = 1) -> bool:
+        w = await self._get("wallet", ip)
+        self._grant(w)
+        if w.balance < n:
+            return False
+        w.balance -= n
+        w.delta -= n
+        return True
+
+    async def refund(self, ip: str, n: int = 1):
+        w = await self._get("wallet", ip)
+        w.balance += n
+        w.delta += n
+
+    # ---- write-back ----
+    async def flush(self) -> int:
+        """Write every dirty entry in one transaction; returns the rows written.
+        Deltas are taken before the write, so changes made meanwhile wait for
+        the next flush; on failure they are put back. Until the write commits
+        the entries stay the truth, so eviction keeps them in `_evicted`."""
+        async with self._flush_lock:
+            usage: List[tuple] = []
+            wallets: List[tuple] = []
+            taken: List[tuple] = []
+            for kind in ("usage", "wallet"):
+                for key, e in [*self._mem[kind].items(), *self._evicted[kind].items()]:
+                    if not e.dirty:
+                        continue
+                    if kind == "usage":
+                        usage.append((key[0], key[1], e.delta))
+                    else:
+                        wallets.append((key, e.delta, e.last_grant_day))
+                    taken.append((e, e.delta, getattr(e, "granted", False)))
+                    e.delta = 0
+                    if kind == "wallet":
+                        e.granted = False
+            if not taken:
+                return 0
+            self._flushing = {e for e, _, _ in taken}
+            try:
+                await self.db.run(self.write_back, usage, wallets)
+            except Exception as exc:
+                self.flush_errors += 1
+                for e, delta, granted in taken:
+                    e.delta += delta
+                    if granted:
+                        e.granted = True
+                if self.on_error is not None:
+                    self.on_error(exc)
+                return 0
+            finally:
+                self._flushing = set()
+            for kind in ("usage", "wallet"):
+                evicted = self._evicted[kind]
+                for key in [k for k, e in evicted.items() if not e.dirty]:
+                    del evicted[key]
+            self.flushes += 1
+            self.flushed_rows += len(taken)
+            return len(taken)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def aclose(self):
+        """Stop the periodic flush and write back everything still dirty."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def dirty(self) -> int:
+        return sum(1 for table in (*self._mem.values(), *self._evicted.values()) for e in table.values() if e.dirty)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"usage_items": len(self._mem["usage"]), "wallet_items": len(self._mem["wallet"]),
+                "dirty": self.dirty(), "hits": self.hits, "loads": self.loads, "evictions": self.evictions,
+                "flushes": self.flushes, "flushed_rows": self.flushed_rows, "flush_errors": self.flush_errors,
+                "flush_interval_s": self.flush_interval}
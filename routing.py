@@ -0,0 +1,325 @@
+"""
+Multi-upstream routing — several OpenAI-compatible backends with weights,
+per-backend latency tracking and circuit breakers, plus hedged requests.
+
+Each call goes to the healthy backend with the best score (EWMA latency,
+inflated by its in-flight load, divided by its weight). If that call hasn't
+produced response headers within the backend's rolling p95, a hedged
+duplicate goes to the next-best backend; the first usable answer wins and the
+other leg is cancelled. A failed leg fails over to another backend right away.
+Every leg holds its own slot in the shared `AdaptiveLimiter`; hedges only take
+a free slot and never queue.
+"""
+
+import asyncio
+import json
+import math
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import httpx
+
+from upstream import AdaptiveLimiter, Lease, Overloaded
+
+FAILURE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failures; after `reset_timeout`
+    one probe is let through (half-open) and its outcome closes or re-opens it."""
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+
+    def available(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return not self._probing
+
+    def on_attempt(self):
+        if self.state == "open" and self.available():
+            self.state = "half_open"
+        if self.state == "half_open":
+            self._probing = True
+
+    def cancelled(self):
+        """A probe was abandoned before it produced an outcome; allow another."""
+        self._probing = False
+
+    def success(self):
+        self.state, self.failures, self._probing = "closed", 0, False
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.opens += 1
+            self.state, self.opened_at, self._probing = "open", time.monotonic(), False
+
+    def reopens_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+
+class Backend:
+    def __init__(self, name: str, base_url: str, model: str, api_key: Optional[str] = None,
+                 weight: float = 1.0, org: Optional[str] = None, window: int = 200,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.weight = max(float(weight), 0.001)
+        self.org = org
+        self.client: Optional[httpx.AsyncClient] = None   # set by the app at startup
+        self.breaker = breaker or CircuitBreaker()
+        self.in_flight = 0
+        self.requests = self.failures = 0
+        self._latency: Dict[str, deque] = {"plain": deque(maxlen=window), "stream": deque(maxlen=window)}
+        self._ewma: Dict[str, Optional[float]] = {"plain": None, "stream": None}
+        self._updated: Dict[str, float] = {"plain": 0.0, "stream": 0.0}
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        if self.org:
+            headers["OpenAI-Organization"] = self.org
+        return headers
+
+    def record(self, mode: str, latency: Optional[float], ok: bool):
+        self.requests += 1
+        if not ok:
+            self.failures += 1
+            self.breaker.failure()
+            return
+        self.breaker.success()
+        if latency is None:
+            return
+        self._latency[mode].append(latency)
+        prev = self._ewma[mode]
+        self._ewma[mode] = latency if prev is None else prev + 0.3 * (latency - prev)
+        self._updated[mode] = time.monotonic()
+
+    def record_cancelled(self, mode: str, elapsed: float):
+        """A leg abandoned after `elapsed` seconds (usually a lost hedge race): its
+        latency is at least that. Raises the EWMA to it and marks it fresh, so a
+        slow backend that keeps losing hedges stops being re-probed as "unknown"
+        on every pick; the p95 window only takes complete samples."""
+        prev = self._ewma[mode]
+        self._ewma[mode] = elapsed if prev is None else max(prev, elapsed)
+        self._updated[mode] = time.monotonic()
+
+    def p95(self, mode: str, min_samples: int = 20) -> Optional[float]:
+        window = self._latency[mode]
+        if len(window) < min_samples:
+            return None
+        ordered = sorted(window)
+        return ordered[math.ceil(0.95 * len(ordered)) - 1]
+
+    def score(self, mode: str, stale_after: float) -> float:
+        """Lower is better. Unknown or stale latency scores 0 so the backend gets re-probed."""
+        ewma = self._ewma[mode]
+        if ewma is None or time.monotonic() - self._updated[mode] > stale_after:
+            ewma = 0.0
+        return ewma * (1 + self.in_flight) / self.weight
+
+    def stats(self) -> Dict[str, Any]:
+        return {"name": self.name, "model": self.model, "weight": self.weight, "state": self.breaker.state,
+                "in_flight": self.in_flight, "requests": self.requests, "failures": self.failures,
+                "ewma_s": {m: (round(v, 3) if v is not None else None) for m, v in self._ewma.items()},
+                "p95_s": {m: (round(v, 3) if (v := self.p95(m)) is not None else None) for m in self._latency}}
+
+
+def load_backends(raw: Optional[str], default: Dict[str, Any],
+                  make_breaker: Callable[[], CircuitBreaker] = CircuitBreaker) -> List[Backend]:
+    """UPSTREAMS is a JSON list of {name, base_url, model?, api_key?, weight?, org?};
+    missing fields come from `default` (the single OPENAI_* backend)."""
+    if not raw:
+        return [Backend(name="default", breaker=make_breaker(), **default)]
+    backends = []
+    for i, entry in enumerate(json.loads(raw)):
+        cfg = {**default, **{k: v for k, v in entry.items() if k != "name"}}
+        backends.append(Backend(name=entry.get("name") or f"upstream{i}", breaker=make_breaker(), **cfg))
+    if not backends:
+        raise ValueError("UPSTREAMS must list at least one backend")
+    return backends
+
+
+class Attempt:
+    """One winning leg. Plain attempts are finished on return; stream attempts
+    hold their limiter slot until `aclose()`."""
+
+    def __init__(self, router: "Router", backend: Backend, mode: str, lease: Lease,
+                 response: httpx.Response, started: float):
+        self.router = router
+        self.backend = backend
+        self.mode = mode
+        self.lease = lease
+        self.response = response
+        self.started = started
+        self.closed = False
+
+    @property
+    def ok(self) -> bool:
+        return self.response.status_code not in FAILURE_STATUS
+
+    async def aclose(self, failed: bool = False):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.response.aclose()
+        finally:
+            if failed:
+                self.backend.record(self.mode, None, False)
+            self.router._finish(self, failed)
+
+
+class Router:
+    def __init__(self, backends: List[Backend], limiter: AdaptiveLimiter, hedge: bool = True,
+                 hedge_min_delay: float = 0.25, stale_after: float = 30.0,
+                 observer: Optional[Callable[[str, str, str, float], None]] = None):
+        self.backends = backends
+        self.limiter = limiter
+        self.hedge = hedge and len(backends) > 1
+        self.hedge_min_delay = hedge_min_delay
+        self.stale_after = stale_after
+        self.observer = observer   # (backend, mode, status, seconds) per leg
+        self.hedges = self.hedge_wins = self.failovers = 0
+
+    def pick(self, mode: str, exclude: Iterable[Backend] = ()) -> Optional[Backend]:
+        excluded = set(map(id, exclude))
+        candidates = [b for b in self.backends if id(b) not in excluded and b.breaker.available()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: (b.score(mode, self.stale_after), b.in_flight / b.weight))
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(min(b.breaker.reopens_in() for b in self.backends)))
+
+    def hedge_delay(self, backend: Backend, mode: str) -> Optional[float]:
+        if not self.hedge:
+            return None
+        p95 = backend.p95(mode)
+        if p95 is None:   # new or re-probed backend: borrow the best known p95
+            p95 = min((p for b in self.backends if (p := b.p95(mode)) is not None), default=None)
+        return None if p95 is None else max(p95, self.hedge_min_delay)
+
+    async def _leg(self, backend: Backend, body: Dict[str, Any], stream: bool, hedge: bool) -> Attempt:
+        lease = await self.limiter.acquire(wait=not hedge)
+        mode = "stream" if stream else "plain"
+        backend.breaker.on_attempt()
+        backend.in_flight += 1
+        started = time.monotonic()
+        try:
+            request = backend.client.build_request("POST", "/chat/completions", json={**body, "model": backend.model})
+            response = await backend.client.send(request, stream=stream)
+        except asyncio.CancelledError:   # lost a hedge race, or the caller went away
+            backend.in_flight -= 1
+            backend.breaker.cancelled()
+            backend.record_cancelled(mode, time.monotonic() - started)
+            self.limiter.release(lease)
+            self._observe(backend, mode, "cancelled", started)
+            raise
+        except BaseException:
+            backend.in_flight -= 1
+            backend.record(mode, None, False)
+            self.limiter.release(lease, failed=True)
+            self._observe(backend, mode, "error", started)
+            raise
+        lease.observe(response.status_code)
+        ok = response.status_code not in FAILURE_STATUS
+        backend.record(mode, lease.latency if ok else None, ok)
+        attempt = Attempt(self, backend, mode, lease, response, started)
+        if not stream:
+            attempt.closed = True
+            self._finish(attempt, False)
+        return attempt
+
+    def _finish(self, attempt: Attempt, failed: bool):
+        attempt.backend.in_flight -= 1
+        self.limiter.release(attempt.lease, failed)
+        self._observe(attempt.backend, attempt.mode, "error" if failed else str(attempt.response.status_code),
+                      attempt.started)
+
+    def _observe(self, backend: Backend, mode: str, status: str, started: float):
+        if self.observer is not None:
+            self.observer(backend.name, mode, status, time.monotonic() - started)
+
+    async def send(self, body: Dict[str, Any], stream: bool = False) -> Attempt:
+        """Run one (possibly hedged) call and return the first usable attempt, or
+        the last failed one when every backend tried failed with a status.
+        Transport errors propagate when no leg succeeded."""
+        mode = "stream" if stream else "plain"
+        primary = self.pick(mode)
+        if primary is None:
+            raise Overloaded(self.retry_after(), "no healthy upstream")
+        tried: List[Backend] = []
+        legs: Dict[asyncio.Task, bool] = {}   # task -> is a hedge
+
+        def launch(backend: Backend, hedge: bool):
+            tried.append(backend)
+            legs[asyncio.ensure_future(self._leg(backend, body, stream, hedge))] = hedge
+
+        launch(primary, hedge=False)
+        delay = self.hedge_delay(primary, mode)
+        fallback: Optional[Attempt] = None
+        error: Optional[BaseException] = None
+        try:
+            while legs:
+                done, _ = await asyncio.wait(legs, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:   # primary is slower than its p95: hedge once
+                    delay = None
+                    second = self.pick(mode, exclude=tried)
+                    if second is not None:
+                        self.hedges += 1
+                        launch(second, hedge=True)
+                    continue
+                for task in done:
+                    hedge = legs.pop(task)
+                    exc = task.exception()
+                    if exc is None:
+                        attempt = task.result()
+                        if attempt.ok:
+                            self.hedge_wins += hedge
+                            if fallback is not None:
+                                await fallback.aclose()
+                            return attempt
+                        if fallback is not None:
+                            await fallback.aclose()
+                        fallback = attempt
+                    elif isinstance(exc, Overloaded):
+                        if not hedge:
+                            raise exc   # queue full / wait timed out: no point trying elsewhere
+                        continue        # hedge found no free slot; keep waiting on the primary
+                    else:
+                        error = exc
+                if not legs:   # every leg failed: fail over to an untried backend
+                    delay = None
+                    nxt = self.pick(mode, exclude=tried)
+                    if nxt is not None:
+                        self.failovers += 1
+                        launch(nxt, hedge=False)
+            if fallback is not None:
+                return fallback
+            raise error
+        finally:
+            for task in legs:
+                task.cancel()
+            for result in await asyncio.gather(*legs, return_exceptions=True):
+                if isinstance(result, Attempt):
+                    await result.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hedging": self.hedge, "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+                "failovers": self.failovers, "backends": [b.stats() for b in self.backends]}
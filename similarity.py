@@ -0,0 +1,214 @@
+"""
+Near-duplicate lookup for /enhance inputs — text normalization, MinHash
+signatures and an LSH band index.
+
+Prompts are normalized (Unicode NFKC, case-folded, reduced to word tokens) and
+cut into overlapping word shingles. A signature keeps, for each of `num_perm`
+hash functions, the smallest hash over the shingles; the fraction of equal
+positions in two signatures estimates the Jaccard similarity of their shingle
+sets. The index splits each signature into `bands` bands and files the entry
+under every band's hash, so a lookup only compares the few entries that share
+at least one band with the query (with 16 bands of 4, pairs at 0.8 similarity
+share one with probability > 0.999, pairs at 0.3 about 12% of the time).
+
+Entries are bounded (oldest go first); persistence is left to the caller, who
+stores `(key, signature.tobytes())` and feeds them back to `load()`.
+"""
+
+import hashlib
+import re
+import struct
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+_WORD = re.compile(r"\w+")
+_GROUP = 16   # uint32 hash values per 64-byte blake2b digest
+
+
+def normalize(text: str) -> List[str]:
+    """Word tokens of `text`, ignoring case, width/compatibility forms, punctuation and spacing."""
+    return _WORD.findall(unicodedata.normalize("NFKC", text).casefold())
+
+
+def shingles(words: List[str], k: int = 3) -> set:
+    if len(words) <= k:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, shingle_size: int = 3):
+        if num_perm % _GROUP:
+            raise ValueError(f"num_perm must be a multiple of {_GROUP}")
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # Independent hash families: one keyed blake2b digest per 16 values.
+        self._persons = [b"pw-minhash-%d" % g for g in range(num_perm // _GROUP)]
+        self._unpack = struct.Struct(f"<{_GROUP}I").unpack
+
+    def _hashes(self, shingle: str) -> Tuple[int, ...]:
+        data = shingle.encode("utf-8")
+        out: Tuple[int, ...] = ()
+        for person in self._persons:
+            out += self._unpack(hashlib.blake2b(data, digest_size=64, person=person).digest())
+        return out
+
+    def signature(self, text: str) -> Optional[array]:
+        """None for text without any words."""
+        grams = shingles(normalize(text), self.shingle_size)
+        if not grams:
+            return None
+        return array("I", map(min, zip(*map(self._hashes, grams))))
+
+
+def signature_from_bytes(blob: bytes) -> array:
+    sig = array("I")
+    sig.frombytes(blob)
+    return sig
+
+
+def similarity(a: array, b: array) -> float:
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class SimilarityIndex:
+    """Bounded MinHash/LSH index from keys to signatures.
+
+    Memory is kept flat: signatures live in one contiguous array (a slot per
+    entry), and each band is a sorted array of `band hash << bits | slot`
+    values, so a band lookup is two bisections and an entry costs about
+    4 * num_perm + 8 * bands bytes plus its key. Adding an entry is an ordered
+    insert per band (fine at the rate upstream answers arrive); `load()` bulk-
+    builds. When full, the oldest slot is reused (FIFO).
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, max_items: int = 100000):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.hasher = MinHasher(num_perm)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_items = max(max_items, 1)
+        self._bits = self.max_items.bit_length()           # low bits of a band value: the slot
+        self._hash_mask = (1 << (63 - self._bits)) - 1
+        self._sigs = array("I")
+        self._keys: List[Optional[str]] = []
+        self._slots: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._next = 0                                     # next slot to reuse once full
+        self._bands = [array("q") for _ in range(bands)]
+        self.lookups = 0
+        self.matches = 0
+        self.evictions = 0
+
+    def signature(self, text: str) -> Optional[array]:
+        return self.hasher.signature(text)
+
+    def _band_keys(self, sig: array) -> List[int]:
+        # In-process hash of each band's bytes; the index is rebuilt on load, so
+        # it doesn't matter that str/bytes hashing is salted per process.
+        raw, w, mask, bits = sig.tobytes(), 4 * self.rows, self._hash_mask, self._bits
+        return [(hash(raw[i:i + w]) & mask) << bits for i in range(0, len(raw), w)]
+
+    def _sig(self, slot: int) -> array:
+        return self._sigs[slot * self.num_perm:(slot + 1) * self.num_perm]
+
+    def _place(self, key: str, sig: array, index: bool) -> int:
+        if self._free:
+            slot = self._free.pop()
+        elif len(self._keys) < self.max_items:
+            slot = len(self._keys)
+            self._keys.append(None)
+            self._sigs.extend(array("I", bytes(4 * self.num_perm)))
+        else:
+            slot = self._next
+            self._next = (slot + 1) % self.max_items
+            self._drop(slot, index)
+            self.evictions += 1
+        self._keys[slot] = key
+        self._slots[key] = slot
+        self._sigs[slot * self.num_perm:(slot + 1) * self.num_perm] = sig
+        if index:
+            for arr, band in zip(self._bands, self._band_keys(sig)):
+                insort(arr, band | slot)
+        return slot
+
+    def _drop(self, slot: int, index: bool = True):
+        key = self._keys[slot]
+        if key is None:
+            return
+        del self._slots[key]
+        self._keys[slot] = None
+        if index:
+            for arr, band in zip(self._bands, self._band_keys(self._sig(slot))):
+                i = bisect_left(arr, band | slot)
+                if i < len(arr) and arr[i] == band | slot:
+                    del arr[i]
+
+    def add(self, key: str, sig: array):
+        if key not in self._slots:
+            self._place(key, sig, index=True)
+
+    def load(self, entries: Iterable[Tuple[str, array]]):
+        """Bulk add (oldest first), then rebuild the band arrays in one sort each."""
+        for key, sig in entries:
+            if key not in self._slots:
+                self._place(key, sig, index=False)
+        values: List[List[int]] = [[] for _ in range(self.bands)]
+        for slot, key in enumerate(self._keys):
+            if key is not None:
+                for vals, band in zip(values, self._band_keys(self._sig(slot))):
+                    vals.append(band | slot)
+        self._bands = [array("q", sorted(vals)) for vals in values]
+
+    def remove(self, key: str):
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._drop(slot)
+            self._free.append(slot)
+
+    def items(self) -> Iterator[Tuple[str, array]]:
+        for slot, key in enumerate(self._keys):
+            if key is not None:
+                yield key, self._sig(slot)
+
+    def query(self, sig: array, threshold: float, exclude: Iterable[str] = (),
+              prefix: str = "") -> Optional[Tuple[str, float]]:
+        """Best entry with estimated similarity >= threshold, as (key, similarity);
+        only keys starting with `prefix` are considered."""
+        self.lookups += 1
+        skip = set(exclude)
+        step = 1 << self._bits
+        mask = step - 1
+        best: Optional[Tuple[str, float]] = None
+        seen = set()
+        for arr, band in zip(self._bands, self._band_keys(sig)):
+            lo = bisect_left(arr, band)
+            hi = bisect_left(arr, band + step, lo)
+            for value in arr[lo:hi]:
+                slot = value & mask
+                if slot in seen:
+                    continue
+                seen.add(slot)
+                key = self._keys[slot]
+                if key is None or key in skip or not key.startswith(prefix):
+                    continue
+                score = similarity(sig, self._sig(slot))
+                if score >= threshold and (best is None or score > best[1]):
+                    best = (key, score)
+        if best is not None:
+            self.matches += 1
+        return best
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._slots
+
+    def stats(self) -> Dict[str, Any]:
+        return {"items": len(self._slots), "capacity": self.max_items, "lookups": self.lookups,
+                "matches": self.matches, "evictions": self.evictions}
@@ -7,6 +7,8 @@ const output = $('#output');
 const outputConcise = $('#outputConcise');
 const msg = $('#msg');
 const historyDiv = $('#history');
+const historySearch = $('#historySearch');
+const historyMore = $('#historyMore');
 
 const LS_KEY = 'pw_presets_v1';
 
@@ -39,23 +41,67 @@ async function buildPrompt(e){
   }
 }
 
-async function enhanceField(fieldId){
+// Parse an SSE body from fetch() (EventSource can't POST); calls onEvent(name, data) per event.
+async function readSSE(r, onEvent){
+  const reader = r.body.getReader();
+  const dec = new TextDecoder();
+  let buf = '';
+  for(;;){
+    const { value, done } = await reader.read();
+    if(done) break;
+    buf += dec.decode(value, { stream:true });
+    let i;
+    while((i = buf.indexOf('\n\n')) >= 0){
+      const frame = buf.slice(0, i); buf = buf.slice(i + 2);
+      let name = 'message', data = '';
+      frame.split('\n').forEach(l=>{
+        if(l.startsWith('event:')) name = l.slice(6).trim();
+        else if(l.startsWith('data:')) data += l.slice(5).trim();
+      });
+      if(data) onEvent(name, JSON.parse(data));
+    }
+  }
+}
+
+// `fresh` skips the cache and near-duplicate suggestions (always calls the model).
+// The fresh answer always goes into the box; a suggestion is only offered.
+async function enhanceField(fieldId, fresh=false){
   const box = document.getElementById(fieldId);
   const text = (box?.value || '').trim();
   if(!text){ if(msg) msg.textContent='Nothing to enhance.'; return; }
+  const original = box.value;
   try{
     if(msg) msg.textContent = 'Enhancing…';
-    const r = await fetch('/enhance', {
+    const r = await fetch('/enhance_stream', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ prompt: text }),
+      body: JSON.stringify({ prompt: text, no_cache: fresh, goal: form?.goal?.value || null }),
     });
-    const data = await r.json();
-    if(!r.ok) throw new Error(data.error || `${r.status} ${r.statusText}`);
-    if(data.prompt) box.value = data.prompt;
-    if(msg) msg.textContent = 'Enhanced.';
-    if(data.usage)  updateUsageUI?.(data.usage);
-    if(data.credits)updateCreditsUI?.(data.credits);
+    if(!(r.headers.get('content-type') || '').includes('text/event-stream')){
+      const data = await r.json();
+      if(data.usage)  updateUsageUI?.(data.usage);
+      if(data.credits)updateCreditsUI?.(data.credits);
+      throw new Error(data.error || `${r.status} ${r.statusText}`);
+    }
+    let started = false, failed = null, suggestion = null, tokens = null;
+    await readSSE(r, (name, data)=>{
+      if(name === 'token'){
+        if(!started){ box.value = ''; started = true; }
+        box.value += data.t;
+        box.scrollTop = box.scrollHeight;
+      }else if(name === 'done' || name === 'error'){
+        if(data.usage)  updateUsageUI?.(data.usage);
+        if(data.credits)updateCreditsUI?.(data.credits);
+        if(name === 'done'){ if(data.prompt) box.value = data.prompt; suggestion = data.suggestion || null; tokens = data.tokens; }
+        else failed = data;
+      }
+    });
+    if(failed){
+      box.value = original;
+      throw new Error(failed.error || 'Enhance error');
+    }
+    if(msg) msg.textContent = tokens?.truncated ? `Enhanced (input shortened to ${tokens.input} tokens).` : 'Enhanced.';
+    if(suggestion) showSuggestion(fieldId, suggestion);
   }catch(err){
     console.error(err);
     if(msg) msg.textContent = (err && err.message) ? err.message : 'Enhance error';
@@ -70,25 +116,78 @@ async function saveItem(e){
   try{
     const r = await fetch('/save', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({ prompt: output?.value||'' })});
     const d = await r.json();
-    if(msg) msg.textContent = d.ok ? 'Saved.' : 'Error saving';
-    loadHistory();
+    if(msg) msg.textContent = d.ok ? (d.duplicate ? 'Already saved.' : 'Saved.') : 'Error saving';
+    if(d.ok && d.item && !d.duplicate && !historyQuery()) prependHistory(d.item);
   }catch(err){
     console.error(err);
     if(msg) msg.textContent = 'Save error';
   }
 }
 
+// History is paged by id (newest first): `historyLatest` is the newest id
+// shown, `historyNext` the cursor for "Load more". The browser revalidates
+// with the ETag, so an unchanged history costs a 304.
+let historyLatest = 0;
+let historyNext = null;
+let historyTimer = null;
+
+function historyQuery(){ return (historySearch?.value || '').trim(); }
+
+function historyItem(it){
+  const div=document.createElement('div'); div.className='item';
+  div.innerHTML=`<div class="small">${it.created_at}</div><pre style="white-space:pre-wrap;margin:0">${it.prompt}</pre>`;
+  return div;
+}
+
+// A successful /save echoes the row, so it is shown without re-fetching /history.
+function prependHistory(it){
+  if(!historyDiv) return;
+  historyDiv.prepend(historyItem(it));
+  if(it.id) historyLatest = Math.max(historyLatest, it.id);
+}
+
+async function fetchHistory(params){
+  const qs = new URLSearchParams(params);
+  const q = historyQuery();
+  if(q) qs.set('q', q);
+  const r = await fetch(`/history?${qs}`);
+  if(!r.ok) throw new Error(`${r.status}`);
+  return r.json();
+}
+
+function showMore(d){
+  historyNext = d.next_before_id;
+  if(historyMore) historyMore.style.display = historyNext ? '' : 'none';
+}
+
 async function loadHistory(){
   try{
-    const r = await fetch('/history');
-    const d = await r.json();
+    const d = await fetchHistory({});
     if(!historyDiv) return;
     historyDiv.innerHTML = '';
-    (d.items||[]).forEach(it=>{
-      const div=document.createElement('div'); div.className='item';
-      div.innerHTML=`<div class="small">${it.created_at}</div><pre style="white-space:pre-wrap;margin:0">${it.prompt}</pre>`;
-      historyDiv.appendChild(div);
-    });
+    (d.items||[]).forEach(it=> historyDiv.appendChild(historyItem(it)));
+    historyLatest = d.latest_id || 0;
+    showMore(d);
+  }catch(e){ /* ignore */ }
+}
+
+async function loadMoreHistory(){
+  if(!historyNext || !historyDiv) return;
+  try{
+    const d = await fetchHistory({ before_id: historyNext });
+    (d.items||[]).forEach(it=> historyDiv.appendChild(historyItem(it)));
+    showMore(d);
+  }catch(e){ /* ignore */ }
+}
+
+// Pick up rows saved elsewhere (other tabs/devices) without a full reload.
+async function syncHistory(){
+  if(!historyDiv || historyQuery()) return;
+  try{
+    const d = await fetchHistory({ since_id: historyLatest });
+    if(d.more) return loadHistory();
+    (d.items||[]).slice().reverse().forEach(prependHistory);
+    historyLatest = Math.max(historyLatest, d.latest_id || 0);
   }catch(e){ /* ignore */ }
 }
 
@@ -180,7 +279,7 @@ function startCountdown(elementId, resetIso){
   function tick(){
     const left=(target-Date.now())/1000;
     el.textContent='Resets in: '+formatHMS(left);
-    if(left<=0){ clearInterval(resetTimerInterval); refreshUsage?.(); refreshCredits?.(); }
+    if(left<=0){ clearInterval(resetTimerInterval); if(!statusLive()) refreshStatus(); }
   }
   tick(); resetTimerInterval=setInterval(tick,1000);
 }
@@ -192,63 +291,67 @@ function updateUsageUI(u){
   }
   if(u.reset_at) startCountdown('resetTimerUsage', u.reset_at);
 }
-async function refreshUsage(){
-  try{
-    const r=await fetch('/usage_today'); const u=await r.json();
-    updateUsageUI(u);
-  }catch(e){}
-}
 function updateCreditsUI(c){
   const tag=document.getElementById('creditsBadge'); if(!tag) return;
   tag.textContent=`Credits: ${c.balance}/${c.max_balance}`;
   if(c.reset_at) startCountdown('resetTimerCredits', c.reset_at);
 }
-async function refreshCredits(){
-  try{
-    const r=await fetch('/credits_status'); const c=await r.json();
-    updateCreditsUI(c);
-  }catch(e){}
+
+// The caller enhanced a near-duplicate of this prompt before; offer that answer
+// next to the fresh one. Nothing changes unless they pick it.
+function showSuggestion(fieldId, suggestion){
+  if(!msg) return;
+  msg.append(` You enhanced a ${Math.round((suggestion.similarity||0)*100)}% similar prompt before. `);
+  const btn = document.createElement('button');
+  btn.type = 'button'; btn.className = 'ghost'; btn.textContent = 'Use that answer';
+  btn.title = suggestion.prompt;
+  btn.addEventListener('click', (e)=>{
+    e.preventDefault();
+    const box = document.getElementById(fieldId);
+    if(box) box.value = suggestion.prompt;
+    btn.remove();
+  });
+  msg.appendChild(btn);
 }
 
-// Paid/free detection resilient to "paid" or "paid_credits"
-async function initModeBars(){
-  try{
-    const r = await fetch('/health');
-    const h = await r.json();
-    const mode = (h.mode||'').toLowerCase();
-    const isPaid = (mode === 'paid' || mode === 'paid_credits');
+// ---------- Live quota status ----------
+// One /status/stream per tab: the server pushes the caller's usage/credits on
+// every change and at the daily reset, so nothing polls on a timer. Without
+// EventSource, /status is fetched on load and when the tab regains focus.
+let statusStream = null;
 
-    const usageBar = document.getElementById('usageBar');
-    const creditsBar = document.getElementById('creditsBar');
+function statusLive(){ return !!statusStream && statusStream.readyState === 1; }
 
-    if(isPaid){
-      if(creditsBar) creditsBar.style.display = 'flex';
-      if(usageBar) usageBar.style.display = 'none';
-      refreshCredits();
-    }else{
-      if(usageBar) usageBar.style.display = 'flex';
-      if(creditsBar) creditsBar.style.display = 'none';
-      refreshUsage();
-    }
+function applyStatus(s){
+  const isPaid = (s.mode||'').toLowerCase().startsWith('paid');
+  const usageBar = document.getElementById('usageBar');
+  const creditsBar = document.getElementById('creditsBar');
+  if(usageBar) usageBar.style.display = isPaid ? 'none' : 'flex';
+  if(creditsBar) creditsBar.style.display = isPaid ? 'flex' : 'none';
+  if(s.usage) updateUsageUI(s.usage);
+  if(s.credits) updateCreditsUI(s.credits);
+}
+
+async function refreshStatus(){
+  try{
+    const r = await fetch('/status');
+    applyStatus(await r.json());
   }catch(e){
-    // fallback: try credits endpoint; if it returns balance, assume paid
-    try{
-      const r=await fetch('/credits_status');
-      if(r.ok){
-        const c=await r.json();
-        if(typeof c.balance === 'number'){
-          document.getElementById('creditsBar')?.style.setProperty('display','flex');
-          document.getElementById('usageBar')?.style.setProperty('display','none');
-          updateCreditsUI(c);
-          return;
-        }
-      }
-    }catch(_){}
     // default to free meter
     document.getElementById('usageBar')?.style.setProperty('display','flex');
   }
 }
 
+function initModeBars(){
+  if(!window.EventSource){
+    refreshStatus();
+    window.addEventListener('focus', refreshStatus);
+    return;
+  }
+  statusStream = new EventSource('/status/stream');   // reconnects by itself
+  statusStream.addEventListener('status', (ev)=> applyStatus(JSON.parse(ev.data)));
+}
+
 // ---------- Theme toggle ----------
 (function themeInit(){
   const root = document.documentElement;
@@ -302,11 +405,13 @@ document.getElementById('enhanceConciseBtn')?.addEventListener('click', (e)=>{ e
 document.getElementById('copyBtn')?.addEventListener('click', (e)=>{ e.preventDefault(); copyOut(e); });
 document.getElementById('copyConciseBtn')?.addEventListener('click', (e)=>{ e.preventDefault(); copyConcise(e); });
 document.getElementById('saveBtn')?.addEventListener('click', (e)=>{ e.preventDefault(); saveItem(e); });
+historyMore?.addEventListener('click', (e)=>{ e.preventDefault(); loadMoreHistory(); });
+historySearch?.addEventListener('input', ()=>{ clearTimeout(historyTimer); historyTimer = setTimeout(loadHistory, 250); });
+window.addEventListener('focus', syncHistory);
 
 // ---------- Init ----------
 window.addEventListener('load', ()=>{
   loadHistory();
   renderUserPresets?.();
   initModeBars();
-  setInterval(()=> initModeBars(), 60000);
 });
@@ -0,0 +1,109 @@
+"""
+Per-caller status board — a short-TTL cache of each caller's quota/credit
+status, with push to live subscribers (the `/status/stream` SSE channel).
+
+Routes that change a caller's quota call `changed(key)` (drop the entry and,
+if anyone is listening, reload and push) or `put(key, status)` when they
+already hold a fresh value. Entries also expire at `horizon()` (the daily
+reset), so nothing cached survives midnight.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+Status = Dict[str, Any]
+
+
+class StatusBoard:
+    def __init__(self, load: Callable[[str], Awaitable[Status]], ttl: float = 30.0,
+                 max_items: int = 10000, horizon: Optional[Callable[[], float]] = None):
+        self.load = load
+        self.ttl = ttl
+        self.max_items = max_items
+        self.horizon = horizon   # epoch seconds after which every entry is stale
+        self._mem: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (status, expires_at)
+        self._loading: Dict[str, asyncio.Task] = {}
+        self._subs: Dict[str, Set[asyncio.Queue]] = {}
+        self._tasks: set = set()
+        self.hits = 0
+        self.loads = 0
+        self.pushes = 0
+
+    # ---- cache ----
+    def _expiry(self) -> float:
+        expires = time.time() + self.ttl
+        return expires if self.horizon is None else min(expires, self.horizon())
+
+    def _store(self, key: str, status: Status):
+        self._mem[key] = (status, self._expiry())
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    async def get(self, key: str) -> Status:
+        entry = self._mem.get(key)
+        if entry is not None and entry[1] > time.time():
+            self.hits += 1
+            self._mem.move_to_end(key)
+            return entry[0]
+        # Concurrent misses for one key (several tabs at once) share a load.
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.ensure_future(self._load(key))
+            task.add_done_callback(lambda _t, k=key: self._loading.pop(k, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str) -> Status:
+        self.loads += 1
+        status = await self.load(key)
+        self._store(key, status)
+        return status
+
+    def put(self, key: str, status: Status):
+        """Store a fresh value and push it to subscribers if it changed."""
+        entry = self._mem.get(key)
+        self._store(key, status)
+        if entry is None or entry[0] != status:
+            self._publish(key, status)
+
+    def changed(self, key: str):
+        """The caller's status changed but the new value isn't known here."""
+        self._mem.pop(key, None)
+        if self._subs.get(key):
+            task = asyncio.get_running_loop().create_task(self.refresh(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def refresh(self, key: str) -> Status:
+        """Reload, bypassing the cache, and push if the value changed."""
+        self._mem.pop(key, None)
+        status = await self.load(key)
+        self.loads += 1
+        self.put(key, status)
+        return status
+
+    # ---- subscriptions ----
+    def subscribe(self, key: str) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=8)
+        self._subs.setdefault(key, set()).add(q)
+        return q
+
+    def unsubscribe(self, key: str, q: asyncio.Queue):
+        subs = self._subs.get(key)
+        if subs is not None:
+            subs.discard(q)
+            if not subs:
+                del self._subs[key]
+
+    def _publish(self, key: str, status: Status):
+        for q in self._subs.get(key, ()):
+            if q.full():   # a stalled reader only needs the newest value
+                q.get_nowait()
+            q.put_nowait(status)
+            self.pushes += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"items": len(self._mem), "hits": self.hits, "loads": self.loads, "pushes": self.pushes,
+                "subscribers": sum(len(s) for s in self._subs.values())}
@@ -0,0 +1,114 @@
+"""
+Token pre-flight for upstream calls — local token counts, prompt compaction
+and an input budget.
+
+Counts come from `tiktoken` when it is installed. Without it a heuristic is
+used: every run of up to 4 word characters, and every punctuation mark, is one
+token. That is close to BPE counts for English prose (within ~15%), and counts
+and truncation points agree with each other either way.
+
+`compact()` only removes what the model can't use: trailing and repeated
+spaces, runs of blank lines, and lines that repeat verbatim (consecutive
+repeats of any line, and later repeats of a substantial one).
+"""
+
+import re
+from typing import List, NamedTuple
+
+try:  # optional dependency
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_HEURISTIC = re.compile(r"\w{1,4}|[^\w\s]")
+_SPACES = re.compile(r"[ \t\f\v\u00a0]+")
+_REPEAT_MIN_CHARS = 16   # shorter lines ("-", "1)", "Example:") may legitimately repeat
+
+
+class TokenCounter:
+    def __init__(self, encoding: str = "cl100k_base"):
+        self._enc = None
+        if tiktoken is not None:
+            try:
+                self._enc = tiktoken.get_encoding(encoding)
+            except Exception:   # unknown name, or the BPE file can't be fetched offline
+                self._enc = None
+        self.name = f"tiktoken:{encoding}" if self._enc is not None else "heuristic"
+
+    def count(self, text: str) -> int:
+        if self._enc is not None:
+            return len(self._enc.encode(text, disallowed_special=()))
+        return sum(1 for _ in _HEURISTIC.finditer(text))
+
+    def truncate(self, text: str, limit: int) -> str:
+        """Longest prefix of `text` within `limit` tokens."""
+        if limit <= 0:
+            return ""
+        if self._enc is not None:
+            ids = self._enc.encode(text, disallowed_special=())
+            return text if len(ids) <= limit else self._enc.decode(ids[:limit])
+        for i, m in enumerate(_HEURISTIC.finditer(text)):
+            if i == limit:
+                return text[:m.start()].rstrip()
+        return text
+
+
+def compact(text: str) -> str:
+    lines: List[str] = []
+    seen = set()
+    blank = False
+    for raw in text.replace("\r\n", "\n").replace("\r", "\n").split("\n"):
+        stripped = raw.strip()
+        if not stripped:
+            blank = bool(lines)
+            continue
+        indent = raw[:len(raw) - len(raw.lstrip())]
+        line = indent + _SPACES.sub(" ", stripped)
+        if lines and line == lines[-1]:
+            continue
+        if len(stripped) >= _REPEAT_MIN_CHARS:
+            if line in seen:
+                continue
+            seen.add(line)
+        if blank:
+            lines.append("")
+            blank = False
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class OverBudget(ValueError):
+    def __init__(self, tokens: int, budget: int):
+        super().__init__(f"Prompt is too long ({tokens} tokens, max {budget}).")
+        self.tokens = tokens
+        self.budget = budget
+
+
+class Preflight(NamedTuple):
+    prompt: str            # what goes upstream
+    tokens: int            # its token count
+    original_tokens: int   # before compaction/truncation
+    truncated: bool
+
+
+def preflight(text: str, counter: TokenCounter, budget: int = 0, truncate: bool = True,
+              compact_text: bool = True) -> Preflight:
+    """Count, compact, then fit `text` into `budget` tokens (0 = unlimited).
+    Raises OverBudget instead of truncating when `truncate` is false."""
+    original = counter.count(text)
+    prompt = compact(text) if compact_text else text
+    tokens = counter.count(prompt) if prompt != text else original
+    truncated = False
+    if budget > 0 and tokens > budget:
+        if not truncate:
+            raise OverBudget(tokens, budget)
+        prompt = counter.truncate(prompt, budget)
+        tokens = counter.count(prompt)
+        truncated = True
+    return Preflight(prompt, tokens, original, truncated)
+
+
+def output_budget(input_tokens: int, base: int, ratio: float, ceiling: int, floor: int = 1) -> int:
+    """max_tokens for a rewrite: the goal's base allowance plus `ratio` per input
+    token (an improved prompt grows with what it improves), within [floor, ceiling]."""
+    return max(min(base + int(input_tokens * ratio), ceiling), min(floor, ceiling))
@@ -0,0 +1,107 @@
+"""
+Request tracing — named timing spans collected per request and reported in a
+`Server-Timing` response header — plus an on-demand sampling profiler.
+
+Spans live in a ContextVar holding one dict per request, so tasks and threads
+spawned from the request (which copy the context) add to the same dict.
+Outside a request, `span()`/`record()` are no-ops beyond a clock read.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+Spans = Dict[str, List[float]]   # name -> [total seconds, count]
+
+_spans: ContextVar[Optional[Spans]] = ContextVar("spans", default=None)
+
+
+def record(name: str, seconds: float):
+    spans = _spans.get()
+    if spans is None:
+        return
+    s = spans.get(name)
+    if s is None:
+        spans[name] = [seconds, 1]
+    else:
+        s[0] += seconds
+        s[1] += 1
+
+
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def server_timing(spans: Spans, total: float) -> str:
+    parts = []
+    for name, (secs, n) in spans.items():
+        parts.append(f'{name};dur={secs * 1000:.2f}' + (f';desc="x{n}"' if n > 1 else ""))
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+class ServerTimingMiddleware:
+    """Pure ASGI middleware. The header is written when the response starts, so
+    for streaming responses it covers only the work done before the first byte."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        spans: Spans = {}
+        token = _spans.set(spans)
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                value = server_timing(spans, time.perf_counter() - start).encode("latin-1")
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", value)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _spans.reset(token)
+
+
+# ---------------- Sampling profiler ----------------
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    """Sample every thread's Python stack for `seconds`; returns collapsed stacks
+    ("thread;outer;...;inner count" per line) for flamegraph.pl / speedscope.
+
+    Runs in the calling thread, which is excluded from the samples, so call it
+    from a worker thread, never from the event loop.
+    """
+    me = threading.get_ident()
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(labels))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
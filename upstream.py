@@ -0,0 +1,210 @@
+"""
+Upstream scheduling — an adaptive (AIMD) concurrency limit with a FIFO wait
+queue, fast rejection when the queue is full, and a jittered retry policy that
+honours `Retry-After`.
+
+The limiter knows nothing about HTTP: callers hold a slot per attempt and
+report the status they got, so it can back off on overload (429/503/504,
+timeouts) or on latency above the target, and probe upward again while calls
+stay fast.
+"""
+
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Mapping, Optional
+
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+OVERLOAD_STATUS = frozenset({429, 503, 504})
+
+
+class Overloaded(Exception):
+    """The wait queue is full (or the wait timed out); retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: int, reason: str = "queue full"):
+        super().__init__(f"Upstream busy ({reason}); retry in {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class Lease:
+    __slots__ = ("start", "status", "latency")
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.status: Optional[int] = None
+        self.latency: Optional[float] = None
+
+    def observe(self, status: int):
+        """Report the attempt's status; latency is measured up to this call
+        (so a stream reports time-to-headers, not its whole duration)."""
+        self.status = status
+        self.latency = time.monotonic() - self.start
+
+
+class AdaptiveLimiter:
+    """AIMD limit on concurrent upstream calls.
+
+    Each fast, successful call adds 1/limit (about +1 per round of calls); an
+    overload signal or a call slower than `target_latency` multiplies the limit
+    by `backoff`, at most once per `cooldown` so one burst of slow calls counts
+    as a single congestion event. Callers over the limit wait in arrival order;
+    beyond `queue_max` waiters, or after `queue_timeout` seconds of waiting,
+    `Overloaded` is raised instead. (There is no priority ordering: the quota
+    mode is process-wide, so one limiter never sees PAID and FREE callers mix.)
+    """
+
+    def __init__(self, min_limit: int = 2, max_limit: int = 64, initial: int = 16,
+                 queue_max: int = 256, queue_timeout: float = 10.0, target_latency: float = 15.0,
+                 backoff: float = 0.7, cooldown: float = 1.0):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._waiters: deque = deque()   # futures, oldest first
+        self._last_decrease = 0.0
+        self._ewma_latency = 1.0
+        self.rejected = 0
+        self.timeouts = 0
+        self.decreases = 0
+
+    # ---- queue ----
+    def queued(self) -> int:
+        return sum(1 for f in self._waiters if not f.done())
+
+    def saturated(self) -> bool:
+        """True when a new caller would be rejected right away."""
+        return self.in_flight >= int(self.limit) and self.queued() >= self.queue_max
+
+    def retry_after(self) -> int:
+        """Rough time for the current queue to drain, in whole seconds (1..60)."""
+        rounds = (self.queued() + 1) / max(int(self.limit), 1)
+        return min(60, max(1, math.ceil(rounds * self._ewma_latency)))
+
+    async def acquire(self, wait: bool = True) -> Lease:
+        """Take a slot (queueing if needed); pair with `release()`. With wait=False
+        raise Overloaded at once instead of queueing (used for optional work
+        like hedged requests, which must never displace queued callers)."""
+        await self._acquire(wait)
+        return Lease()
+
+    def release(self, lease: Lease, failed: bool = False):
+        """Give the slot back; `failed` marks an overload-type failure (timeout, reset)."""
+        if failed or lease.status is not None:
+            self._feedback(lease.latency, failed or lease.status in OVERLOAD_STATUS)
+        self._release()
+
+    async def _acquire(self, wait: bool = True):
+        if self.in_flight < int(self.limit) and not self.queued():
+            self.in_flight += 1
+            return
+        if not wait:
+            raise Overloaded(self.retry_after(), "no free slot")
+        if self.queued() >= self.queue_max:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not fut.done():
+                fut.cancel()
+                self.timeouts += 1
+                raise Overloaded(self.retry_after(), "queue wait timed out") from None
+        except BaseException:
+            if not fut.cancel():          # slot was already handed to us; give it back
+                self._release()
+            raise
+        # fut resolved: _wake() already counted us in in_flight
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+
+    # ---- feedback ----
+    def _feedback(self, latency: Optional[float], overloaded: bool):
+        now = time.monotonic()
+        if latency is not None:
+            self._ewma_latency += 0.2 * (latency - self._ewma_latency)
+        if overloaded or (latency is not None and latency > self.target_latency):
+            if now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.decreases += 1
+        elif latency is not None:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one upstream slot for the body; call `lease.observe(status)` once
+        the response status is known. Leaving with an error counts as overload
+        (timeouts, connection resets), except for cancellation/client disconnect."""
+        lease = await self.acquire()
+        failed = False
+        try:
+            yield lease
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.release(lease, failed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "queued": self.queued(),
+                "rejected": self.rejected, "queue_timeouts": self.timeouts, "decreases": self.decreases,
+                "ewma_latency_s": round(self._ewma_latency, 3)}
+
+
+def retry_after_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP-date)."""
+    value = (headers or {}).get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by attempts and a total time budget."""
+
+    def __init__(self, retries: int = 2, base: float = 0.5, cap: float = 8.0, budget: float = 20.0):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.budget = budget
+
+    def delay(self, attempt: int, elapsed: float, headers: Optional[Mapping[str, str]] = None) -> Optional[float]:
+        """Seconds to wait before retry number `attempt + 1`, or None to give up.
+        A server-provided Retry-After wins over the backoff but must fit the budget."""
+        if attempt >= self.retries:
+            return None
+        wait = retry_after_seconds(headers)
+        if wait is None:
+            wait = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        if elapsed + wait > self.budget:
+            return None
+        return wait